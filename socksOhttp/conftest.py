@@ -0,0 +1 @@
+# pytest puts this directory on sys.path, so the tests can import the socksohttp package
@@ -2,6 +2,7 @@ import logging
 
 from socksohttp.server import *
 from socksohttp.client import *
+from socksohttp.resolver import DNSCache, DNS_TTL, DNS_NEGATIVE_TTL
 from socksohttp import logger
 from socksohttp.socksetio_proxy import *
 
@@ -21,16 +22,41 @@ if __name__ == '__main__':
 	server_group.add_argument('listen_port', type=int, help='port for the server')
 	server_group.add_argument('-j', action='store_true', help='spin up proxy JS server')
 	server_group.add_argument('-s', action='store_true', help='spin up proxy Socket.IO server')
+	server_group.add_argument('--json', action='store_true', help='only offer the legacy JSON wire format to the agents')
+	server_group.add_argument('-e', '--encrypt', action='store_true', help='encrypt the traffic between server and agents')
+	server_group.add_argument('-c', '--compress', type=int, metavar='LEVEL', help='compress the traffic between server and agents with a deflate stream, starting at LEVEL (1-9)')
+	server_group.add_argument('--fixed-level', action='store_true', help='do not adjust the compression level automatically')
+	server_group.add_argument('-w', '--window', type=int, default=256*1024, metavar='BYTES', help='flow control window of each session, 0 turns flow control off')
+	server_group.add_argument('--queue-bytes', type=int, default=QUEUE_MAX_BYTES, metavar='BYTES', help='size limit of the outgoing queues, producers wait when it is reached. 0 makes them unbounded')
+	server_group.add_argument('--quantum', type=int, default=DRR_QUANTUM, metavar='BYTES', help='bytes each session may send per round when several sessions share the websocket')
+	server_group.add_argument('--interactive-ports', default='22,23,53,3389,5900', metavar='PORTS', help='comma separated destination ports whose sessions are always sent before bulk traffic')
+	server_group.add_argument('--bulk-ports', default='', metavar='PORTS', help='comma separated destination ports whose sessions are always bulk traffic')
+	server_group.add_argument('--small-packet', type=int, default=512, metavar='BYTES', help='other sessions count as interactive while their average packet is smaller than this')
+	server_group.add_argument('--early-data', action='store_true', help='answer SOCKS clients before the agent connected and send their first bytes along with the connect request')
 	
 	agent_group = subparsers.add_parser('agent', help='Agent mode')
 	agent_group.add_argument('url', help='URL to connect to')
 	agent_group.add_argument('-p','--proxy', help='Proxy server url')
 	agent_group.add_argument('-pi','--proxy-ip', help='IP the proxy should listen on', default = '127.0.0.1')
 	agent_group.add_argument('-pp','--proxy-port', type=int, help='Port the proxy should listen on', default = '10001')
+	agent_group.add_argument('--queue-bytes', type=int, default=QUEUE_MAX_BYTES, metavar='BYTES', help='size limit of the outgoing queues, producers wait when it is reached. 0 makes them unbounded')
+	agent_group.add_argument('--quantum', type=int, default=DRR_QUANTUM, metavar='BYTES', help='bytes each session may send per round when several sessions share the websocket')
+	agent_group.add_argument('--interactive-ports', default='22,23,53,3389,5900', metavar='PORTS', help='comma separated destination ports whose sessions are always sent before bulk traffic')
+	agent_group.add_argument('--bulk-ports', default='', metavar='PORTS', help='comma separated destination ports whose sessions are always bulk traffic')
+	agent_group.add_argument('--small-packet', type=int, default=512, metavar='BYTES', help='other sessions count as interactive while their average packet is smaller than this')
+	agent_group.add_argument('--stripes', type=int, default=1, metavar='N', help='use up to N websockets to the server, more are opened when the traffic needs them')
+	agent_group.add_argument('--stripe-rate', type=int, default=1024*1024, metavar='BYTES', help='traffic per websocket (bytes/sec) above which another one is opened')
+	agent_group.add_argument('--dns-ttl', type=int, default=DNS_TTL, metavar='SECONDS', help='how long resolved names are cached, 0 only merges lookups of the same name that run at the same time')
 
 	special_group = subparsers.add_parser('special', help='Special Agent mode')
 	special_group.add_argument('-l','--listen-ip', help='Ip to listen for incoming connections')
 	special_group.add_argument('-p','--listen-port', help='Port to listen for incoming connections')
+	special_group.add_argument('--queue-bytes', type=int, default=QUEUE_MAX_BYTES, metavar='BYTES', help='size limit of the outgoing queues, producers wait when it is reached. 0 makes them unbounded')
+	special_group.add_argument('--quantum', type=int, default=DRR_QUANTUM, metavar='BYTES', help='bytes each session may send per round when several sessions share the websocket')
+	special_group.add_argument('--interactive-ports', default='22,23,53,3389,5900', metavar='PORTS', help='comma separated destination ports whose sessions are always sent before bulk traffic')
+	special_group.add_argument('--bulk-ports', default='', metavar='PORTS', help='comma separated destination ports whose sessions are always bulk traffic')
+	special_group.add_argument('--small-packet', type=int, default=512, metavar='BYTES', help='other sessions count as interactive while their average packet is smaller than this')
+	special_group.add_argument('--dns-ttl', type=int, default=DNS_TTL, metavar='SECONDS', help='how long resolved names are cached, 0 only merges lookups of the same name that run at the same time')
 
 	args = parser.parse_args()
 	print(args)
@@ -56,28 +82,34 @@ if __name__ == '__main__':
 		wslogger.addHandler(logging.StreamHandler())
 
 
+	queue_bytes = args.queue_bytes if args.queue_bytes > 0 else None
+	priority_rules = PriorityRules(PriorityRules.parse_ports(args.interactive_ports), PriorityRules.parse_ports(args.bulk_ports), args.small_packet)
+
 	if args.mode == 'server':
 		logging.debug('Starting server mode')
 		if args.s == True:
 			s = SocketIOProxy(server_url = 'ws://127.0.0.1:8443',host = '0.0.0.0', port = '80', logger = logger)
 			asyncio.ensure_future(s.run())
-		cs = CommsServer(args.listen_ip, int(args.listen_port), args.j)
+		wire_format = WireFormat.JSON if args.json else WireFormat.BINARY
+		cs = CommsServer(args.listen_ip, int(args.listen_port), args.j, wire_format, args.encrypt, args.compress, not args.fixed_level, args.window if args.window > 0 else None, queue_bytes, args.quantum, priority_rules, args.early_data)
 		start_server = cs.run()
 		asyncio.get_event_loop().run_until_complete(start_server)
 		asyncio.get_event_loop().run_forever()
 
 	elif args.mode == 'agent':
 		logging.debug('Starting agent mode')
-		ca = CommsAgentServer(args.url, args.proxy, args.proxy_ip, args.proxy_port)
+		dns_cache = DNSCache(args.dns_ttl, min(args.dns_ttl, DNS_NEGATIVE_TTL))
+		ca = CommsAgentServer(args.url, args.proxy, args.proxy_ip, args.proxy_port, queue_bytes, args.quantum, priority_rules, StripePolicy(args.stripes, grow_rate = args.stripe_rate), dns_cache)
 		asyncio.get_event_loop().run_until_complete(ca.run())
 		logging.debug('Agent exited!')
 
 	elif args.mode == 'special':
 		logging.debug('Starting special agent mode')
+		dns_cache = DNSCache(args.dns_ttl, min(args.dns_ttl, DNS_NEGATIVE_TTL))
 		if args.listen_ip and args.listen_port:
-			ca = CommsAgentServerListening(args.listen_ip, args.listen_port)
+			ca = CommsAgentServerListening(args.listen_ip, args.listen_port, queue_bytes, args.quantum, priority_rules, dns_cache)
 		else:
-			ca = CommsAgentServerListening()
+			ca = CommsAgentServerListening(queue_bytes = queue_bytes, quantum = args.quantum, priority_rules = priority_rules, dns_cache = dns_cache)
 		asyncio.get_event_loop().run_until_complete(ca.run())
 		asyncio.get_event_loop().run_forever()
 		logging.debug('Agent exited!')
\ No newline at end of file
@@ -457,6 +457,12 @@ class AESModeOfOperationCFB(AESSegmentModeOfOperation):
 
 	segment_bytes = property(lambda s: s._segment_bytes)
 
+	def reset(self, iv):
+		'''Restarts the feedback with a new IV, the expanded key is kept.'''
+		if len(iv) != 16:
+			raise ValueError('initialization vector must be 16 bytes')
+		self._shift_register = _string_to_bytes(iv)
+
 	def encrypt(self, plaintext):
 		if len(plaintext) % self._segment_bytes != 0:
 			raise ValueError('plaintext block must be a multiple of segment_size')
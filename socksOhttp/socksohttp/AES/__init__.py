@@ -52,3 +52,4 @@ VERSION = [1, 3, 0]
 from .AES import AES, AESModeOfOperationCTR, AESModeOfOperationCBC, AESModeOfOperationCFB, AESModeOfOperationECB, AESModeOfOperationOFB, AESModesOfOperation, Counter
 from .blockfeeder import decrypt_stream, Decrypter, encrypt_stream, Encrypter
 from .blockfeeder import PADDING_NONE, PADDING_DEFAULT
+from .batchctr import AESModeOfOperationBatchCTR
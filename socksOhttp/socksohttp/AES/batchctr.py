@@ -0,0 +1,108 @@
+
+# Counter mode that computes the keystream for a whole buffer in one go.
+# The block function works on the expanded key of the AES class with plain
+# integer words, so there are no per byte lists and no copying between rounds.
+# XORing the keystream is done as one big integer, or with NumPy if it is
+# installed.
+
+import struct
+
+from .AES import AES
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+__all__ = ["AESModeOfOperationBatchCTR"]
+
+
+class AESModeOfOperationBatchCTR(object):
+	'''AES Counter Mode of Operation, batched.
+
+	   o A stream-cipher, the output is compatible with AESModeOfOperationCTR
+		 started from the same 128 bit counter value.
+	   o The keystream for all blocks of a buffer is computed at once, unused
+		 keystream bytes are kept for the next call.
+	   o The key is expanded once, reset() starts over from a new counter.'''
+
+
+	name = "Batch Counter (CTR)"
+
+	def __init__(self, key, iv = None, use_numpy = True):
+		self._aes = AES(key)
+		# the key schedule of AES holds signed words, the block function needs them unsigned
+		self._Ke = [[w & 0xFFFFFFFF for w in k] for k in self._aes._Ke]
+		self._rounds = len(self._Ke) - 1
+		self._use_numpy = use_numpy and numpy is not None
+		self.reset(iv)
+
+	def reset(self, iv = None):
+		'''Restarts the keystream from the counter value in iv (16 bytes).'''
+		if iv is None:
+			self._counter = 1
+		elif len(iv) != 16:
+			raise ValueError('initialization vector must be 16 bytes')
+		else:
+			self._counter = int.from_bytes(iv, byteorder = 'big', signed = False)
+		self._remaining = b''
+
+	def _keystream(self, blocks):
+		T1 = self._aes.T1
+		T2 = self._aes.T2
+		T3 = self._aes.T3
+		T4 = self._aes.T4
+		S = self._aes.S
+		Ke = self._Ke
+		k0 = Ke[0]
+		kl = Ke[self._rounds]
+		middle = Ke[1:self._rounds]
+
+		words = []
+		ctr = self._counter
+		for _ in range(blocks):
+			c = ctr & 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+			s0 = (c >> 96) ^ k0[0]
+			s1 = ((c >> 64) & 0xFFFFFFFF) ^ k0[1]
+			s2 = ((c >> 32) & 0xFFFFFFFF) ^ k0[2]
+			s3 = (c & 0xFFFFFFFF) ^ k0[3]
+			for k in middle:
+				s0, s1, s2, s3 = (
+					T1[s0 >> 24] ^ T2[(s1 >> 16) & 0xFF] ^ T3[(s2 >> 8) & 0xFF] ^ T4[s3 & 0xFF] ^ k[0],
+					T1[s1 >> 24] ^ T2[(s2 >> 16) & 0xFF] ^ T3[(s3 >> 8) & 0xFF] ^ T4[s0 & 0xFF] ^ k[1],
+					T1[s2 >> 24] ^ T2[(s3 >> 16) & 0xFF] ^ T3[(s0 >> 8) & 0xFF] ^ T4[s1 & 0xFF] ^ k[2],
+					T1[s3 >> 24] ^ T2[(s0 >> 16) & 0xFF] ^ T3[(s1 >> 8) & 0xFF] ^ T4[s2 & 0xFF] ^ k[3],
+				)
+			words.append(((S[s0 >> 24] << 24) | (S[(s1 >> 16) & 0xFF] << 16) | (S[(s2 >> 8) & 0xFF] << 8) | S[s3 & 0xFF]) ^ kl[0])
+			words.append(((S[s1 >> 24] << 24) | (S[(s2 >> 16) & 0xFF] << 16) | (S[(s3 >> 8) & 0xFF] << 8) | S[s0 & 0xFF]) ^ kl[1])
+			words.append(((S[s2 >> 24] << 24) | (S[(s3 >> 16) & 0xFF] << 16) | (S[(s0 >> 8) & 0xFF] << 8) | S[s1 & 0xFF]) ^ kl[2])
+			words.append(((S[s3 >> 24] << 24) | (S[(s0 >> 16) & 0xFF] << 16) | (S[(s1 >> 8) & 0xFF] << 8) | S[s2 & 0xFF]) ^ kl[3])
+			ctr += 1
+
+		self._counter = ctr
+		return struct.pack('>%dI' % len(words), *words)
+
+	def _xor(self, data, keystream):
+		if self._use_numpy:
+			a = numpy.frombuffer(data, dtype = numpy.uint8)
+			b = numpy.frombuffer(keystream, dtype = numpy.uint8)
+			return numpy.bitwise_xor(a, b).tobytes()
+
+		x = int.from_bytes(data, byteorder = 'big') ^ int.from_bytes(keystream, byteorder = 'big')
+		return x.to_bytes(len(data), byteorder = 'big')
+
+	def encrypt(self, plaintext):
+		length = len(plaintext)
+		if length == 0:
+			return b''
+
+		keystream = self._remaining
+		if len(keystream) < length:
+			keystream += self._keystream((length - len(keystream) + 15) // 16)
+
+		self._remaining = keystream[length:]
+		return self._xor(plaintext, keystream[:length])
+
+	def decrypt(self, ciphertext):
+		# AES-CTR is symetric
+		return self.encrypt(ciphertext)
@@ -0,0 +1,131 @@
+from collections import deque
+
+class ChunkBuffer:
+	"""
+	FIFO byte buffer that keeps the chunks as they were appended, so appending never copies what is already buffered.
+	Reading a whole chunk hands back the chunk itself, read_view returns a memoryview into the first chunk.
+	Either way every byte is copied at most once, no matter how far behind the consumer is.
+	"""
+	def __init__(self):
+		self.chunks = deque()
+		self.offset = 0 #start of the unread data in the first chunk
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def append(self, data):
+		if len(data) == 0:
+			return
+		if not isinstance(data, bytes):
+			#the caller may reuse a mutable buffer
+			data = bytes(data)
+		self.chunks.append(data)
+		self.size += len(data)
+
+	def consume(self, n):
+		while n > 0:
+			avail = len(self.chunks[0]) - self.offset
+			if n < avail:
+				self.offset += n
+				self.size -= n
+				return
+			self.chunks.popleft()
+			self.offset = 0
+			self.size -= avail
+			n -= avail
+
+	def read_view(self, n = -1):
+		"""
+		Up to n bytes from the first chunk as a memoryview, without copying
+		"""
+		if self.size == 0:
+			return memoryview(b'')
+		first = self.chunks[0]
+		avail = len(first) - self.offset
+		if n < 0 or n > avail:
+			n = avail
+		view = memoryview(first)[self.offset:self.offset + n]
+		self.consume(n)
+		return view
+
+	def read(self, n = -1):
+		"""
+		Up to n bytes (everything if n is negative) as bytes
+		"""
+		if n < 0 or n > self.size:
+			n = self.size
+		if n == 0:
+			return b''
+		first = self.chunks[0]
+		if self.offset == 0 and len(first) == n:
+			self.chunks.popleft()
+			self.size -= n
+			return first
+		if len(first) - self.offset >= n:
+			data = first[self.offset:self.offset + n]
+			self.consume(n)
+			return data
+		parts = []
+		while n > 0:
+			view = self.read_view(n)
+			parts.append(view)
+			n -= len(view)
+		return b''.join(parts)
+
+	def find(self, sub, start = 0):
+		"""
+		Position of sub in the buffered data or -1. Merges the chunks first, only meant for short protocol headers.
+		"""
+		if self.size == 0:
+			return -1
+		if len(self.chunks) > 1 or self.offset > 0:
+			self.append(self.read())
+		return self.chunks[0].find(sub, start)
+
+READ_SIZE_MIN = 4096
+READ_SIZE_MAX = 64*1024 #one read becomes one packet, JSON wire format makes it 4x longer and websockets refuses messages over 1MB
+
+class ReadSizer:
+	"""
+	Picks how much to read from a socket next. It starts small so interactive traffic goes out right away,
+	doubles while the socket keeps filling the whole read (bulk transfer, fewer and bigger packets) and
+	halves when a read returns less than half of what was asked for.
+	"""
+	def __init__(self, min_size = READ_SIZE_MIN, max_size = READ_SIZE_MAX):
+		self.min_size = min_size
+		self.max_size = max_size
+		self.size = min_size
+
+		self.reads = 0
+		self.total_bytes = 0
+		self.largest = min_size
+		self.grows = 0
+		self.shrinks = 0
+
+	def observe(self, n, asked = None):
+		"""
+		n is the length of what the read returned, asked the size of the read if it was smaller than size (eg. flow control credit)
+		"""
+		if asked is None:
+			asked = self.size
+		self.reads += 1
+		self.total_bytes += n
+		if n >= self.size and self.size < self.max_size:
+			self.size = min(self.size * 2, self.max_size)
+			self.grows += 1
+			if self.size > self.largest:
+				self.largest = self.size
+		elif n < asked // 2 and self.size > self.min_size:
+			self.size = max(self.size // 2, self.min_size)
+			self.shrinks += 1
+
+	def to_dict(self):
+		t = {}
+		t['size'] = self.size
+		t['largest'] = self.largest
+		t['reads'] = self.reads
+		t['avg_read'] = self.total_bytes // self.reads if self.reads > 0 else 0
+		t['grows'] = self.grows
+		t['shrinks'] = self.shrinks
+		return t
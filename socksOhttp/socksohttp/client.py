@@ -7,33 +7,45 @@ from .comms import *
 from . import logger
 from .modules.echo import EchoModule
 from .modules.socks5 import Socks5Module
-from .tcp_proxy import *
+from .relay import *
+from .resolver import DNSCache
 from .fakehttpserver import *
 
 import websockets
 
 
 class CommsAgentClient:
-	def __init__(self, client_uuid, in_queue, out_queue):
+	def __init__(self, client_uuid, in_queue, out_queue, wire_format = WireFormat.JSON, channel = None, priority_rules = None, dns_cache = None):
 		self.client_uuid = client_uuid
+		self.priority_rules = priority_rules
+		self.dns_cache = dns_cache
+		self.wire_format = wire_format
+		self.channel = channel
 		self.connected_at = datetime.utcnow()
 		self.last_seen_at = None
 		
 		self.in_queue = in_queue
-		self.out_queue = out_queue
+		self.out_queue = out_queue #StripedSink of the websockets, the modules send their data straight into it
 
 		self.modules = {} #jobid -> job_in_queue
-		self.modules_cmd_queue = asyncio.Queue()
+		self.socks5_modules = {} #jobid -> Socks5Module, for the session stats of the keepalive
+		self.modules_cmd_queue = asyncio.Queue() #job control messages, the modules send their data straight into out_queue
 		self.modules_ctr = Counter()
 		self.name = '[CommsAgentClient]'
 
+	def queue_stats(self):
+		return [stripe.out_queue.to_dict() for stripe in self.out_queue.stripes]
+
+	def session_stats(self):
+		return {job_id : module.session_stats() for job_id, module in self.socks5_modules.items()}
+
 	async def create_job(self, module_name):
 		logger.debug('%s Creating job %s' % (self.name, module_name))
 		try:
 			if module_name == 'echo':
 				job_id = self.modules_ctr.get_next()
 				in_queue = asyncio.Queue()
-				em = EchoModule(job_id, in_queue, self.modules_cmd_queue)
+				em = EchoModule(job_id, in_queue, self.out_queue)
 				asyncio.ensure_future(em.run())
 
 				self.modules[job_id] = in_queue
@@ -46,10 +58,11 @@ class CommsAgentClient:
 			if module_name == 'socks5':
 				job_id = self.modules_ctr.get_next()
 				in_queue = asyncio.Queue()
-				em = Socks5Module(job_id, in_queue, self.modules_cmd_queue)
+				em = Socks5Module(job_id, in_queue, self.out_queue, initial_window = self.channel.initial_window, priority_rules = self.priority_rules, dns_cache = self.dns_cache)
 				asyncio.ensure_future(em.run())
 
 				self.modules[job_id] = in_queue
+				self.socks5_modules[job_id] = em
 
 				rply = CreateJobRply()
 				rply.job_name = module_name
@@ -87,8 +100,7 @@ class CommsAgentClient:
 		try:
 			while True:
 				rply = await self.modules_cmd_queue.get()
-				rply.client_uuid = self.client_uuid
-				await self.out_queue.put(rply)
+				self.out_queue.put_nowait(rply)
 		except Exception as e:
 			logger.exception('%s listen_module_rplys' % (self.name,))
 
@@ -158,8 +170,9 @@ class FakeHTTPProxy:
 			writer.close()
 			return
 
-		tcp_proxy = AioTCPProxy(proxy_reader, proxy_writer, reader, writer, '[FakeHTTPProxy Proxy]', logger, timeout = None)
-		asyncio.ensure_future(tcp_proxy.run())
+		#plain TCP on both sides, the reads are not limited by the websocket message size
+		relay = Relay('[FakeHTTPProxy Proxy]', logger, timeout = None)
+		relay.connect(SocketEndpoint.from_stream(proxy_reader, proxy_writer, 256*1024, 'proxy'), SocketEndpoint.from_stream(reader, writer, 256*1024, 'client'))
 
 
 
@@ -172,9 +185,13 @@ class FakeHTTPProxy:
 		asyncio.ensure_future(server.serve_forever())
 
 class CommsAgentServerListening:
-	def __init__(self, listen_ip = '127.0.0.1', listen_port = 8443):
+	def __init__(self, listen_ip = '127.0.0.1', listen_port = 8443, queue_bytes = QUEUE_MAX_BYTES, quantum = DRR_QUANTUM, priority_rules = None, dns_cache = None):
 		self.listen_ip = listen_ip
 		self.listen_port = listen_port
+		self.queue_bytes = queue_bytes #bound of the outgoing queues, None makes them unbounded
+		self.quantum = quantum #DRR quantum of the outgoing scheduler
+		self.priority_rules = priority_rules #PriorityRules of the sessions, None means the defaults
+		self.dns_cache = dns_cache if dns_cache is not None else DNSCache() #shared by the sessions, it outlives the connection to the server
 		self.uuid = None
 		self.name = '[CommsAgentServerListening]'
 		self.client_timeout = 30
@@ -188,7 +205,7 @@ class CommsAgentServerListening:
 			try:
 				pong_waiter = await ws.ping()
 				await asyncio.wait_for(pong_waiter, timeout=self.client_timeout)
-				logger.debug('Server still alive!')
+				logger.debug('Server still alive! Queues: %s Sessions: %s DNS cache: %s' % (client.queue_stats(), client.session_stats(), self.dns_cache.to_dict()))
 				await asyncio.sleep(self.client_ping_interval)
 			except asyncio.TimeoutError:
 				logger.info('Server timed out, dropping client!')
@@ -205,34 +222,50 @@ class CommsAgentServerListening:
 			logger.debug('CMD recieved! %s' % str(type(cc)))
 
 			client_uuid = cc.cmd.client_uuid
-			rply = RegisterRply()
-			rply.client_uuid = client_uuid
+			rply = RegisterRply.negotiate(cc.cmd)
+			logger.debug('%s Negotiated options: %s' % (self.name, rply.to_dict()))
 			msg = ClientRply()
 			msg.uuid = cc.uuid
 			msg.rply = rply
+			msg.wire_format = cc.wire_format
 			data = msg.to_msg()
 			await ws.send(data)
 			client_in_queue = asyncio.Queue()
-			client_out_queue = asyncio.Queue()
+			client_out_queue = FrameSink(client_uuid, self.queue_bytes, self.quantum)
 
 			logger.debug('%s Registration succseeded! Got UUID: %s' % (self.name, client_uuid))
 
-			return CommsAgentClient(client_uuid, client_in_queue, client_out_queue)
+			#the rest of the connection uses the negotiated options
+			wire_format = WireFormat.BINARY if rply.wire_format == 'binary' else WireFormat.JSON
+			channel = CommsChannel(client_uuid, ModuleDesignation.AGENT, rply.with_encryption, rply.cipher_suite, rply.compression_level, rply.auto_level, batching = rply.batching, initial_window = rply.initial_window, session_open = rply.session_open)
+			#the connection comes from the other side, so this mode always has a single websocket
+			stripe = Stripe(client_uuid, client_in_queue, client_out_queue, wire_format, channel)
+			stripes = StripedSink(client_uuid, sticky = False)
+			stripes.add(stripe)
+			return CommsAgentClient(client_uuid, client_in_queue, stripes, wire_format, channel, self.priority_rules, self.dns_cache), stripe
 			
 		except Exception as e:
 			logger.exception()
-			return
+			return None, None
 	
 	async def handle_client_out(self, ws, client):
 		while True:
 			try:
-				rply = await client.out_queue.get()
-				msg = ClientRply()
-				msg.uuid = str(uuid.uuid4())
-				msg.rply = rply
-				data = msg.to_msg()
-				logger.debug('%s Sending data to server: %s' % (self.name, data))
-				await ws.send(data)
+				rplys = await get_batch(client.out_queue)
+				if client.wire_format == WireFormat.BINARY and client.channel.batching:
+					#everything that is pending goes out in one message
+					data = ClientRply.batch_to_msg(rplys, client.channel)
+					logger.debug('%s Sending data to server: %s' % (self.name, data))
+					await ws.send(data)
+					continue
+
+				for rply in rplys:
+					msg = ClientRply()
+					msg.rply = rply
+					msg.wire_format = client.wire_format
+					data = msg.to_msg(client.channel)
+					logger.debug('%s Sending data to server: %s' % (self.name, data))
+					await ws.send(data)
 			except Exception as e:
 				logger.exception(self.name)
 				return
@@ -242,9 +275,8 @@ class CommsAgentServerListening:
 			try:
 				msg = await ws.recv()
 				logger.debug('%s Got command from server: %s' % (self.name, msg))
-				cr = ClientCmd.from_msg(msg)
-				cmd_uuid = cr.uuid
-				await client.in_queue.put(cr.cmd)
+				for cc in ClientCmd.from_batch(msg, client.channel.with_encryption, channel = client.channel):
+					await client.in_queue.put(cc.cmd)
 			except Exception as e:
 				logger.exception(self.name)
 				return
@@ -252,10 +284,10 @@ class CommsAgentServerListening:
 	async def handle_client(self, ws, path):
 		logger.debug('JS proxy connected from %s:%d' % ws.remote_address)
 		try:
-			cc = await self.register(ws)
+			cc, stripe = await self.register(ws)
 			asyncio.ensure_future(self.keepalive(ws, cc))
-			asyncio.ensure_future(self.handle_client_in(ws, cc))
-			asyncio.ensure_future(self.handle_client_out(ws, cc))
+			asyncio.ensure_future(self.handle_client_in(ws, stripe))
+			asyncio.ensure_future(self.handle_client_out(ws, stripe))
 			await cc.run()
 		except Exception as e:
 				logger.exception(self.name)
@@ -273,8 +305,14 @@ class CommsAgentServerListening:
 			return
 
 class CommsAgentServer:
-	def __init__(self, url, proxy = None, proxy_listen_ip = None, proxy_listen_port = None):
+	def __init__(self, url, proxy = None, proxy_listen_ip = None, proxy_listen_port = None, queue_bytes = QUEUE_MAX_BYTES, quantum = DRR_QUANTUM, priority_rules = None, stripe_policy = None, dns_cache = None):
 		self.url = url
+		self.stripe_policy = stripe_policy if stripe_policy is not None else StripePolicy() #the default uses one websocket
+		self.striping = False #set if the server supports more websockets per agent
+		self.queue_bytes = queue_bytes #bound of the outgoing queues, None makes them unbounded
+		self.quantum = quantum #DRR quantum of the outgoing scheduler
+		self.priority_rules = priority_rules #PriorityRules of the sessions, None means the defaults
+		self.dns_cache = dns_cache if dns_cache is not None else DNSCache() #shared by the sessions, it outlives the connection to the server
 		self.uuid = None
 		self.proxy = proxy
 		self.proxy_listen_ip = proxy_listen_ip
@@ -293,43 +331,132 @@ class CommsAgentServer:
 			logger.debug('Original destination rewritten to connect to proxy! Final url: %s' % self.url)
 			self.proxy_server = FakeHTTPProxy(self.proxy, destination, self.proxy_listen_ip, self.proxy_listen_port)
 
-	async def register(self, ws):
+	async def register(self, ws, client = None):
+		"""
+		Registers the websocket. If client is set it is an additional stripe of that client.
+		Returns the client and the stripe.
+		"""
 		msg = await ws.recv()
 		cc = ClientCmd.from_msg(msg)
 		logger.debug('CMD recieved! %s' % str(type(cc)))
 
 		client_uuid = cc.cmd.client_uuid
-		rply = RegisterRply()
-		rply.client_uuid = client_uuid
+		rply = RegisterRply.negotiate(cc.cmd, client.client_uuid if client is not None else None)
+		logger.debug('%s Negotiated options: %s' % (self.name, rply.to_dict()))
 		msg = ClientRply()
 		msg.uuid = cc.uuid
 		msg.rply = rply
+		msg.wire_format = cc.wire_format
 		data = msg.to_msg()
 
 		await ws.send(data)
-		client_in_queue = asyncio.Queue()
-		client_out_queue = asyncio.Queue()
-		return CommsAgentClient(client_uuid, client_in_queue, client_out_queue)
-
+		client_out_queue = FrameSink(client_uuid, self.queue_bytes, self.quantum)
+		#the rest of the connection uses the negotiated options
+		wire_format = WireFormat.BINARY if rply.wire_format == 'binary' else WireFormat.JSON
+		channel = CommsChannel(client_uuid, ModuleDesignation.AGENT, rply.with_encryption, rply.cipher_suite, rply.compression_level, rply.auto_level, batching = rply.batching, initial_window = rply.initial_window, session_open = rply.session_open)
+		if client is None:
+			self.striping = rply.striping
+			client_in_queue = asyncio.Queue()
+			client = CommsAgentClient(client_uuid, client_in_queue, StripedSink(client_uuid, sticky = False), wire_format, channel, self.priority_rules, self.dns_cache)
+		stripe = Stripe(client_uuid, client.in_queue, client_out_queue, wire_format, channel)
+		client.out_queue.add(stripe)
 		logger.debug('%s Registration succseeded! Got UUID: %s' % (self.name, client_uuid))
+		return client, stripe
+
+	def start_stripe(self, ws, stripe):
+		stripe.tasks.append(asyncio.ensure_future(self.handle_client_in(ws, stripe)))
+		stripe.tasks.append(asyncio.ensure_future(self.handle_client_out(ws, stripe)))
+
+	async def add_stripe(self, client):
+		try:
+			ws = await websockets.connect(self.url)
+			_, stripe = await self.register(ws, client)
+			self.start_stripe(ws, stripe)
+			logger.debug('%s Opened a new stripe, now have %d' % (self.name, len(client.out_queue.stripes)))
+			return ws, stripe
+		except Exception as e:
+			logger.exception('%s add_stripe' % self.name)
+			return None, None
+
+	async def remove_stripe(self, client, ws, stripe):
+		"""
+		The stripe gets no new sessions, it is closed once the server sent everything it had for it and our sessions on it are closed
+		"""
+		try:
+			stripe.draining = True
+			stripe.out_queue.put_nowait(StripeRply(StripeOp.DRAIN))
+			await stripe.drained.wait()
+			while stripe.sessions > 0 or not stripe.out_queue.empty():
+				await asyncio.sleep(0.1)
+			await ws.close()
+		except Exception as e:
+			logger.exception('%s remove_stripe' % self.name)
+		client.out_queue.remove(stripe)
+		logger.debug('%s Closed a stripe, now have %d' % (self.name, len(client.out_queue.stripes)))
+
+	async def manage_stripes(self, client, ws):
+		policy = self.stripe_policy
+		websockets_of = {client.out_queue.stripes[0] : ws}
+		seen = {} #stripe -> bytes at the last check
+		while True:
+			await asyncio.sleep(policy.interval)
+			rate = 0
+			for stripe in client.out_queue.stripes:
+				total = stripe.channel.bytes_in + stripe.channel.bytes_out
+				rate += total - seen.get(stripe, 0)
+				seen[stripe] = total
+			rate = rate / policy.interval
+			active = client.out_queue.active()
+			backlog = sum(stripe.to_dict()['queued_bytes'] for stripe in active)
+			decision = policy.decide(len(active), rate, backlog)
+			if decision > 0:
+				new_ws, stripe = await self.add_stripe(client)
+				if stripe is not None:
+					websockets_of[stripe] = new_ws
+			elif decision < 0:
+				#never the first one, that is the one the agent is registered with
+				stripe = min(active[1:], key = lambda s: s.sessions)
+				asyncio.ensure_future(self.remove_stripe(client, websockets_of.pop(stripe), stripe))
+			for stripe in [s for s in seen if s.closed.is_set()]:
+				del seen[stripe]
 	
 	async def handle_client_out(self, ws, client):
 		while True:
-			rply = await client.out_queue.get()
-			msg = ClientRply()
-			msg.uuid = str(uuid.uuid4())
-			msg.rply = rply
-			data = msg.to_msg()
-			logger.debug('%s Sending data to server: %s' % (self.name, data))
-			await ws.send(data)
+			rplys = await get_batch(client.out_queue)
+			if client.wire_format == WireFormat.BINARY and client.channel.batching:
+				#everything that is pending goes out in one message
+				data = ClientRply.batch_to_msg(rplys, client.channel)
+				logger.debug('%s Sending data to server: %s' % (self.name, data))
+				client.channel.bytes_out += len(data)
+				await ws.send(data)
+				continue
+
+			for rply in rplys:
+				msg = ClientRply()
+				msg.rply = rply
+				msg.wire_format = client.wire_format
+				data = msg.to_msg(client.channel)
+				logger.debug('%s Sending data to server: %s' % (self.name, data))
+				client.channel.bytes_out += len(data)
+				await ws.send(data)
 
 	async def handle_client_in(self, ws, client):
 		while True:
-			msg = await ws.recv()
+			try:
+				msg = await ws.recv()
+			except websockets.exceptions.ConnectionClosed:
+				if client.draining:
+					#we closed a stripe we did not need anymore
+					return
+				raise
 			logger.debug('%s Got command from server: %s' % (self.name, msg))
-			cr = ClientCmd.from_msg(msg)
-			cmd_uuid = cr.uuid
-			await client.in_queue.put(cr.cmd)
+			client.channel.bytes_in += len(msg)
+			for cc in ClientCmd.from_batch(msg, client.channel.with_encryption, channel = client.channel):
+				if isinstance(cc.cmd, StripeCmd):
+					#the server will not send anything more on this websocket
+					client.drained.set()
+					continue
+				await client.in_queue.put(cc.cmd)
 
 	async def run(self):
 		try:
@@ -337,10 +464,12 @@ class CommsAgentServer:
 				asyncio.ensure_future(self.proxy_server.run())
 
 			async with websockets.connect(self.url) as ws:
-				client = await self.register(ws)
-				asyncio.ensure_future(self.handle_client_in(ws, client))
-				asyncio.ensure_future(self.handle_client_out(ws, client))
+				client, stripe = await self.register(ws)
+				self.start_stripe(ws, stripe)
+				if self.striping and self.stripe_policy.max_stripes > 1:
+					asyncio.ensure_future(self.manage_stripes(client, ws))
 				await client.run()
+				logger.debug('%s DNS cache: %s' % (self.name, self.dns_cache.to_dict()))
 			
 		except Exception as e:
 			logger.exception('Error in main loop!')
@@ -1,15 +1,564 @@
 import abc
+import time
 import zlib
 import json
 import enum
+import uuid
+import heapq
+import struct
+import asyncio
+from collections import deque
 from datetime import datetime
 
-from .AES import AESModeOfOperationCFB, Encrypter, Decrypter
+from .crypto import CIPHER_SUITES, AESCFBSuite, get_cipher_suite, select_cipher_suite
+from .compression import StreamCompressor, StreamDecompressor, CompressionVerdict
+from .buffers import ChunkBuffer
+from .queues import ByteQueue, DRRQueue
+from .priority import Priority, PriorityRules, SessionPriority
 from . import logger
 
 key = b'AAAAAAAAAAAAAAAA'
 iv = b'\x11'*16
 
+WIRE_VERSION = 3
+PROTOCOL_VERSION = 2 #1 is the original protocol where registration only carried the client uuid
+MSG_REPLY = 0x80 #set in the msg_type of binary frames carrying a reply
+MSG_BATCH = 0x7F #msg_type of a frame holding several frames, MSG_REPLY is set if they are replies
+
+BATCH_MAX_BYTES = 64*1024
+BATCH_MAX_DELAY = 0.002
+QUEUE_MAX_BYTES = 1024*1024 #default bound of the outgoing queues, producers wait when it is reached
+DRR_QUANTUM = 16*1024 #bytes a session may send per round of the outgoing scheduler
+
+class WireFormat(enum.Enum):
+	JSON = enum.auto() #legacy text frames, kept as fallback for old peers
+	BINARY = enum.auto()
+
+class FrameFlag(enum.IntFlag):
+	SESSION = 0x01 #job_data is a SessionPacket, session id is in the header
+	TEXT = 0x02 #job_data is a str
+	NODATA = 0x04 #job_data is None (session closing)
+	CONTROL = 0x08 #job_data is a SessionControl, the first payload byte is the ControlType
+	COMPRESSED = 0x10
+	ENCRYPTED = 0x20
+
+def pack_varint(n):
+	"""
+	LEB128, 7 bits per byte, the high bit means more bytes follow
+	"""
+	if n < 0x80:
+		return bytes((n,))
+	out = bytearray()
+	while n > 0x7F:
+		out.append((n & 0x7F) | 0x80)
+		n >>= 7
+	out.append(n)
+	return bytes(out)
+
+def unpack_varint(data, pos = 0):
+	"""
+	Returns the value and the position after it
+	"""
+	n = 0
+	shift = 0
+	while True:
+		if pos >= len(data):
+			raise Exception('Truncated varint!')
+		b = data[pos]
+		pos += 1
+		n |= (b & 0x7F) << shift
+		if not b & 0x80:
+			return n, pos
+		shift += 7
+		if shift > 63:
+			raise Exception('Varint too long!')
+
+class Frame:
+	"""
+	Binary websocket message.
+	Header: version, msg_type, flags as bytes then seq, ack, job_id and session_id (only if the SESSION flag is set)
+	as varints, followed by the raw payload.
+	seq and ack are only set on the frames that are sent as a websocket message (see SeqTracker), 0 otherwise.
+	"""
+	header = struct.Struct('!BBB')
+	overhead = 8 #typical header size, used for estimates only
+
+	def __init__(self):
+		self.version = WIRE_VERSION
+		self.msg_type = None
+		self.flags = FrameFlag(0)
+		self.seq = 0
+		self.ack = 0
+		self.job_id = 0
+		self.session_id = None
+		self.payload = b''
+		self.header_data = None
+		self.compression = None #CompressionVerdict of the session, not sent
+
+	def pack_header(self):
+		job_id = self.job_id if self.job_id is not None else 0
+		header = self.header.pack(self.version, self.msg_type, self.flags) + pack_varint(self.seq) + pack_varint(self.ack) + pack_varint(job_id)
+		if self.flags & FrameFlag.SESSION:
+			header += pack_varint(self.session_id)
+		return header
+
+	def to_bytes(self):
+		return self.pack_header() + self.payload
+
+	@staticmethod
+	def from_bytes(data):
+		if len(data) < Frame.header.size:
+			raise Exception('Frame too short!')
+		frame = Frame()
+		frame.version, frame.msg_type, flags = Frame.header.unpack_from(data)
+		if frame.version != WIRE_VERSION:
+			raise Exception('Unsupported wire version %d' % frame.version)
+		frame.flags = FrameFlag(flags)
+		frame.seq, pos = unpack_varint(data, Frame.header.size)
+		frame.ack, pos = unpack_varint(data, pos)
+		frame.job_id, pos = unpack_varint(data, pos)
+		if frame.flags & FrameFlag.SESSION:
+			frame.session_id, pos = unpack_varint(data, pos)
+		frame.header_data = data[:pos]
+		frame.payload = data[pos:]
+		return frame
+
+def pack_job_data(frame, job_data):
+	"""
+	Puts the job_data of a JobCmd/JobRply into the frame
+	"""
+	if isinstance(job_data, SessionControl):
+		frame.flags |= FrameFlag.SESSION | FrameFlag.CONTROL
+		frame.session_id = job_data.session_id
+		frame.payload = bytes((job_data.ctrl_type,)) + job_data.data
+		return
+
+	if isinstance(job_data, SessionPacket):
+		frame.flags |= FrameFlag.SESSION
+		frame.session_id = job_data.session_id
+		frame.compression = job_data.compression
+		job_data = job_data.data
+
+	if job_data is None:
+		frame.flags |= FrameFlag.NODATA
+	elif isinstance(job_data, str):
+		frame.flags |= FrameFlag.TEXT
+		frame.payload = job_data.encode()
+	else:
+		frame.payload = bytes(job_data)
+
+def unpack_job_data(frame):
+	if frame.flags & FrameFlag.CONTROL:
+		if len(frame.payload) == 0:
+			raise Exception('Empty control packet!')
+		return SessionControl(frame.session_id, frame.payload[0], frame.payload[1:])
+
+	if frame.flags & FrameFlag.NODATA:
+		job_data = None
+	elif frame.flags & FrameFlag.TEXT:
+		job_data = frame.payload.decode()
+	else:
+		job_data = frame.payload
+
+	if frame.flags & FrameFlag.SESSION:
+		return SessionPacket(frame.session_id, job_data)
+	return job_data
+
+def encode_payload(frame, channel = None):
+	compress_payload(frame, channel)
+	encrypt_payload(frame, channel)
+
+def compress_payload(frame, channel = None):
+	if channel is not None and channel.with_compression and len(frame.payload) > 0:
+		if frame.compression is None or frame.compression.should_compress(frame.payload):
+			#skipped frames are not part of the stream, the peer only decompresses frames with the flag set
+			size = len(frame.payload)
+			frame.payload = channel.compress(frame.payload)
+			frame.flags |= FrameFlag.COMPRESSED
+			if frame.compression is not None:
+				frame.compression.update(size, len(frame.payload))
+
+def encrypt_payload(frame, channel = None):
+	if channel is not None and channel.with_encryption:
+		frame.flags |= FrameFlag.ENCRYPTED
+		#the header is authenticated by suites that have a tag
+		frame.payload = channel.encrypt(frame.payload, frame.pack_header())
+
+def decode_payload(frame, channel = None):
+	if frame.flags & (FrameFlag.ENCRYPTED | FrameFlag.COMPRESSED) and channel is None:
+		raise Exception('Encrypted/compressed frame but no channel!')
+	if frame.flags & FrameFlag.ENCRYPTED:
+		frame.payload = channel.decrypt(frame.payload, frame.header_data)
+	if frame.flags & FrameFlag.COMPRESSED:
+		frame.payload = channel.decompress(frame.payload)
+
+batch_record = struct.Struct('!I')
+
+def pack_batch(frames, msg_type, channel = None):
+	"""
+	Packs frames into one batch frame: each record is the length and the bytes of a frame.
+	Records are compressed one by one (in order, so the deflate stream stays in sync),
+	the batch is encrypted once.
+	"""
+	batch = Frame()
+	batch.msg_type = msg_type
+	records = []
+	for frame in frames:
+		compress_payload(frame, channel)
+		data = frame.to_bytes()
+		records.append(batch_record.pack(len(data)))
+		records.append(data)
+	batch.payload = b''.join(records)
+	if channel is not None:
+		batch.seq, batch.ack = channel.seq.next()
+	encrypt_payload(batch, channel)
+	return batch.to_bytes()
+
+def unpack_batch(batch, channel = None):
+	"""
+	Returns the frames of an already decrypted batch frame
+	"""
+	frames = []
+	payload = batch.payload
+	pos = 0
+	while pos < len(payload):
+		if pos + batch_record.size > len(payload):
+			raise Exception('Truncated batch record!')
+		length, = batch_record.unpack_from(payload, pos)
+		pos += batch_record.size
+		if pos + length > len(payload):
+			raise Exception('Truncated batch record!')
+		frame = Frame.from_bytes(payload[pos:pos+length])
+		if frame.msg_type & ~MSG_REPLY == MSG_BATCH:
+			raise Exception('Nested batch!')
+		decode_payload(frame, channel)
+		frames.append(frame)
+		pos += length
+	return frames
+
+def estimate_size(obj):
+	job_data = obj if isinstance(obj, SessionPacket) else getattr(obj, 'job_data', None)
+	if isinstance(job_data, SessionPacket):
+		job_data = job_data.data
+	if job_data is None:
+		return Frame.overhead
+	return Frame.overhead + len(job_data)
+
+def flow_key(obj):
+	"""
+	Sessions are scheduled separately, job data that does not belong to a session shares one flow per job
+	"""
+	job_data = getattr(obj, 'job_data', None)
+	if isinstance(job_data, SessionPacket):
+		return (obj.job_id, job_data.session_id)
+	return (getattr(obj, 'job_id', None), None)
+
+class FrameSink:
+	"""
+	Outgoing messages of one websocket, read by its writer task (handle_client_out) with get_batch.
+	Modules put their data here directly instead of going through the queues of the client objects.
+	Every message has a Priority class and the writer always takes from the highest class that has something:
+	put_nowait is the control class (job creation, window updates), it never waits.
+	put is for job data, the class of session data comes from the SessionPriority of its packets.
+	Each data class is bounded by max_bytes and has a queue per session served deficit round robin (see DRRQueue),
+	so one bulk transfer does not hold up the interactive sessions or new connections.
+	"""
+	def __init__(self, client_uuid, max_bytes = QUEUE_MAX_BYTES, quantum = DRR_QUANTUM):
+		self.client_uuid = client_uuid
+		self.control = deque()
+		self.lanes = [] #data lanes, highest priority first
+		for priority in [Priority.INTERACTIVE, Priority.BULK]:
+			self.lanes.append((priority, DRRQueue(max_bytes, estimate_size, flow_key, quantum, priority.name.lower())))
+		self.ready = asyncio.Event()
+		self.total_control = 0
+
+	def qsize(self):
+		return len(self.control) + sum(lane.qsize() for _, lane in self.lanes)
+
+	def empty(self):
+		return self.qsize() == 0
+
+	def put_nowait(self, item):
+		item.client_uuid = self.client_uuid
+		self.control.append(item)
+		self.total_control += 1
+		self.ready.set()
+
+	def get_lane(self, item):
+		priority = Priority.INTERACTIVE
+		job_data = getattr(item, 'job_data', None)
+		if isinstance(job_data, SessionPacket) and job_data.priority is not None:
+			if job_data.data is None:
+				priority = job_data.priority.priority
+			else:
+				priority = job_data.priority.observe(len(job_data.data))
+		key = flow_key(item)
+		for _, lane in self.lanes:
+			#the session changed class but still has data queued, it stays in order
+			if key in lane.flows:
+				return lane
+		for lane_priority, lane in self.lanes:
+			if lane_priority == priority:
+				return lane
+		return self.lanes[-1][1]
+
+	async def put(self, item):
+		item.client_uuid = self.client_uuid
+		await self.get_lane(item).put(item)
+		self.ready.set()
+
+	def get_nowait(self):
+		if len(self.control) > 0:
+			return self.control.popleft()
+		for _, lane in self.lanes:
+			if not lane.empty():
+				return lane.get_nowait()
+		raise asyncio.QueueEmpty()
+
+	async def get(self):
+		while self.empty():
+			self.ready.clear()
+			await self.ready.wait()
+		return self.get_nowait()
+
+	def to_dict(self):
+		t = {}
+		t['name'] = 'sink'
+		t['control_items'] = len(self.control)
+		t['total_control'] = self.total_control
+		for _, lane in self.lanes:
+			t[lane.name] = lane.to_dict()
+		return t
+
+class Stripe:
+	"""
+	One websocket of a client. An agent can have several of them (see StripedSink), each one is registered
+	on its own so it has its own channel (sequence numbers, compression stream, encryption nonce) and FrameSink.
+	It has the attributes handle_client_in/handle_client_out need from a client.
+	"""
+	def __init__(self, client_uuid, in_queue, out_queue, wire_format, channel):
+		self.client_uuid = client_uuid
+		self.in_queue = in_queue #shared by all stripes of the client
+		self.out_queue = out_queue #FrameSink
+		self.wire_format = wire_format
+		self.channel = channel
+		self.sessions = 0 #sessions that sent data on this stripe and are not closed yet
+		self.draining = False #gets no new sessions
+		self.drained = asyncio.Event() #set once the server will not send anything more on it
+		self.closed = asyncio.Event()
+		self.group = None #StripedSink the stripe belongs to
+		self.tasks = [] #handler tasks of the websocket, cancelled when the stripe is removed
+
+	def queue_stats(self):
+		return [self.out_queue.to_dict()]
+
+	def to_dict(self):
+		t = {}
+		t['client_uuid'] = self.client_uuid
+		t['sessions'] = self.sessions
+		t['draining'] = self.draining
+		t['queued_bytes'] = sum(lane.size for _, lane in self.out_queue.lanes)
+		return t
+
+class StripedSink:
+	"""
+	What the modules of a client send into when it can have several websockets (stripes).
+	Every message is passed on to the FrameSink of one stripe, the first one unless it belongs to a session.
+	A session is pinned to the stripe it first sent on, so its data and its control messages stay in order.
+	New sessions go to the stripe with the least open sessions, draining stripes get none.
+	On the server the pin outlives the session (sticky): it reuses session ids, and the first packet of the
+	new session must not overtake the closing packet of the old one on another websocket, so it only reuses
+	the ids that are pinned to the stripe it wants (see open_session). If the pinned stripe already
+	sent its last message (drained) the new session waits for it to be closed before moving to another one.
+	The agent drops the pin when it sends the closing packet, the server only reuses the id after it got that.
+	"""
+	def __init__(self, client_uuid, sticky = True):
+		self.client_uuid = client_uuid
+		self.sticky = sticky
+		self.stripes = [] #the first one is the websocket the client registered with
+		self.pins = {} #flow_key -> Stripe
+		self.open_sessions = set() #flow keys of the sessions that are counted in Stripe.sessions
+
+	def add(self, stripe):
+		stripe.group = self
+		self.stripes.append(stripe)
+
+	def remove(self, stripe):
+		stripe.closed.set()
+		for task in stripe.tasks:
+			task.cancel()
+		if stripe in self.stripes:
+			self.stripes.remove(stripe)
+		for key in [k for k, v in self.pins.items() if v is stripe]:
+			del self.pins[key]
+			self.open_sessions.discard(key)
+
+	def active(self):
+		return [s for s in self.stripes if not s.draining]
+
+	def pick(self):
+		stripes = self.active()
+		if len(stripes) == 0:
+			stripes = self.stripes
+		return min(stripes, key = lambda s: (s.sessions, s.out_queue.qsize()))
+
+	async def get_stripe(self, item):
+		job_data = getattr(item, 'job_data', None)
+		if not isinstance(job_data, SessionPacket):
+			return self.stripes[0]
+		key = flow_key(item)
+		stripe = self.pins.get(key)
+		if stripe is not None and stripe.drained.is_set() and key not in self.open_sessions:
+			#only reachable by a reused session id, see above. A session that is still open on the agent
+			#(eg. answering the close of the server) has to finish on its stripe, which waits for it
+			await stripe.closed.wait()
+			stripe = None
+		if stripe is None:
+			stripe = self.pick()
+			self.pins[key] = stripe
+
+		if isinstance(job_data, SessionControl):
+			return stripe
+		if job_data.data is None:
+			if key in self.open_sessions:
+				self.open_sessions.remove(key)
+				stripe.sessions -= 1
+			if not self.sticky:
+				del self.pins[key]
+		elif key not in self.open_sessions:
+			self.open_sessions.add(key)
+			stripe.sessions += 1
+		return stripe
+
+	async def put(self, item):
+		stripe = await self.get_stripe(item)
+		await stripe.out_queue.put(item)
+
+	def open_session(self, job_id, session_ids):
+		"""
+		Allocates the id of a new session from the IdAllocator session_ids and pins it right away, so sessions
+		opened at the same time are spread too. A released id is only reused if it is not pinned or pinned to the
+		stripe the new session gets.
+		"""
+		stripe = self.pick()
+		def accept(session_id):
+			pin = self.pins.get((job_id, session_id))
+			return pin is None or pin is stripe
+		session_id = session_ids.get(accept)
+		key = (job_id, session_id)
+		self.pins[key] = stripe
+		self.open_sessions.add(key)
+		stripe.sessions += 1
+		return session_id
+
+	def put_nowait(self, item):
+		stripe = self.stripes[0]
+		job_data = getattr(item, 'job_data', None)
+		if isinstance(job_data, SessionPacket):
+			stripe = self.pins.get(flow_key(item))
+			if stripe is None or stripe.drained.is_set():
+				#a control message of a session that has nothing to keep in order with anymore
+				stripe = self.pick()
+		stripe.out_queue.put_nowait(item)
+
+	def qsize(self):
+		return sum(s.out_queue.qsize() for s in self.stripes)
+
+	def empty(self):
+		return self.qsize() == 0
+
+	async def drain(self, stripe):
+		"""
+		Server side of closing a stripe: once none of its sessions are open and everything queued on it
+		went out, tells the agent that nothing more will come on it. The agent then closes the websocket.
+		"""
+		stripe.draining = True
+		while stripe.sessions > 0 or not stripe.out_queue.empty():
+			await asyncio.sleep(0.1)
+		stripe.drained.set()
+		stripe.out_queue.put_nowait(StripeCmd(StripeOp.DRAINED))
+
+	def to_dict(self):
+		return [s.to_dict() for s in self.stripes]
+
+class StripePolicy:
+	"""
+	Decides on the agent how many websockets (stripes) to use, every interval seconds from the traffic
+	of the last interval. A stripe is added while the traffic per stripe is above grow_rate (bytes/sec)
+	or while more than grow_backlog bytes are waiting per stripe. One is removed when the others could
+	carry the traffic at a quarter of grow_rate and nothing is waiting, for shrink_after intervals in a row.
+	"""
+	def __init__(self, max_stripes = 1, min_stripes = 1, grow_rate = 1024*1024, grow_backlog = 256*1024, shrink_after = 5, interval = 1.0):
+		self.max_stripes = max_stripes
+		self.min_stripes = min_stripes
+		self.grow_rate = grow_rate
+		self.grow_backlog = grow_backlog
+		self.shrink_after = shrink_after
+		self.interval = interval
+		self.idle = 0
+
+	def decide(self, stripes, rate, backlog):
+		"""
+		Returns +1, -1 or 0
+		"""
+		if stripes < self.max_stripes and (rate / stripes >= self.grow_rate or backlog / stripes >= self.grow_backlog):
+			self.idle = 0
+			return 1
+		if stripes > self.min_stripes and backlog == 0 and rate / (stripes - 1) < self.grow_rate / 4:
+			self.idle += 1
+			if self.idle >= self.shrink_after:
+				self.idle = 0
+				return -1
+			return 0
+		self.idle = 0
+		return 0
+
+async def get_batch(queue, max_bytes = BATCH_MAX_BYTES, max_delay = BATCH_MAX_DELAY):
+	"""
+	Waits for the next item of the queue, then takes everything else that is pending.
+	While there is room it yields to the other tasks so they can add more, but never longer than max_delay.
+	"""
+	items = [await queue.get()]
+	size = estimate_size(items[0])
+	deadline = time.monotonic() + max_delay
+	while size < max_bytes:
+		if queue.empty():
+			if time.monotonic() >= deadline:
+				break
+			await asyncio.sleep(0)
+			if queue.empty():
+				break
+		item = queue.get_nowait()
+		items.append(item)
+		size += estimate_size(item)
+	return items
+
+
+class IdAllocator:
+	"""
+	Hands out small integer ids, released ids are reused (lowest first) so they stay short on the wire.
+	"""
+	def __init__(self, start_no = 0):
+		self.next_id = start_no
+		self.free = []
+
+	def get(self, accept = None):
+		"""
+		accept can limit which released ids may be reused, if none of them is accepted a new id is handed out
+		"""
+		if accept is None and len(self.free) > 0:
+			return heapq.heappop(self.free)
+		for free_id in sorted(self.free):
+			if accept(free_id):
+				self.free.remove(free_id)
+				heapq.heapify(self.free)
+				return free_id
+		new_id = self.next_id
+		self.next_id += 1
+		return new_id
+
+	def release(self, free_id):
+		heapq.heappush(self.free, free_id)
 
 class Counter:
 	def __init__(self, start_no = 0):
@@ -20,10 +569,140 @@ class Counter:
 		self.current += 1
 		return ctr
 
+class SeqTracker:
+	"""
+	Sequence numbers of the websocket messages of one connection.
+	Every message carries its own seq and the last seq seen from the peer as ack.
+	Gaps and old seqs are counted as lost/reordered, an ack that moves forward gives a round trip sample
+	(it includes the time the peer had nothing to send, so it is an upper bound on idle connections).
+	"""
+	max_pending = 1024
+
+	def __init__(self):
+		self.send_seq = 0
+		self.recv_seq = 0
+		self.pending = deque() #(seq, sent_at) waiting for an ack
+		self.lost = 0
+		self.reordered = 0
+		self.srtt = None
+		self.rttvar = None
+
+	def next(self, track = True):
+		"""
+		Returns the seq and ack for the next outgoing message
+		"""
+		self.send_seq = (self.send_seq + 1) & 0xFFFFFFFF
+		if track:
+			self.pending.append((self.send_seq, time.monotonic()))
+			if len(self.pending) > self.max_pending:
+				self.pending.popleft()
+		return self.send_seq, self.recv_seq
+
+	def received(self, seq, ack):
+		expected = (self.recv_seq + 1) & 0xFFFFFFFF
+		if seq != expected:
+			if (seq - expected) & 0xFFFFFFFF < 0x80000000:
+				self.lost += (seq - expected) & 0xFFFFFFFF
+				logger.debug('Messages lost! Expected seq %d got %d' % (expected, seq))
+			else:
+				self.reordered += 1
+				logger.debug('Message out of order! Expected seq %d got %d' % (expected, seq))
+				return
+		self.recv_seq = seq
+		self.acked(ack)
+
+	def acked(self, ack):
+		sample = None
+		while len(self.pending) > 0 and (ack - self.pending[0][0]) & 0xFFFFFFFF < 0x80000000:
+			seq, sent_at = self.pending.popleft()
+			if seq == ack:
+				sample = time.monotonic() - sent_at
+		if sample is None:
+			return
+		if self.srtt is None:
+			self.srtt = sample
+			self.rttvar = sample / 2
+		else:
+			self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+			self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+	def to_dict(self):
+		t = {}
+		t['send_seq'] = self.send_seq
+		t['recv_seq'] = self.recv_seq
+		t['lost'] = self.lost
+		t['reordered'] = self.reordered
+		t['srtt'] = self.srtt
+		t['rttvar'] = self.rttvar
+		return t
+
 class ModuleDesignation(enum.Enum):
 	SERVER = enum.auto()
 	AGENT = enum.auto()
 
+class CommsChannel:
+	"""
+	Per websocket state, created once the client is registered.
+	Encryption: the cipher suite (see crypto.py) is set up only once. Binary frames get a fresh
+	IV per frame built from the direction, the client uuid and a running counter. The aes-ctr and
+	shake256-hmac suites also derive a key of their own for each connection from the client uuid.
+	Compression: one deflate stream per direction (see compression.py), compression_level None turns it off.
+	Both need the frames to be processed in order, websockets guarantee that.
+	"""
+	def __init__(self, client_uuid, designation, with_encryption = False, cipher_suite = 'aes-cfb', compression_level = None, auto_level = True, batching = False, initial_window = None, session_open = False, enc_key = key):
+		self.client_uuid = client_uuid
+		self.designation = designation
+		self.batching = batching
+		self.initial_window = initial_window
+		self.session_open = session_open
+		self.with_encryption = with_encryption
+		self.cipher_suite = cipher_suite
+		self.nonce = uuid.UUID(client_uuid).bytes
+		self.suite = get_cipher_suite(cipher_suite, enc_key, self.nonce)
+		self.legacy_suite = AESCFBSuite(enc_key)
+		
+		self.send_ctr = Counter()
+		self.recv_ctr = Counter()
+		self.seq = SeqTracker()
+		self.bytes_in = 0 #websocket message bytes, for the stripe policy
+		self.bytes_out = 0
+
+		self.compressor = None
+		if compression_level is not None:
+			self.compressor = StreamCompressor(compression_level, auto_level)
+		self.decompressor = StreamDecompressor()
+
+	@property
+	def with_compression(self):
+		return self.compressor is not None
+
+	def compress(self, data):
+		return self.compressor.compress(data)
+
+	def decompress(self, data):
+		return self.decompressor.decompress(data)
+
+	def get_iv(self, designation, ctr):
+		direction = 0 if designation == ModuleDesignation.SERVER else 1
+		return self.suite.get_iv(direction, self.nonce, ctr)
+
+	def encrypt(self, data, aad = b''):
+		return self.suite.seal(self.get_iv(self.designation, self.send_ctr.get_next()), data, aad)
+
+	def decrypt(self, data, aad = b''):
+		#frames we recieve were encrypted by the other side
+		designation = ModuleDesignation.AGENT if self.designation == ModuleDesignation.SERVER else ModuleDesignation.SERVER
+		return self.suite.open(self.get_iv(designation, self.recv_ctr.get_next()), data, aad)
+
+	def encrypt_legacy(self, data):
+		"""
+		JSON messages always use the same IV, this is what old peers expect
+		"""
+		return self.legacy_suite.seal(iv, data)
+
+	def decrypt_legacy(self, data):
+		return self.legacy_suite.open(iv, data)
+
 class CommsModule:
 	def __init__(self, module_name, job_id, in_queue, out_queue, designation = ModuleDesignation.SERVER):
 		self.module_name = module_name
@@ -37,17 +716,24 @@ class CommsModule:
 		data = await self.in_queue.get()
 		return data
 
-	async def send_data(self, data):
+	def wrap_data(self, data):
 		if self.designation == ModuleDesignation.SERVER:
 			cmd = JobCmd()
-			cmd.job_id = self.job_id
-			cmd.job_data = data
-			await self.out_queue.put(cmd)
 		else:
 			cmd = JobRply()
-			cmd.job_id = self.job_id
-			cmd.job_data = data
-			await self.out_queue.put(cmd)
+		cmd.job_id = self.job_id
+		cmd.job_data = data
+		return cmd
+
+	async def send_data(self, data):
+		await self.out_queue.put(self.wrap_data(data))
+
+	def send_control(self, data):
+		"""
+		For small control data (eg. window updates), never waits.
+		If out_queue is a FrameSink this skips ahead of the queued data.
+		"""
+		self.out_queue.put_nowait(self.wrap_data(data))
 
 class CommsModuleStreaming:
 	def __init__(self, module_name, job_id, in_queue, out_queue, designation = ModuleDesignation.SERVER):
@@ -58,43 +744,27 @@ class CommsModuleStreaming:
 		self.started_at = datetime.utcnow()
 		self.designation = designation
 
-		self.in_buffer = b''
+		self.in_buffer = ChunkBuffer()
+		self.data_arrived = asyncio.Event()
 
 		asyncio.ensure_future(self.get_data())
 
 	async def read(self, maxlen = -1):
-		if maxlen == -1:
-			data = self.in_buffer
-			self.in_buffer = b''
-			return data
-		else:
-			if len(self.in_buffer) >= maxlen:
-				data = self.in_buffer[maxlen]
-				self.in_buffer = self.in_buffer[maxlen:]
-				return data
-			else:
-				data = self.in_buffer
-				self.in_buffer = b''
-				return data
-
-	async def readexactly(cnt):
-		if len(self.in_buffer) >= cnt:
-			data = self.in_buffer[maxlen]
-			self.in_buffer = self.in_buffer[maxlen:]
-			return data
-		else:
-			while not len(self.in_buffer) >= cnt:
-				await asyincio.sleep(0.01)
-			
-			data = self.in_buffer[maxlen]
-			self.in_buffer = self.in_buffer[maxlen:]
-			return data
+		return self.in_buffer.read(maxlen)
+
+	async def readexactly(self, cnt):
+		while len(self.in_buffer) < cnt:
+			self.data_arrived.clear()
+			await self.data_arrived.wait()
+		return self.in_buffer.read(cnt)
 
-	
 	async def get_data(self):
 		while True:
 			data = await self.in_queue.get()
-			self.in_buffer += bytes.fromhex(data)
+			if isinstance(data, str):
+				data = bytes.fromhex(data)
+			self.in_buffer.append(data)
+			self.data_arrived.set()
 
 	async def send_data(self, data):
 		if self.designation == ModuleDesignation.SERVER:
@@ -109,6 +779,128 @@ class CommsModuleStreaming:
 			await self.out_queue.put(cmd)
 
 
+class SessionPacket:
+	"""
+	Job data belonging to one session of a module (eg. one TCP connection of the socks5 module).
+	session_id is a small int given out by the module on the server side (see IdAllocator).
+	data being None signals that the session is closing, both sides send it exactly once.
+	compression is the CompressionVerdict and priority the SessionPriority of the session, they stay in memory.
+	"""
+	def __init__(self, session_id, data, compression = None, priority = None):
+		self.session_id = session_id
+		self.data = data
+		self.compression = compression
+		self.priority = priority
+
+	def to_dict(self):
+		t = {}
+		t['session_id'] = self.session_id
+		if self.data is None: #special case for closing socket
+			t['data'] = None
+		else:
+			t['data'] = self.data.hex()
+		return t
+
+	def to_json(self):
+		return json.dumps(self.to_dict())
+
+	@classmethod
+	def from_data(cls, data):
+		if isinstance(data, SessionPacket):
+			#binary frames are already decoded
+			return data
+		packet = json.loads(data)
+		pdata = packet['data']
+		if 'ctrl_type' in packet:
+			return SessionControl(packet['session_id'], packet['ctrl_type'], bytes.fromhex(pdata))
+		if pdata is None:
+			return cls(packet['session_id'], None)
+		else:
+			return cls(packet['session_id'], bytes.fromhex(pdata))
+
+class ControlType(enum.IntEnum):
+	WINDOW_UPDATE = 1 #data is the varint increment
+	OPEN = 2 #server asks the agent to open the session, data is the module's connect request, it can be followed by the first data of the session
+	OPEN_RESULT = 3 #agent's answer to OPEN, data is one result code byte of the module
+
+class SessionControl(SessionPacket):
+	"""
+	Control message of a session, it is not part of the stream data
+	"""
+	def __init__(self, session_id, ctrl_type, data = b''):
+		SessionPacket.__init__(self, session_id, data)
+		self.ctrl_type = ctrl_type
+
+	def to_dict(self):
+		t = SessionPacket.to_dict(self)
+		t['ctrl_type'] = self.ctrl_type
+		return t
+
+	@staticmethod
+	def window_update(session_id, increment):
+		return SessionControl(session_id, ControlType.WINDOW_UPDATE, pack_varint(increment))
+
+	@staticmethod
+	def open_result(session_id, code):
+		return SessionControl(session_id, ControlType.OPEN_RESULT, bytes((code,)))
+
+	@property
+	def increment(self):
+		return unpack_varint(self.data)[0]
+
+	@property
+	def result_code(self):
+		return self.data[0]
+
+class FlowWindow:
+	"""
+	Credit based flow control of one session, HTTP/2 style.
+	Sending: at most send_credit bytes may be in flight, the reader of the local socket waits when it runs out.
+	Recieving: the bytes passed on to the local socket are given back to the peer with a WINDOW_UPDATE
+	once they add up to half the window, so a session never has more than initial_window bytes buffered on the other side.
+	"""
+	def __init__(self, initial_window):
+		self.initial_window = initial_window
+		self.send_credit = initial_window
+		self.has_credit = asyncio.Event()
+		self.has_credit.set()
+		self.delivered_bytes = 0
+		self.closed = False
+
+	async def wait_for_credit(self):
+		"""
+		Returns False if the session got closed while waiting
+		"""
+		while self.send_credit <= 0 and not self.closed:
+			await self.has_credit.wait()
+		return not self.closed
+
+	def consume(self, n):
+		self.send_credit -= n
+		if self.send_credit <= 0:
+			self.has_credit.clear()
+
+	def update(self, increment):
+		self.send_credit += increment
+		if self.send_credit > 0:
+			self.has_credit.set()
+
+	def delivered(self, n):
+		"""
+		Returns the increment to send to the peer, 0 if it is not time yet
+		"""
+		self.delivered_bytes += n
+		if self.delivered_bytes < self.initial_window // 2:
+			return 0
+		increment = self.delivered_bytes
+		self.delivered_bytes = 0
+		return increment
+
+	def close(self):
+		self.closed = True
+		self.has_credit.set()
+
+
 class ClientCmd:
 	__metaclass__ = abc.ABCMeta
 	def __init__(self):		
@@ -116,6 +908,7 @@ class ClientCmd:
 		self.cmd = None
 		self.with_encryption = False
 		self.with_compression = False
+		self.wire_format = WireFormat.JSON
 
 	@abc.abstractmethod
 	def to_json(self):
@@ -125,7 +918,21 @@ class ClientCmd:
 	def from_json(self):
 		pass
 	
-	def to_msg(self):
+	def to_binary(self, channel = None):
+		frame = self.cmd.to_frame()
+		if channel is not None:
+			frame.seq, frame.ack = channel.seq.next()
+		encode_payload(frame, channel)
+		return frame.to_bytes()
+
+	def to_msg(self, channel = None):
+		if channel is not None:
+			self.with_encryption = channel.with_encryption
+		if self.wire_format == WireFormat.BINARY:
+			return self.to_binary(channel)
+		if self.uuid is None and channel is not None:
+			#only registration messages have a real uuid, old peers don't look at it
+			self.uuid, _ = channel.seq.next(track = False)
 		data = self.cmd.to_json()
 		if self.with_compression:
 			cdata = zlib.compress(data.encode(), 9)
@@ -133,20 +940,67 @@ class ClientCmd:
 			cdata = data.encode()
 
 		if self.with_encryption:
-			encrypter = Encrypter(AESModeOfOperationCFB(key, iv)) #ovbiously change this
-			edata = encrypter.feed(cdata)
-			edata +=  encrypter.feed()
+			edata = channel.encrypt_legacy(cdata)
 			return json.dumps({'uuid': self.uuid, 'data': edata.hex()})
 		else:
 			return json.dumps({'uuid': self.uuid, 'data': cdata.hex()})
 
 	@staticmethod
-	def from_msg(msg, with_encryption = False, with_compression = False):
+	def batch_to_msg(cmds, channel = None):
+		"""
+		Binary format only, packs the commands into one websocket message
+		"""
+		if len(cmds) == 1:
+			msg = ClientCmd()
+			msg.cmd = cmds[0]
+			msg.wire_format = WireFormat.BINARY
+			return msg.to_msg(channel)
+		return pack_batch([cmd.to_frame() for cmd in cmds], MSG_BATCH, channel)
+
+	@staticmethod
+	def from_frame(frame):
+		if frame.msg_type & MSG_REPLY or frame.msg_type not in int2cmd:
+			raise Exception('Unknown/malformed command!')
+		cc = ClientCmd()
+		cc.wire_format = WireFormat.BINARY
+		cc.cmd = int2cmd[frame.msg_type].from_frame(frame)
+		return cc
+
+	@staticmethod
+	def from_batch(msg, with_encryption = False, with_compression = False, channel = None):
+		"""
+		Returns a list of ClientCmd, msg can be a batch or a single message
+		"""
+		if not isinstance(msg, (bytes, bytearray)):
+			return [ClientCmd.from_msg(msg, with_encryption, with_compression, channel)]
+		frame = Frame.from_bytes(msg)
+		if frame.msg_type != MSG_BATCH:
+			return [ClientCmd.from_binary(msg, channel)]
+		decode_payload(frame, channel)
+		if channel is not None:
+			channel.seq.received(frame.seq, frame.ack)
+		return [ClientCmd.from_frame(x) for x in unpack_batch(frame, channel)]
+
+	@staticmethod
+	def from_binary(msg, channel = None):
+		frame = Frame.from_bytes(msg)
+		if frame.msg_type & MSG_REPLY or frame.msg_type not in int2cmd:
+			raise Exception('Unknown/malformed command!')
+		decode_payload(frame, channel)
+		if channel is not None:
+			channel.seq.received(frame.seq, frame.ack)
+		cc = ClientCmd()
+		cc.wire_format = WireFormat.BINARY
+		cc.cmd = int2cmd[frame.msg_type].from_frame(frame)
+		return cc
+
+	@staticmethod
+	def from_msg(msg, with_encryption = False, with_compression = False, channel = None):
+		if isinstance(msg, (bytes, bytearray)):
+			return ClientCmd.from_binary(msg, channel)
 		temp = json.loads(msg)
 		if with_encryption:
-			a = Decrypter(AESModeOfOperationCFB(key, iv)) #ovbiously change this
-			ddata = a.feed(bytes.fromhex(temp['data']))
-			ddata += a.feed()
+			ddata = channel.decrypt_legacy(bytes.fromhex(temp['data']))
 
 		else:
 			ddata = bytes.fromhex(temp['data'])
@@ -182,6 +1036,16 @@ class OKCmd:
 	def from_json(data):
 		cmd = OKCmd()
 		return cmd
+
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = OKCmd()
+		return cmd
 	
 class ErrorCmd:
 	def __init__(self):
@@ -203,15 +1067,67 @@ class ErrorCmd:
 		cmd.error_data = data['error_data']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		frame.payload = str(self.error_data).encode()
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = ErrorCmd()
+		cmd.error_data = frame.payload.decode()
+		return cmd
+
+def get_capabilities():
+	"""
+	Everything this side supports, each list in order of preference
+	"""
+	t = {}
+	t['wire_formats'] = ['binary', 'json']
+	t['wire_versions'] = [WIRE_VERSION]
+	t['cipher_suites'] = CIPHER_SUITES
+	t['compression'] = ['deflate-stream']
+	t['batching'] = ['batch']
+	t['flow_control'] = ['window']
+	t['striping'] = ['stripes']
+	t['session_open'] = ['open']
+	return t
+
+def pick_mutual(offered, supported):
+	"""
+	The first offered option we also support, None if there is none
+	"""
+	for option in offered:
+		if option in supported:
+			return option
+	return None
+
 class RegisterCmd:
+	"""
+	Always sent as JSON so agents of any version can read it.
+	capabilities holds what the server is willing to use, with_encryption and compression_level what it asks for.
+	"""
 	def __init__(self):
 		self.cmd_id = 3
 		self.client_uuid = None
+		self.protocol_version = PROTOCOL_VERSION
+		self.capabilities = get_capabilities()
+		self.with_encryption = False
+		self.compression_level = None
+		self.auto_level = True #False keeps the compression level fixed at compression_level
+		self.initial_window = None #per session flow control window in bytes, None turns it off
 
 	def to_dict(self):
 		t = {}
 		t['cmd_id'] = self.cmd_id
 		t['client_uuid'] = self.client_uuid
+		t['protocol_version'] = self.protocol_version
+		t['capabilities'] = self.capabilities
+		t['with_encryption'] = self.with_encryption
+		t['compression_level'] = self.compression_level
+		t['auto_level'] = self.auto_level
+		t['initial_window'] = self.initial_window
 		return t
 
 	def to_json(self):
@@ -221,8 +1137,44 @@ class RegisterCmd:
 	def from_json(data):
 		cmd = RegisterCmd()
 		cmd.client_uuid = data['client_uuid']
+		cmd.protocol_version = data.get('protocol_version', 1)
+		cmd.capabilities = data.get('capabilities', {})
+		cmd.with_encryption = data.get('with_encryption', False)
+		cmd.compression_level = data.get('compression_level')
+		cmd.auto_level = data.get('auto_level', True)
+		cmd.initial_window = data.get('initial_window')
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		frame.payload = self.to_json().encode()
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		return RegisterCmd.from_json(json.loads(frame.payload))
+
+	def check_options(self, rply):
+		"""
+		Makes sure the agent only picked options that were offered
+		"""
+		offered = self.capabilities
+		if rply.wire_format == 'binary' and (rply.wire_format not in offered['wire_formats'] or rply.wire_version not in offered['wire_versions']):
+			raise Exception('Agent picked a wire format that was not offered! %s %s' % (rply.wire_format, rply.wire_version))
+		if rply.with_encryption and rply.wire_format == 'binary' and rply.cipher_suite not in offered['cipher_suites']:
+			raise Exception('Agent picked a cipher suite that was not offered! %s' % rply.cipher_suite)
+		if rply.compression_level is not None and self.compression_level is None:
+			raise Exception('Agent wants compression that was not asked for!')
+		if rply.batching and 'batch' not in offered['batching']:
+			raise Exception('Agent wants batching that was not offered!')
+		if rply.initial_window is not None and rply.initial_window != self.initial_window:
+			raise Exception('Agent wants a different flow control window! %s' % rply.initial_window)
+		if (rply.striping or rply.join is not None) and 'stripes' not in offered.get('striping', []):
+			raise Exception('Agent wants striping that was not offered!')
+		if rply.session_open and 'open' not in offered.get('session_open', []):
+			raise Exception('Agent wants session open messages that were not offered!')
+
 class CreateJobCmd:
 	def __init__(self):
 		self.cmd_id = 4
@@ -246,6 +1198,18 @@ class CreateJobCmd:
 		cmd.client_uuid = data['client_uuid']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		frame.payload = self.job_name.encode()
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = CreateJobCmd()
+		cmd.job_name = frame.payload.decode()
+		return cmd
+
 class StopJobCmd:
 	def __init__(self):
 		self.cmd_id = 5
@@ -269,19 +1233,34 @@ class StopJobCmd:
 		cmd.client_uuid = data['client_uuid']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		frame.job_id = self.job_id
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = StopJobCmd()
+		cmd.job_id = frame.job_id
+		return cmd
+
 class JobCmd:
 	def __init__(self):
 		self.cmd_id = 6
 		self.client_uuid = None
 		self.job_id = None
-		self.job_data = None #must be string!
+		self.job_data = None #str, bytes or SessionPacket
 
 	def to_dict(self):
 		t = {}
 		t['cmd_id'] = self.cmd_id
 		t['client_uuid'] = self.client_uuid
 		t['job_id'] = self.job_id
-		t['job_data'] = self.job_data
+		if isinstance(self.job_data, SessionPacket):
+			t['job_data'] = self.job_data.to_json()
+		else:
+			t['job_data'] = self.job_data
 		return t
 
 	def to_json(self):
@@ -295,6 +1274,20 @@ class JobCmd:
 		cmd.client_uuid = data['client_uuid']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		frame.job_id = self.job_id
+		pack_job_data(frame, self.job_data)
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = JobCmd()
+		cmd.job_id = frame.job_id
+		cmd.job_data = unpack_job_data(frame)
+		return cmd
+
 
 class ClientRply:
 	def __init__(self):
@@ -302,6 +1295,7 @@ class ClientRply:
 		self.rply = None
 		self.with_encryption = False
 		self.with_compression = False
+		self.wire_format = WireFormat.JSON
 	
 	@abc.abstractmethod
 	def to_json(self):
@@ -311,27 +1305,90 @@ class ClientRply:
 	def from_json(self):
 		pass
 
-	def to_msg(self):
+	def to_binary(self, channel = None):
+		frame = self.rply.to_frame()
+		if channel is not None:
+			frame.seq, frame.ack = channel.seq.next()
+		encode_payload(frame, channel)
+		return frame.to_bytes()
+
+	def to_msg(self, channel = None):
+		if channel is not None:
+			self.with_encryption = channel.with_encryption
+		if self.wire_format == WireFormat.BINARY:
+			return self.to_binary(channel)
+		if self.uuid is None and channel is not None:
+			#only registration messages have a real uuid, old peers don't look at it
+			self.uuid, _ = channel.seq.next(track = False)
 		data = self.rply.to_json()
 		if self.with_compression:
 			cdata = zlib.compress(data.encode(), 9)
 		else:
 			cdata = data.encode()
 		if self.with_encryption:
-			encrypter = Encrypter(AESModeOfOperationCFB(b'AAAAAAAAAAAAAAAA', iv = b'\x11'*16)) #ovbiously change this
-			edata = encrypter.feed(cdata)
-			edata +=  encrypter.feed()
+			edata = channel.encrypt_legacy(cdata)
 			return json.dumps({'uuid': self.uuid, 'data': edata.hex()})
 		else:
 			return json.dumps({'uuid': self.uuid, 'data': cdata.hex()})
 		
 	@staticmethod
-	def from_msg(msg, with_encryption = False, with_compression = False):
+	def batch_to_msg(rplys, channel = None):
+		"""
+		Binary format only, packs the replies into one websocket message
+		"""
+		if len(rplys) == 1:
+			msg = ClientRply()
+			msg.rply = rplys[0]
+			msg.wire_format = WireFormat.BINARY
+			return msg.to_msg(channel)
+		return pack_batch([rply.to_frame() for rply in rplys], MSG_REPLY | MSG_BATCH, channel)
+
+	@staticmethod
+	def from_frame(frame):
+		rply_id = frame.msg_type & ~MSG_REPLY
+		if not frame.msg_type & MSG_REPLY or rply_id not in int2rply:
+			raise Exception('Unknown/malformed reply!')
+		cr = ClientRply()
+		cr.wire_format = WireFormat.BINARY
+		cr.rply = int2rply[rply_id].from_frame(frame)
+		return cr
+
+	@staticmethod
+	def from_batch(msg, with_encryption = False, with_compression = False, channel = None):
+		"""
+		Returns a list of ClientRply, msg can be a batch or a single message
+		"""
+		if not isinstance(msg, (bytes, bytearray)):
+			return [ClientRply.from_msg(msg, with_encryption, with_compression, channel)]
+		frame = Frame.from_bytes(msg)
+		if frame.msg_type != MSG_REPLY | MSG_BATCH:
+			return [ClientRply.from_binary(msg, channel)]
+		decode_payload(frame, channel)
+		if channel is not None:
+			channel.seq.received(frame.seq, frame.ack)
+		return [ClientRply.from_frame(x) for x in unpack_batch(frame, channel)]
+
+	@staticmethod
+	def from_binary(msg, channel = None):
+		frame = Frame.from_bytes(msg)
+		rply_id = frame.msg_type & ~MSG_REPLY
+		if not frame.msg_type & MSG_REPLY or rply_id not in int2rply:
+			raise Exception('Unknown/malformed reply!')
+		decode_payload(frame, channel)
+		if channel is not None:
+			channel.seq.received(frame.seq, frame.ack)
+		cr = ClientRply()
+		cr.wire_format = WireFormat.BINARY
+		cr.rply = int2rply[rply_id].from_frame(frame)
+		return cr
+
+	@staticmethod
+	def from_msg(msg, with_encryption = False, with_compression = False, channel = None):
+		if isinstance(msg, (bytes, bytearray)):
+			return ClientRply.from_binary(msg, channel)
 		temp = json.loads(msg)
 		if with_encryption:
-			decrypter = Decrypter(AESModeOfOperationCFB(b'AAAAAAAAAAAAAAAA', iv = b'\x11'*16)) #ovbiously change this
-			ddata = decrypter.feed(bytes.fromhex(temp['data']))
-			ddata += decrypter.feed()
+			ddata = channel.decrypt_legacy(bytes.fromhex(temp['data']))
 		else:
 			ddata = bytes.fromhex(temp['data'])
 		if with_compression:
@@ -348,14 +1405,44 @@ class ClientRply:
 			raise Exception('Unknown/malformed command!')
 
 class RegisterRply:
+	"""
+	The options the agent picked, they apply to the rest of the connection.
+	Agents speaking protocol version 1 only send the client_uuid, the defaults match what they can do.
+	"""
 	def __init__(self):
 		self.rply_id = 3
 		self.client_uuid = None
+		self.protocol_version = PROTOCOL_VERSION
+		self.capabilities = get_capabilities()
+		self.wire_format = 'json'
+		self.wire_version = None
+		self.with_encryption = False
+		self.cipher_suite = 'aes-cfb'
+		self.compression_level = None #set if the agent will do stream compression
+		self.auto_level = True #the agent moves the compression level like the server does
+		self.batching = False
+		self.initial_window = None #set if the agent does flow control
+		self.striping = False #set if the agent may open more websockets (stripes) later
+		self.join = None #client_uuid of the first websocket if this one is an additional stripe of it
+		self.session_open = False #set if the agent opens sessions on an OPEN control message, the server does the module handshake itself
 
 	def to_dict(self):
 		t={}
 		t['rply_id'] = self.rply_id
 		t['client_uuid'] = self.client_uuid
+		t['protocol_version'] = self.protocol_version
+		t['capabilities'] = self.capabilities
+		t['wire_format'] = self.wire_format
+		t['wire_version'] = self.wire_version
+		t['with_encryption'] = self.with_encryption
+		t['cipher_suite'] = self.cipher_suite
+		t['compression_level'] = self.compression_level
+		t['auto_level'] = self.auto_level
+		t['batching'] = self.batching
+		t['initial_window'] = self.initial_window
+		t['striping'] = self.striping
+		t['join'] = self.join
+		t['session_open'] = self.session_open
 		return t
 
 	def to_json(self):
@@ -365,8 +1452,68 @@ class RegisterRply:
 	def from_json(data):
 		cmd = RegisterRply()
 		cmd.client_uuid = data['client_uuid']
+		cmd.protocol_version = data.get('protocol_version', 1)
+		cmd.capabilities = data.get('capabilities', {})
+		cmd.wire_format = data.get('wire_format', 'json')
+		cmd.wire_version = data.get('wire_version')
+		cmd.with_encryption = data.get('with_encryption', False)
+		cmd.cipher_suite = data.get('cipher_suite', 'aes-cfb')
+		cmd.compression_level = data.get('compression_level')
+		cmd.auto_level = data.get('auto_level', True)
+		cmd.batching = data.get('batching', False)
+		cmd.initial_window = data.get('initial_window')
+		cmd.striping = data.get('striping', False)
+		cmd.join = data.get('join')
+		cmd.session_open = data.get('session_open', False)
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		frame.payload = self.to_json().encode()
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		return RegisterRply.from_json(json.loads(frame.payload))
+
+	@staticmethod
+	def negotiate(cmd, join = None):
+		"""
+		Picks the best mutual option set from the RegisterCmd, the server's order of preference wins.
+		join is the client_uuid of the agent's first websocket when registering an additional stripe.
+		"""
+		supported = get_capabilities()
+		offered = cmd.capabilities
+		rply = RegisterRply()
+		rply.client_uuid = cmd.client_uuid
+		rply.with_encryption = cmd.with_encryption
+		if cmd.protocol_version < 2:
+			#old server, nothing to negotiate
+			return rply
+
+		if cmd.initial_window is not None and pick_mutual(offered.get('flow_control', []), supported['flow_control']) is not None:
+			rply.initial_window = cmd.initial_window
+
+		rply.striping = pick_mutual(offered.get('striping', []), supported['striping']) is not None
+		if rply.striping:
+			rply.join = join
+		elif join is not None:
+			raise Exception('Server does not support striping!')
+		rply.session_open = pick_mutual(offered.get('session_open', []), supported['session_open']) is not None
+
+		wire_format = pick_mutual(offered.get('wire_formats', ['json']), supported['wire_formats'])
+		wire_version = pick_mutual(offered.get('wire_versions', []), supported['wire_versions'])
+		if wire_format == 'binary' and wire_version is not None:
+			rply.wire_format = wire_format
+			rply.wire_version = wire_version
+			rply.cipher_suite = select_cipher_suite(offered.get('cipher_suites', ['aes-cfb']))
+			if cmd.compression_level is not None and pick_mutual(offered.get('compression', []), supported['compression']) is not None:
+				rply.compression_level = cmd.compression_level
+				rply.auto_level = cmd.auto_level
+			rply.batching = pick_mutual(offered.get('batching', []), supported['batching']) is not None
+		return rply
+
 class OKRply:
 	def __init__(self):
 		self.rply_id = 0
@@ -384,6 +1531,16 @@ class OKRply:
 		cmd = OKRply()
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = OKRply()
+		return cmd
+
 class ErrorRply:
 	def __init__(self):
 		self.rply_id = 1
@@ -404,6 +1561,18 @@ class ErrorRply:
 		cmd.error_data = data['error_data']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		frame.payload = str(self.error_data).encode()
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = ErrorRply()
+		cmd.error_data = frame.payload.decode()
+		return cmd
+
 class CreateJobRply:
 	def __init__(self):
 		self.rply_id = 4
@@ -427,6 +1596,20 @@ class CreateJobRply:
 		cmd.job_id = data['job_id']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		frame.job_id = self.job_id
+		frame.payload = self.job_name.encode()
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = CreateJobRply()
+		cmd.job_name = frame.payload.decode()
+		cmd.job_id = frame.job_id
+		return cmd
+
 class StopJobRply:
 	def __init__(self):
 		self.rply_id = 5
@@ -447,17 +1630,32 @@ class StopJobRply:
 		cmd.job_id = data['rply_id']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		frame.job_id = self.job_id
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = StopJobRply()
+		cmd.job_id = frame.job_id
+		return cmd
+
 class JobRply:
 	def __init__(self):
 		self.rply_id = 6
 		self.job_id = None
-		self.job_data = None #must be string!
+		self.job_data = None #str, bytes or SessionPacket
 
 	def to_dict(self):
 		t = {}
 		t['rply_id'] = self.rply_id
 		t['job_id'] = self.job_id
-		t['job_data'] = self.job_data
+		if isinstance(self.job_data, SessionPacket):
+			t['job_data'] = self.job_data.to_json()
+		else:
+			t['job_data'] = self.job_data
 		return t
 
 	def to_json(self):
@@ -470,13 +1668,98 @@ class JobRply:
 		cmd.job_data = data['job_data']
 		return cmd
 
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		frame.job_id = self.job_id
+		pack_job_data(frame, self.job_data)
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		cmd = JobRply()
+		cmd.job_id = frame.job_id
+		cmd.job_data = unpack_job_data(frame)
+		return cmd
+
+class StripeOp(enum.IntEnum):
+	DRAIN = 1 #agent: no new sessions on this websocket, it will be closed
+	DRAINED = 2 #server: nothing more will be sent on this websocket
+
+class StripeCmd:
+	"""
+	Sent by the server on the websocket (stripe) it is about
+	"""
+	def __init__(self, op = StripeOp.DRAINED):
+		self.cmd_id = 7
+		self.client_uuid = None
+		self.op = op
+
+	def to_dict(self):
+		t = {}
+		t['cmd_id'] = self.cmd_id
+		t['client_uuid'] = self.client_uuid
+		t['op'] = int(self.op)
+		return t
+
+	def to_json(self):
+		return json.dumps(self.to_dict())
+
+	@staticmethod
+	def from_json(data):
+		cmd = StripeCmd(StripeOp(data['op']))
+		cmd.client_uuid = data['client_uuid']
+		return cmd
+
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = self.cmd_id
+		frame.payload = bytes((self.op,))
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		return StripeCmd(StripeOp(frame.payload[0]))
+
+class StripeRply:
+	"""
+	Sent by the agent on the websocket (stripe) it is about
+	"""
+	def __init__(self, op = StripeOp.DRAIN):
+		self.rply_id = 7
+		self.op = op
+
+	def to_dict(self):
+		t = {}
+		t['rply_id'] = self.rply_id
+		t['op'] = int(self.op)
+		return t
+
+	def to_json(self):
+		return json.dumps(self.to_dict())
+
+	@staticmethod
+	def from_json(data):
+		return StripeRply(StripeOp(data['op']))
+
+	def to_frame(self):
+		frame = Frame()
+		frame.msg_type = MSG_REPLY | self.rply_id
+		frame.payload = bytes((self.op,))
+		return frame
+
+	@staticmethod
+	def from_frame(frame):
+		return StripeRply(StripeOp(frame.payload[0]))
+
 int2cmd = {
 	0 : OKCmd,
 	1 : ErrorCmd,
 	3 : RegisterCmd,
 	4 : CreateJobCmd,
 	5 : StopJobCmd,
-	6 : JobCmd
+	6 : JobCmd,
+	7 : StripeCmd,
 }
 
 int2rply = {
@@ -485,5 +1768,6 @@ int2rply = {
 	3 : RegisterRply,
 	4 : CreateJobRply,
 	5 : StopJobRply,
-	6 : JobRply
+	6 : JobRply,
+	7 : StripeRply,
 }
\ No newline at end of file
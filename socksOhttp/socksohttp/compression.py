@@ -0,0 +1,130 @@
+import zlib
+import math
+import time
+from collections import Counter
+
+# raw deflate, no zlib header. This lets us swap the compressor for one with a different level
+# in the middle of the stream without the other side noticing.
+WBITS = -15
+
+class StreamCompressor:
+	"""
+	One deflate stream per websocket, every frame is flushed with Z_SYNC_FLUSH so the other side
+	can decompress it right away while both sides keep the history of the previous frames.
+	If auto_level is set the level is moved up or down after every window of frames, depending on
+	how much CPU time it took to save a megabyte compared to max_cpu_per_saved_mb (seconds).
+	"""
+	def __init__(self, level = 6, auto_level = True, max_cpu_per_saved_mb = 0.05, min_level = 1, max_level = 9, window = 64):
+		self.level = level
+		self.auto_level = auto_level
+		self.max_cpu_per_saved_mb = max_cpu_per_saved_mb
+		self.min_level = min_level
+		self.max_level = max_level
+		self.window = window
+		self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS)
+
+		self.frames = 0
+		self.cpu_time = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+
+	def compress(self, data):
+		start = time.process_time()
+		cdata = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		self.cpu_time += time.process_time() - start
+		self.bytes_in += len(data)
+		self.bytes_out += len(cdata)
+		self.frames += 1
+		if self.auto_level and self.frames >= self.window:
+			self.adjust_level()
+		return cdata
+
+	def adjust_level(self):
+		saved = self.bytes_in - self.bytes_out
+		if saved <= 0:
+			cost = float('inf')
+		else:
+			cost = self.cpu_time / (saved / (1024*1024))
+
+		if cost > self.max_cpu_per_saved_mb * 1.5 and self.level > self.min_level:
+			self.set_level(self.level - 1)
+		elif cost < self.max_cpu_per_saved_mb / 2 and self.level < self.max_level:
+			self.set_level(self.level + 1)
+
+		self.frames = 0
+		self.cpu_time = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+
+	def set_level(self, level):
+		"""
+		The last frame was sync flushed so the new compressor can just continue the stream.
+		Only the history is lost, the decompressor does not need to know about it.
+		"""
+		self.level = level
+		self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS)
+
+class StreamDecompressor:
+	def __init__(self):
+		self.decompressor = zlib.decompressobj(WBITS)
+
+	def decompress(self, data):
+		return self.decompressor.decompress(data)
+
+def sample_entropy(data, sample_size = 1024, slices = 4):
+	"""
+	Estimates the Shannon entropy (bits per byte) of data from a few slices spread over the buffer.
+	Encrypted or already compressed data is close to 8, text and protocol headers are well below.
+	"""
+	if len(data) <= sample_size:
+		sample = bytes(data)
+	else:
+		step = len(data) // slices
+		size = sample_size // slices
+		sample = b''.join(data[i*step:i*step+size] for i in range(slices))
+	if len(sample) == 0:
+		return 0.0
+	total = len(sample)
+	return -sum((c/total) * math.log2(c/total) for c in Counter(sample).values())
+
+class CompressionVerdict:
+	"""
+	Remembers per session whether compressing its data is worth it.
+	Frames that look random (see sample_entropy) or did not shrink count as misses, after max_misses
+	of them in a row the session is marked incompressible and its frames are sent as they are.
+	Every recheck frames one is compressed again in case the traffic changed.
+	"""
+	def __init__(self, max_misses = 4, recheck = 256, min_size = 256, max_entropy = 7.2, min_saving = 0.03):
+		self.max_misses = max_misses
+		self.recheck = recheck
+		self.min_size = min_size
+		self.max_entropy = max_entropy
+		self.min_saving = min_saving
+
+		self.incompressible = False
+		self.misses = 0
+		self.skipped = 0
+
+	def should_compress(self, data):
+		if self.incompressible:
+			self.skipped += 1
+			if self.skipped < self.recheck:
+				return False
+			self.skipped = 0
+			return True
+		if len(data) >= self.min_size and sample_entropy(data) > self.max_entropy:
+			self.miss()
+			return False
+		return True
+
+	def update(self, size, compressed_size):
+		if compressed_size > size * (1 - self.min_saving):
+			self.miss()
+		else:
+			self.misses = 0
+			self.incompressible = False
+
+	def miss(self):
+		self.misses += 1
+		if self.misses >= self.max_misses:
+			self.incompressible = True
@@ -0,0 +1,201 @@
+import hmac
+import struct
+import hashlib
+
+from .AES import AESModeOfOperationCFB, AESModeOfOperationBatchCTR
+
+# optional C implementations of AES, the first one found is used
+try:
+	from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+	from cryptography.hazmat.backends import default_backend
+	try:
+		from cryptography.hazmat.decrepit.ciphers.modes import CFB8
+	except ImportError:
+		CFB8 = modes.CFB8
+	native_aes = 'cryptography'
+except ImportError:
+	try:
+		from Crypto.Cipher import AES as CryptoAES
+		native_aes = 'pycryptodome'
+	except ImportError:
+		native_aes = None
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+def xor_bytes(data, keystream):
+	"""
+	XORs two buffers of the same length in one go
+	"""
+	if numpy is not None:
+		a = numpy.frombuffer(data, dtype = numpy.uint8)
+		b = numpy.frombuffer(keystream, dtype = numpy.uint8)
+		return numpy.bitwise_xor(a, b).tobytes()
+	x = int.from_bytes(data, byteorder = 'big') ^ int.from_bytes(keystream, byteorder = 'big')
+	return x.to_bytes(len(data), byteorder = 'big')
+
+
+class CipherSuite:
+	"""
+	Base class of the frame ciphers.
+	seal/open process one whole frame payload, the iv must be unique for every frame.
+	aad is authenticated (by suites that have a tag) but not encrypted.
+	nonce is the client uuid of the connection, suites that can use it derive their keys from it.
+	"""
+	name = None
+	tag_size = 0
+	accelerated = False
+
+	def __init__(self, key, nonce = None):
+		self.key = key
+
+	@staticmethod
+	def connection_key(key, nonce, person):
+		"""
+		Key of a single connection, the key is shared by every agent
+		"""
+		if nonce is None:
+			return key
+		return hashlib.blake2b(key, digest_size = len(key), salt = nonce, person = person).digest()
+
+	def get_iv(self, direction, nonce, ctr):
+		return struct.pack('!B7sQ', direction, nonce[:7], ctr)
+
+	def seal(self, iv, data, aad = b''):
+		raise Exception('not implemented')
+
+	def open(self, iv, data, aad = b''):
+		raise Exception('not implemented')
+
+
+class AESCFBSuite(CipherSuite):
+	"""
+	AES-CFB8, the original cipher of the JSON format. Kept for old peers.
+	"""
+	name = 'aes-cfb'
+	accelerated = native_aes is not None
+
+	def __init__(self, key, nonce = None):
+		#old peers only know the shared key
+		CipherSuite.__init__(self, key)
+		if native_aes is None:
+			self.cipher = AESModeOfOperationCFB(key, b'\x00' * 16)
+
+	def seal(self, iv, data, aad = b''):
+		if native_aes == 'cryptography':
+			encryptor = Cipher(algorithms.AES(self.key), CFB8(iv), backend = default_backend()).encryptor()
+			return encryptor.update(data) + encryptor.finalize()
+		if native_aes == 'pycryptodome':
+			return CryptoAES.new(self.key, CryptoAES.MODE_CFB, iv = iv, segment_size = 8).encrypt(data)
+		self.cipher.reset(iv)
+		return self.cipher.encrypt(data)
+
+	def open(self, iv, data, aad = b''):
+		if native_aes == 'cryptography':
+			decryptor = Cipher(algorithms.AES(self.key), CFB8(iv), backend = default_backend()).decryptor()
+			return decryptor.update(data) + decryptor.finalize()
+		if native_aes == 'pycryptodome':
+			return CryptoAES.new(self.key, CryptoAES.MODE_CFB, iv = iv, segment_size = 8).decrypt(data)
+		self.cipher.reset(iv)
+		return self.cipher.decrypt(data)
+
+
+class AESCTRSuite(CipherSuite):
+	"""
+	AES-CTR. Uses the C implementation if one is installed, the batched pure python one otherwise.
+	Both produce the same stream so peers with different backends can talk to each other.
+	"""
+	name = 'aes-ctr'
+	accelerated = native_aes is not None
+
+	def __init__(self, key, nonce = None):
+		#the iv only has room for 5 bytes of the client uuid, the rest of it goes in the key
+		CipherSuite.__init__(self, CipherSuite.connection_key(key, nonce, b'socksohttp-ctr'))
+		if native_aes is None:
+			self.cipher = AESModeOfOperationBatchCTR(self.key)
+
+	def get_iv(self, direction, nonce, ctr):
+		#the last 4 bytes are the block counter inside the frame, they must not overlap with the next frame
+		return struct.pack('!B5sHII', direction, nonce[:5], ctr >> 32, ctr & 0xFFFFFFFF, 0)
+
+	def seal(self, iv, data, aad = b''):
+		if native_aes == 'cryptography':
+			encryptor = Cipher(algorithms.AES(self.key), modes.CTR(iv), backend = default_backend()).encryptor()
+			return encryptor.update(data) + encryptor.finalize()
+		if native_aes == 'pycryptodome':
+			return CryptoAES.new(self.key, CryptoAES.MODE_CTR, nonce = b'', initial_value = iv).encrypt(data)
+		self.cipher.reset(iv)
+		return self.cipher.encrypt(data)
+
+	def open(self, iv, data, aad = b''):
+		#CTR is symmetric
+		return self.seal(iv, data, aad)
+
+
+class SHAKEHMACSuite(CipherSuite):
+	"""
+	Stdlib only suite, always available and runs at C speed.
+	Keystream is SHAKE-256 over (key, iv), the tag is HMAC-SHA256 over (aad, iv, ciphertext) truncated to 16 bytes.
+	"""
+	name = 'shake256-hmac'
+	tag_size = 16
+	accelerated = True
+
+	def __init__(self, key, nonce = None):
+		CipherSuite.__init__(self, key)
+		self.enc_key = hashlib.blake2b(key, digest_size = 32, salt = nonce or b'', person = b'socksohttp-enc').digest()
+		self.mac_key = hashlib.blake2b(key, digest_size = 32, salt = nonce or b'', person = b'socksohttp-mac').digest()
+
+	def keystream(self, iv, length):
+		return hashlib.shake_256(self.enc_key + iv).digest(length)
+
+	def tag(self, iv, data, aad):
+		return hmac.new(self.mac_key, aad + iv + data, hashlib.sha256).digest()[:self.tag_size]
+
+	def seal(self, iv, data, aad = b''):
+		if len(data) == 0:
+			edata = b''
+		else:
+			edata = xor_bytes(data, self.keystream(iv, len(data)))
+		return edata + self.tag(iv, edata, aad)
+
+	def open(self, iv, data, aad = b''):
+		if len(data) < self.tag_size:
+			raise Exception('Encrypted payload too short!')
+		edata = data[:-self.tag_size]
+		if not hmac.compare_digest(data[-self.tag_size:], self.tag(iv, edata, aad)):
+			raise Exception('Frame authentication failed!')
+		if len(edata) == 0:
+			return b''
+		return xor_bytes(edata, self.keystream(iv, len(edata)))
+
+
+name2suite = {
+	AESCTRSuite.name : AESCTRSuite,
+	AESCFBSuite.name : AESCFBSuite,
+	SHAKEHMACSuite.name : SHAKEHMACSuite,
+}
+
+# in order of preference, the suites that run at C speed here come first
+CIPHER_SUITES = [x.name for x in sorted([AESCTRSuite, SHAKEHMACSuite, AESCFBSuite], key = lambda x: not x.accelerated)]
+
+def select_cipher_suite(offered):
+	"""
+	Picks a suite from the offer, which is in the server's order of preference.
+	The first offered suite that is fast on our side wins, if there is none then the first one we support.
+	"""
+	supported = [x for x in offered if x in name2suite]
+	if len(supported) == 0:
+		raise Exception('No common cipher suite! Offered: %s' % ','.join(offered))
+	for name in supported:
+		if name2suite[name].accelerated:
+			return name
+	return supported[0]
+
+def get_cipher_suite(name, key, nonce = None):
+	if name not in name2suite:
+		raise Exception('Unknown cipher suite %s' % name)
+	return name2suite[name](key, nonce)
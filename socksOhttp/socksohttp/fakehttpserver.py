@@ -15,6 +15,8 @@ function connect(){
 	const agent_url = document.getElementById('agent_url').value;
 	const ws_server = new WebSocket(server_url);
 	const ws_agent = new WebSocket(agent_url);
+	ws_server.binaryType = 'arraybuffer';
+	ws_agent.binaryType = 'arraybuffer';
 	
 	ws_server.onopen = function(event) {
 		var label = document.getElementById('serverstatus');
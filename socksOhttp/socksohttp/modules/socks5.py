@@ -5,15 +5,22 @@
 
 import io
 import enum
+import errno
 import ipaddress
 import socket
+import struct
 import asyncio
-import uuid
 
 from ..comms import *
-from ..tcp_proxy import *
+from ..relay import *
+from ..buffers import ReadSizer, READ_SIZE_MAX
 
 module_name = 'socks5'
+SESSION_BUFFER_MAX = 1024*1024 #bytes buffered towards the local socket of one session before the websocket reader waits for it
+EARLY_DATA_MAX = 16*1024 #first bytes of a client sent along with the OPEN message, a TLS ClientHello fits
+EARLY_DATA_WAIT = 0.05 #seconds to wait for them, protocols where the destination speaks first pay this once per connection
+CONNECT_TIMEOUT = 1 #seconds the agent waits for one address of the destination to accept the connection
+OPEN_TIMEOUT = 30 #seconds the server waits for the agent's answer to an OPEN message
 
 async def readexactly_or_exc(reader, n, timeout = None):
 	"""
@@ -60,6 +67,72 @@ async def read_or_exc(reader, n, timeout = None):
 
 	return data
 
+async def read_message(reader, msg_type, timeout = None):
+	"""
+	Reads one message with msg_type.parse, only the bytes the parser still needs are read so nothing
+	after the message is taken from the reader. Usually two reads, with a single timeout for the whole message.
+	:param msg_type: The message class, eg. SOCKS5Request
+	:return: the message object
+	"""
+	async def read():
+		data = b''
+		while True:
+			msg, length = msg_type.parse(data)
+			if msg is not None:
+				return msg
+			try:
+				data += await reader.readexactly(length - len(data))
+			except asyncio.IncompleteReadError:
+				raise Exception('Connection closed!')
+
+	if timeout is None:
+		return await read()
+	return await asyncio.wait_for(read(), timeout = timeout)
+
+def parse_buffer(buff, msg_type):
+	"""
+	from_buffer of the messages: parses from the current position of a seekable buffer (eg. io.BytesIO)
+	in one pass and moves the position past the message.
+	"""
+	pos = buff.tell()
+	if isinstance(buff, io.BytesIO):
+		with buff.getbuffer() as view:
+			msg, length = msg_type.parse(view[pos:])
+	else:
+		msg, length = msg_type.parse(buff.read())
+	if msg is None:
+		raise Exception('Incomplete %s message!' % msg_type.__name__)
+	buff.seek(pos + length)
+	return msg
+
+def parse_address(data, pos):
+	"""
+	Parses the ATYP, address, port part of requests and replies that starts at pos.
+	The parse methods of the messages take bytes or a memoryview and return (message, length),
+	or (None, n) when the data is incomplete and at least n bytes are needed.
+	:return: (ATYP, address, port, end of the port) or (None, None, None, bytes needed)
+	"""
+	if len(data) < pos + 2:
+		return None, None, None, pos + 2
+	atyp = SOCKS5AddressType(data[pos])
+	if atyp == SOCKS5AddressType.IP_V4:
+		start, end = pos + 1, pos + 5
+	elif atyp == SOCKS5AddressType.IP_V6:
+		start, end = pos + 1, pos + 17
+	else:
+		start = pos + 2
+		end = start + data[pos + 1]
+	if len(data) < end + 2:
+		return None, None, None, end + 2
+	if atyp == SOCKS5AddressType.IP_V4:
+		address = ipaddress.IPv4Address(bytes(data[start:end]))
+	elif atyp == SOCKS5AddressType.IP_V6:
+		address = ipaddress.IPv6Address(bytes(data[start:end]))
+	else:
+		address = bytes(data[start:end]).decode()
+	port, = struct.unpack_from('!H', data, end)
+	return atyp, address, port, end + 2
+
 class SOCKS5ServerMode(enum.Enum):
 	OFF    = enum.auto()
 	NORMAL = enum.auto()
@@ -133,34 +206,37 @@ class SOCKS5CommandParser:
 	def __init__(self, protocol = socket.SOCK_STREAM):
 		self.protocol = protocol #not used atm
 
-	def parse(self, buff, session):
+	@staticmethod
+	def get_message_type(session):
+		"""
+		The message class the client sends next
+		"""
 		if session.current_state == SOCKS5ServerState.NEGOTIATION:
-			return SOCKS5Nego.from_buffer(buff)
+			return SOCKS5Nego
 		
 		if session.current_state == SOCKS5ServerState.NOT_AUTHENTICATED:
 			if session.mutual_auth_type == SOCKS5Method.PLAIN:
-				return SOCKS5PlainAuth.from_buffer(buff)
+				return SOCKS5PlainAuth
 			else:
 				raise Exception('Not implemented!')
 
 		if session.current_state == SOCKS5ServerState.REQUEST:
-			return SOCKS5Request.from_buffer(buff)
+			return SOCKS5Request
 
-	async def from_streamreader(reader, session, timeout = None):
-		if session.current_state == SOCKS5ServerState.NEGOTIATION:
-			t = await asyncio.wait_for(SOCKS5Nego.from_streamreader(reader), timeout = timeout)
-			return t
-		
-		if session.current_state == SOCKS5ServerState.NOT_AUTHENTICATED:
-			if session.mutual_auth_type == SOCKS5Method.PLAIN:
-				t = await asyncio.wait_for(SOCKS5PlainAuth.from_streamreader(reader), timeout = timeout)
-				return t
-			else:
-				raise Exception('Not implemented!')
+	def parse(self, buff, session):
+		return SOCKS5CommandParser.get_message_type(session).from_buffer(buff)
 
-		if session.current_state == SOCKS5ServerState.REQUEST:
-			t = await asyncio.wait_for(SOCKS5Request.from_streamreader(reader), timeout = timeout)
-			return t
+	@staticmethod
+	def parse_data(data, session):
+		"""
+		Incremental version of parse for bytes or a memoryview of what is buffered so far
+		:return: (message, length) or (None, bytes needed) if the message is not complete yet
+		"""
+		return SOCKS5CommandParser.get_message_type(session).parse(data)
+
+	@staticmethod
+	async def from_streamreader(reader, session, timeout = None):
+		return await read_message(reader, SOCKS5CommandParser.get_message_type(session), timeout)
 
 
 class SOCKS5AuthHandler:
@@ -215,19 +291,7 @@ class SOCKS5PlainAuth:
 
 	@staticmethod
 	async def from_streamreader(reader, timeout = None):
-		auth = SOCKS5PlainAuth()
-		t = await read_or_exc(reader, 1, timeout = timeout)
-		auth.VER = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader, 1, timeout = timeout)
-		auth.ULEN = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader, auth.ULEN, timeout = timeout)
-		auth.UNAME = t.decode()
-		t = await read_or_exc(reader, 1, timeout = timeout)
-		auth.PLEN = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader, auth.PLEN, timeout = timeout)
-		auth.PASSWD = t.decode()
-
-		return auth
+		return await read_message(reader, SOCKS5PlainAuth, timeout)
 
 	@staticmethod
 	def from_bytes(bbuff):
@@ -235,14 +299,26 @@ class SOCKS5PlainAuth:
 
 	@staticmethod
 	def from_buffer(buff):
-		auth = SOCKS5PlainAuth()
-		auth.VER = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-		auth.ULEN = int.from_bytes(buff.read(1), byteorder = 'big', signed = False)
-		auth.UNAME = buff.read(auth.ULEN).decode()
-		auth.PLEN = int.from_bytes(buff.read(1), byteorder = 'big', signed = False)
-		auth.PASSWD = buff.read(auth.PLEN).decode()
+		return parse_buffer(buff, SOCKS5PlainAuth)
 
-		return auth
+	@staticmethod
+	def parse(data):
+		if len(data) < 2:
+			return None, 2
+		ver, ulen = struct.unpack_from('!BB', data)
+		if len(data) < 3 + ulen:
+			return None, 3 + ulen
+		plen = data[2 + ulen]
+		length = 3 + ulen + plen
+		if len(data) < length:
+			return None, length
+		auth = SOCKS5PlainAuth()
+		auth.VER = ver
+		auth.ULEN = ulen
+		auth.UNAME = bytes(data[2:2 + ulen]).decode()
+		auth.PLEN = plen
+		auth.PASSWD = bytes(data[3 + ulen:length]).decode()
+		return auth, length
 
 	@staticmethod
 	def construct(username, password):
@@ -272,17 +348,7 @@ class SOCKS5Nego:
 
 	@staticmethod
 	async def from_streamreader(reader, timeout = None):
-		nego = SOCKS5Nego()
-		t = await read_or_exc(reader,1, timeout = timeout)
-		nego.VER = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
-		nego.NMETHODS = int.from_bytes(t, byteorder = 'big', signed = False)
-		nego.METHODS = []
-		for i in range(nego.NMETHODS):
-			t = await read_or_exc(reader,1, timeout = timeout)
-			nego.METHODS.append(SOCKS5Method(int.from_bytes(t, byteorder = 'big', signed = False)))
-
-		return nego
+		return await read_message(reader, SOCKS5Nego, timeout)
 
 	@staticmethod
 	def from_bytes(bbuff):
@@ -290,13 +356,22 @@ class SOCKS5Nego:
 
 	@staticmethod
 	def from_buffer(buff):
+		return parse_buffer(buff, SOCKS5Nego)
+
+	@staticmethod
+	def parse(data):
+		if len(data) < 2:
+			return None, 2
+		ver, nmethods = struct.unpack_from('!BB', data)
+		length = 2 + nmethods
+		if len(data) < length:
+			return None, length
 		nego = SOCKS5Nego()
-		nego.VER = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-		nego.NMETHODS = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-		nego.METHODS = []
-		for i in range(nego.NMETHODS):
-			nego.METHODS.append(SOCKS5Method(int.from_bytes(buff.read(1), byteorder = 'big', signed = False)))
-		return nego
+		nego.VER = ver
+		nego.NMETHODS = nmethods
+		#unknown methods (eg. private ones) can never be mutual, they are left out instead of failing the parse
+		nego.METHODS = [SOCKS5Method(method) for method in data[2:length] if method in SOCKS5Method._value2member_map_]
+		return nego, length
 
 	@staticmethod
 	def construct(methods):
@@ -340,14 +415,9 @@ class SOCKS5NegoReply:
 		print(data)
 		return SOCKS5NegoReply.from_bytes(data)
 
+	@staticmethod
 	async def from_streamreader(reader, timeout = None):
-		rep = SOCKS5NegoReply()
-		t = await read_or_exc(reader,1, timeout = timeout)
-		rep.VER = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
-		rep.METHOD = SOCKS5Method(int.from_bytes(t, byteorder = 'big', signed = False))
-		
-		return rep
+		return await read_message(reader, SOCKS5NegoReply, timeout)
 
 	@staticmethod
 	def from_bytes(bbuff):
@@ -355,10 +425,16 @@ class SOCKS5NegoReply:
 
 	@staticmethod
 	def from_buffer(buff):
+		return parse_buffer(buff, SOCKS5NegoReply)
+
+	@staticmethod
+	def parse(data):
+		if len(data) < 2:
+			return None, 2
 		rep = SOCKS5NegoReply()
-		rep.VER = int.from_bytes(buff.read(1), byteorder = 'big', signed = False)
-		rep.METHOD = SOCKS5Method(int.from_bytes(buff.read(1), byteorder = 'big', signed = False))
-		return rep
+		rep.VER, method = struct.unpack_from('!BB', data)
+		rep.METHOD = SOCKS5Method(method)
+		return rep, 2
 
 	@staticmethod
 	def construct(method):
@@ -392,32 +468,7 @@ class SOCKS5Request:
 
 	@staticmethod
 	async def from_streamreader(reader, timeout = None):
-		req = SOCKS5Request()
-		t = await read_or_exc(reader,1, timeout = timeout)
-		req.VER = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
-		req.CMD = SOCKS5Command(int.from_bytes(t, byteorder = 'big', signed = False))
-		t = await read_or_exc(reader,1, timeout = timeout)
-		req.RSV = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
-		req.ATYP = SOCKS5AddressType(int.from_bytes(t, byteorder = 'big', signed = False))
-		if req.ATYP == SOCKS5AddressType.IP_V4:
-			t = await read_or_exc(reader,4, timeout = timeout)
-			req.DST_ADDR = ipaddress.IPv4Address(t)
-		elif req.ATYP == SOCKS5AddressType.IP_V6:
-			t = await read_or_exc(reader,16, timeout = timeout)
-			req.DST_ADDR = ipaddress.IPv6Address(t)
-
-		elif req.ATYP == SOCKS5AddressType.DOMAINNAME:
-			t = await read_or_exc(reader,1, timeout = timeout)
-			length = int.from_bytes(t, byteorder = 'big', signed = False)
-			t = await read_or_exc(reader,length, timeout = timeout)
-			req.DST_ADDR = t.decode()
-
-		t = await read_or_exc(reader,2, timeout = timeout)
-		req.DST_PORT = int.from_bytes(t, byteorder = 'big', signed = False)
-
-		return req
+		return await read_message(reader, SOCKS5Request, timeout)
 
 	@staticmethod
 	def from_bytes(bbuff):
@@ -425,21 +476,20 @@ class SOCKS5Request:
 
 	@staticmethod
 	def from_buffer(buff):
-		req = SOCKS5Request()
-		req.VER = int.from_bytes(buff.read(1), byteorder = 'big', signed = False)
-		req.CMD = SOCKS5Command(int.from_bytes(buff.read(1), byteorder = 'big', signed = False))
-		req.RSV = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-		req.ATYP = SOCKS5AddressType(int.from_bytes(buff.read(1), byteorder = 'big', signed = False)) 
-		if req.ATYP == SOCKS5AddressType.IP_V4:
-			req.DST_ADDR = ipaddress.IPv4Address(buff.read(4))
-		elif req.ATYP == SOCKS5AddressType.IP_V6:
-			req.DST_ADDR = ipaddress.IPv6Address(buff.read(16))
-		elif req.ATYP == SOCKS5AddressType.DOMAINNAME:
-			length = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-			req.DST_ADDR = buff.read(length).decode()
+		return parse_buffer(buff, SOCKS5Request)
 
-		req.DST_PORT = int.from_bytes(buff.read(2), byteorder = 'big', signed = False)
-		return req
+	@staticmethod
+	def parse(data):
+		atyp, address, port, length = parse_address(data, 3)
+		if atyp is None:
+			return None, length
+		req = SOCKS5Request()
+		req.VER, cmd, req.RSV = struct.unpack_from('!BBB', data)
+		req.CMD = SOCKS5Command(cmd)
+		req.ATYP = atyp
+		req.DST_ADDR = address
+		req.DST_PORT = port
+		return req, length
 
 	@staticmethod
 	def construct(cmd, address, port):
@@ -510,30 +560,7 @@ class SOCKS5Reply:
 
 	@staticmethod
 	async def from_streamreader(reader, timeout = None):
-		rep = SOCKS5Reply()
-		t = await read_or_exc(reader,1, timeout = timeout)
-		rep.VER = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
-		rep.REP = SOCKS5ReplyType(int.from_bytes(t, byteorder = 'big', signed = False))
-		t = await read_or_exc(reader,1, timeout = timeout)
-		rep.RSV = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
-		rep.ATYP = SOCKS5AddressType(int.from_bytes(t, byteorder = 'big', signed = False))
-		if rep.ATYP == SOCKS5AddressType.IP_V4:
-			t = await read_or_exc(reader,4, timeout = timeout)
-			rep.BIND_ADDR = ipaddress.IPv4Address(t)
-		elif rep.ATYP == SOCKS5AddressType.IP_V6:
-			t = await read_or_exc(reader,16, timeout = timeout)
-			rep.BIND_ADDR = ipaddress.IPv6Address(t)
-		elif rep.ATYP == SOCKS5AddressType.DOMAINNAME:
-			t = await read_or_exc(reader,1, timeout = timeout)
-			length = int.from_bytes(t, byteorder = 'big', signed = False)
-			t = await read_or_exc(reader,length, timeout = timeout)
-			rep.BIND_ADDR = t.decode()
-
-		t = await read_or_exc(reader,2, timeout = timeout)
-		rep.BIND_PORT = int.from_bytes(t, byteorder = 'big', signed = False)
-		return rep
+		return await read_message(reader, SOCKS5Reply, timeout)
 
 	@staticmethod
 	def from_bytes(bbuff):
@@ -541,23 +568,20 @@ class SOCKS5Reply:
 
 	@staticmethod
 	def from_buffer(buff):
-		rep = SOCKS5Reply()
-		rep.VER = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-		rep.REP = SOCKS5ReplyType(int.from_bytes(buff.read(1), byteorder = 'big', signed = False))
-		rep.RSV = int.from_bytes(buff.read(1), byteorder = 'big', signed = False)
-		rep.ATYP = SOCKS5AddressType(int.from_bytes(buff.read(1), byteorder = 'big', signed = False))
-
-		if rep.ATYP == SOCKS5AddressType.IP_V4:
-			rep.BIND_ADDR = ipaddress.IPv4Address(buff.read(4))
-		elif rep.ATYP == SOCKS5AddressType.IP_V6:
-			rep.BIND_ADDR = ipaddress.IPv6Address(buff.read(16))
-		elif rep.ATYP == SOCKS5AddressType.DOMAINNAME:
-			length = int.from_bytes(buff.read(1), byteorder = 'big', signed = False) 
-			rep.BIND_ADDR = buff.read(length).decode()
-
-		rep.BIND_PORT = int.from_bytes(buff.read(2), byteorder = 'big', signed = False)
+		return parse_buffer(buff, SOCKS5Reply)
 
-		return rep
+	@staticmethod
+	def parse(data):
+		atyp, address, port, length = parse_address(data, 3)
+		if atyp is None:
+			return None, length
+		rep = SOCKS5Reply()
+		rep.VER, reply, rep.RSV = struct.unpack_from('!BBB', data)
+		rep.REP = SOCKS5ReplyType(reply)
+		rep.ATYP = atyp
+		rep.BIND_ADDR = address
+		rep.BIND_PORT = port
+		return rep, length
 
 	@staticmethod
 	def construct(reply, address, port): 
@@ -613,26 +637,26 @@ class SOCKS5UDP:
 	@staticmethod
 	async def from_streamreader(reader, timeout = None):
 		rep = SOCKS5UDP()
-		t = await read_or_exc(reader,2, timeout = timeout)
+		t = await readexactly_or_exc(reader,2, timeout = timeout)
 		rep.RSV = int.from_bytes(t, byteorder = 'big', signed = False)
-		t = await read_or_exc(reader,1, timeout = timeout)
+		t = await readexactly_or_exc(reader,1, timeout = timeout)
 		rep.FRAG = SOCKS5ReplyType(int.from_bytes(t, byteorder = 'big', signed = False))
-		t = await read_or_exc(reader,1, timeout = timeout)
+		t = await readexactly_or_exc(reader,1, timeout = timeout)
 		rep.ATYP = SOCKS5AddressType(int.from_bytes(t, byteorder = 'big', signed = False))
 		if rep.ATYP == SOCKS5AddressType.IP_V4:
-			t = await read_or_exc(reader,4, timeout = timeout)
+			t = await readexactly_or_exc(reader,4, timeout = timeout)
 			rep.DST_ADDR = ipaddress.IPv4Address(t)
 		elif rep.ATYP == SOCKS5AddressType.IP_V6:
-			t = await read_or_exc(reader,16, timeout = timeout)
+			t = await readexactly_or_exc(reader,16, timeout = timeout)
 			rep.DST_ADDR = ipaddress.IPv6Address(t)
 
 		elif rep.ATYP == SOCKS5AddressType.DOMAINNAME:
-			t = await read_or_exc(reader,1, timeout = timeout)
+			t = await readexactly_or_exc(reader,1, timeout = timeout)
 			length = int.from_bytes(t, byteorder = 'big', signed = False)
-			t = await read_or_exc(reader,length, timeout = timeout)
+			t = await readexactly_or_exc(reader,length, timeout = timeout)
 			rep.DST_ADDR = t.decode()
 
-		t = await read_or_exc(reader,2, timeout = timeout)
+		t = await readexactly_or_exc(reader,2, timeout = timeout)
 		rep.DST_PORT = int.from_bytes(t, byteorder = 'big', signed = False)
 		return rep
 
@@ -750,101 +774,195 @@ class SOCKS5Session:
 		t += 'client_transport: %s\r\n' % repr(self.client_transport)
 		return t
 
-class Socks5Packet:
-	def __init__(self, session_id, data):
-		self.session_id = session_id
-		self.data = data
+async def socks5_handshake(reader, send, session, timeout = 30):
+	"""
+	Does the greeting and the authentication with a socks5 client and reads its request.
+	send is a coroutine that sends bytes to the client. The answer to the request is up to the caller.
+	:return: SOCKS5Request or None if the client could not be served
+	"""
+	while True:
+		msg = await SOCKS5CommandParser.from_streamreader(reader, session, timeout)
+		if session.current_state == SOCKS5ServerState.NEGOTIATION:
+			mutual, mutual_idx = get_mutual_preference(session.supported_auth_types, msg.METHODS)
+			if mutual is None:
+				logger.debug('No common authentication types! Client supports %s' % (','.join([str(x) for x in msg.METHODS])))
+				#still the method selection message, so version 5 and not the one of the auth subnegotiation
+				await send(SOCKS5NegoReply.construct(SOCKS5Method.NOTACCEPTABLE).to_bytes())
+				return None
+			logger.debug('Mutual authentication type: %s' % mutual)
+			session.mutual_auth_type = mutual
+			session.authHandler = SOCKS5AuthHandler(session.mutual_auth_type, session.creds) 
+
+			if session.mutual_auth_type == SOCKS5Method.NOAUTH:
+				session.current_state = SOCKS5ServerState.REQUEST # if no authentication is requred then we skip the auth part
+			else:
+				session.current_state = SOCKS5ServerState.NOT_AUTHENTICATED
 
-	def to_dict(self):
-		t = {}
-		t['session_id'] = self.session_id
-		if self.data is None: #special case for closing socket
-			t['data'] = None
-		else:
-			t['data'] = self.data.hex()
-		return t
+			await send(SOCKS5NegoReply.construct(session.mutual_auth_type).to_bytes())
 
-	def to_json(self):
-		return json.dumps(self.to_dict())
+		elif session.current_state == SOCKS5ServerState.NOT_AUTHENTICATED:
+			if session.mutual_auth_type == SOCKS5Method.PLAIN:
+				status, creds = session.authHandler.do_AUTH(msg)
+				if status:
+					session.current_state = SOCKS5ServerState.REQUEST
+					await send(SOCKS5NegoReply.construct_auth(SOCKS5Method.NOAUTH).to_bytes())
+				else:
+					await send(SOCKS5NegoReply.construct_auth(SOCKS5Method.NOTACCEPTABLE).to_bytes())
+					return None
+			else:
+				#put GSSAPI implementation here
+				raise Exception('Not implemented!')
 
-	@staticmethod
-	def from_data(data):
-		packet = json.loads(data)
-		pdata = packet['data']
-		if pdata is None:
-			return Socks5Packet(packet['session_id'], None)
-		else:
-			return Socks5Packet(packet['session_id'], bytes.fromhex(pdata))
+		elif session.current_state == SOCKS5ServerState.REQUEST:
+			logger.debug('Remote client wants to connect to %s:%d' % (str(msg.DST_ADDR), msg.DST_PORT))
+			return msg
+
+def connect_error_reply(e):
+	"""
+	Maps the exception of a failed connect to the socks5 reply the client gets
+	"""
+	if isinstance(e, asyncio.TimeoutError):
+		return SOCKS5ReplyType.TTL_EXPIRED
+	if isinstance(e, ConnectionRefusedError):
+		return SOCKS5ReplyType.CONN_REFUSED
+	if isinstance(e, socket.gaierror):
+		return SOCKS5ReplyType.HOST_UNREACHABLE
+	if isinstance(e, OSError):
+		if e.errno == errno.ENETUNREACH:
+			return SOCKS5ReplyType.NETWORK_UNREACHABLE
+		if e.errno == errno.EHOSTUNREACH:
+			return SOCKS5ReplyType.HOST_UNREACHABLE
+	return SOCKS5ReplyType.FAILURE
+
+class Socks5Packet(SessionPacket):
+	def __init__(self, session_id, data, compression = None, priority = None):
+		SessionPacket.__init__(self, session_id, data, compression, priority)
 
 class FakeStreamReader:
-	def __init__(self, in_queue):
+	"""
+	asyncio.StreamReader lookalike, fed by streamify_input from the in_queue (None means EOF).
+	A read that has to wait sleeps on a future which is resolved when data or EOF arrives.
+	streamify_input stops taking from the in_queue while max_bytes are buffered, so a bounded in_queue fills up.
+	"""
+	def __init__(self, in_queue, on_consumed = None, max_bytes = None):
 		self.in_queue = in_queue
-		self.in_buffer = b''
+		self.in_buffer = ChunkBuffer()
 		self.is_closing = False
+		self.waiter = None
+		self.on_consumed = on_consumed #called with the number of bytes every read took out of the buffer
+		self.max_bytes = max_bytes
+		self.has_room = asyncio.Event()
+		self.has_room.set()
 
 	def at_eof(self):
-		return self.is_closing
+		return self.is_closing and len(self.in_buffer) == 0
+
+	def feed_data(self, data):
+		if len(data) == 0:
+			return
+		self.in_buffer.append(data)
+		self.wakeup_waiter()
+
+	def feed_eof(self):
+		self.is_closing = True
+		self.wakeup_waiter()
+
+	def consumed(self, data):
+		if self.on_consumed is not None and len(data) > 0:
+			self.on_consumed(len(data))
+		if self.max_bytes is not None and len(self.in_buffer) < self.max_bytes:
+			self.has_room.set()
+		return data
+
+	def wakeup_waiter(self):
+		if self.waiter is not None and not self.waiter.done():
+			self.waiter.set_result(None)
+
+	async def wait_for_data(self):
+		if self.waiter is not None:
+			raise RuntimeError('Another coroutine is already waiting for data!')
+		self.waiter = asyncio.get_event_loop().create_future()
+		try:
+			await self.waiter
+		finally:
+			self.waiter = None
 
 	async def streamify_input(self):
 		try:
 			while True:
+				while self.max_bytes is not None and len(self.in_buffer) >= self.max_bytes:
+					self.has_room.clear()
+					await self.has_room.wait()
 				data = await self.in_queue.get()
 				if data is None:
 					logger.debug('We are closing this line!')
-					self.is_closing = True
-				else:
-					self.in_buffer += data
+					self.feed_eof()
+					return
+				self.feed_data(data)
 		except Exception as e:
 			logger.exception('streamify_input')
 
-	async def read(self, maxlen = -1):
-		print('Read %d' % maxlen)
-		
-		while self.in_buffer == b'' and not self.is_closing:
-			await asyncio.sleep(0.01)
-
-		if maxlen == -1:
-			data = self.in_buffer
-			self.in_buffer = b''
-			print('Read data: %s' % data)
-			return data
-		else:
-			if len(self.in_buffer) >= maxlen:
-				data = self.in_buffer[:maxlen]
-				self.in_buffer = self.in_buffer[maxlen:]
-				print('Read data: %s' % data)
-				return data
-			else:
-				data = self.in_buffer
-				self.in_buffer = b''
-				print('Read data: %s' % data)
-				return data
-
-	async def readexactly(cnt):
-		if len(self.in_buffer) >= cnt:
-			data = self.in_buffer[:cnt]
-			if cnt == 1:
-				data = data.to_bytes(1, byteorder = 'big', signed = False)
-			self.in_buffer = self.in_buffer[maxlen:]
-			return data
-		else:
-			while not len(self.in_buffer) >= cnt:
-				await asyincio.sleep(0.01)
-			
-			data = self.in_buffer[:cnt]
-			if cnt == 1:
-				data = data.to_bytes(1, byteorder = 'big', signed = False)
-			self.in_buffer = self.in_buffer[maxlen:]
-			return data
+	async def read(self, n = -1):
+		"""
+		Returns at most n bytes as soon as there is any data, b'' on EOF.
+		n = -1 reads until EOF.
+		"""
+		if n == 0:
+			return b''
+		if n < 0:
+			while not self.is_closing:
+				await self.wait_for_data()
+			return self.consumed(self.in_buffer.read())
+
+		while len(self.in_buffer) == 0 and not self.is_closing:
+			await self.wait_for_data()
+		return self.consumed(self.in_buffer.read(n))
+
+	async def read_view(self, n = -1):
+		"""
+		Same as read but returns a memoryview of (part of) one chunk, without copying
+		"""
+		while len(self.in_buffer) == 0 and not self.is_closing:
+			await self.wait_for_data()
+		return self.consumed(self.in_buffer.read_view(n))
+
+	async def readexactly(self, n):
+		while len(self.in_buffer) < n:
+			if self.is_closing:
+				raise asyncio.IncompleteReadError(self.consumed(self.in_buffer.read()), n)
+			await self.wait_for_data()
+		return self.consumed(self.in_buffer.read(n))
+
+	async def readuntil(self, separator = b'\n'):
+		offset = 0
+		while True:
+			pos = self.in_buffer.find(separator, offset)
+			if pos != -1:
+				break
+			if self.is_closing:
+				raise asyncio.IncompleteReadError(self.consumed(self.in_buffer.read()), None)
+			#the separator can start in the part we already searched
+			offset = max(0, len(self.in_buffer) - len(separator) + 1)
+			await self.wait_for_data()
+		return self.consumed(self.in_buffer.read(pos + len(separator)))
+
+	async def readline(self):
+		try:
+			return await self.readuntil(b'\n')
+		except asyncio.IncompleteReadError as e:
+			return e.partial
 
 	async def run(self):
 		asyncio.ensure_future(self.streamify_input())
 
 class FakeStreamWriter:
-	def __init__(self, session_id, out_queue):
+	def __init__(self, session_id, send_packet, compression = None, window = None, priority = None):
 		self.session_id = session_id
-		self.out_queue = out_queue
-		self.buffer = b''
+		self.send_packet = send_packet #coroutine that sends a Socks5Packet
+		self.compression = compression
+		self.priority = priority
+		self.window = window #FlowWindow of the session, drain waits for credit
+		self.buffer = ChunkBuffer()
 		self.is_closing = False
 
 	def get_extra_info(self, info):
@@ -858,29 +976,44 @@ class FakeStreamWriter:
 			return None
 
 	def write(self, data):
-		if data == b'':
+		if len(data) == 0:
 			self.is_closing = True
-		self.buffer += data
+		self.buffer.append(data)
 
 	async def drain(self):
-		data = self.buffer
-		self.buffer = b''
-		await self.out_queue.put(Socks5Packet(self.session_id, data))
+		while len(self.buffer) > 0:
+			if self.window is None:
+				data = self.buffer.read(READ_SIZE_MAX)
+			else:
+				if not await self.window.wait_for_credit():
+					#session is closed, nobody would read this
+					self.buffer.read()
+					break
+				data = self.buffer.read(min(self.window.send_credit, READ_SIZE_MAX))
+				self.window.consume(len(data))
+			await self.send_packet(Socks5Packet(self.session_id, data, self.compression, self.priority))
 		if self.is_closing:
-			await self.out_queue.put(Socks5Packet(self.session_id, None))
+			await self.send_packet(Socks5Packet(self.session_id, None, priority = self.priority))
 
 
 
 class Socks5Server:
-	def __init__(self, session_id, in_queue, out_queue):
+	def __init__(self, session_id, in_queue, module, initial_window = None, priority_rules = None):
 		self.session_id = session_id
 		self.in_queue = in_queue
-		self.out_queue = out_queue
+		self.module = module #Socks5Module, the packets go through it straight to the websocket
 		self.session = SOCKS5Session()
-		self.creader = FakeStreamReader(self.in_queue)
-		self.cwriter = FakeStreamWriter(self.session_id, self.out_queue)
+		self.compression = CompressionVerdict() #marks the session if the relayed data does not compress (eg. TLS)
+		self.priority = SessionPriority(priority_rules) #the destination port is set once the client sent its request
+		self.window = None
+		if initial_window is not None:
+			self.window = FlowWindow(initial_window)
+		self.creader = FakeStreamReader(self.in_queue, self.data_consumed if self.window is not None else None, self.in_queue.max_bytes)
+		self.cwriter = FakeStreamWriter(self.session_id, self.send_packet, self.compression, self.window, self.priority)
 
 		self.in_buffer = b''
+		self.destination = None #SocketEndpoint once connected
+		self.relay = None #Relay once the session is relaying
 
 	async def parse_message(self, timeout=None):
 		try:
@@ -889,9 +1022,27 @@ class Socks5Server:
 		except asyncio.TimeoutError:
 			logger.debug('Timeout!')
 
+	def data_consumed(self, n):
+		increment = self.window.delivered(n)
+		if increment > 0:
+			self.module.send_control(SessionControl.window_update(self.session_id, increment))
+
+	async def send_packet(self, packet):
+		await self.module.send_session_packet(self, packet)
+
+	def input_closed(self):
+		"""
+		Nothing reads the in_queue anymore, a put waiting for room in it must not hold up the other sessions
+		"""
+		self.in_queue.max_bytes = None
+		self.in_queue.not_full.set()
+
 	async def send(self, data):
 		print('Sending putput data!')
-		await self.out_queue.put(Socks5Packet(self.session_id, data))
+		if self.window is not None:
+			#socks replies are tiny, they just take their share of the credit
+			self.window.consume(len(data))
+		await self.send_packet(Socks5Packet(self.session_id, data, priority = self.priority))
 
 	"""
 	async def proxy_forwarder(self, reader, writer):
@@ -926,174 +1077,518 @@ class Socks5Server:
 		return
 	"""
 
+	async def connect(self, req):
+		"""
+		Connects to the destination of the request
+		:return: SOCKS5ReplyType for the client
+		"""
+		self.priority.set_port(req.DST_PORT)
+		if req.CMD != SOCKS5Command.CONNECT:
+			return SOCKS5ReplyType.COMMAND_NOT_SUPPORTED
+		try:
+			#in this case the server acts as a normal socks5 server
+			self.destination = await self.open_destination(str(req.DST_ADDR), req.DST_PORT)
+		except (asyncio.TimeoutError, OSError, ValueError) as e:
+			#ValueError: names that are not valid IDNA
+			logger.debug('Connecting to %s:%d failed! %s' % (str(req.DST_ADDR), req.DST_PORT, e))
+			return connect_error_reply(e)
+		logger.debug('Connected!')
+		self.session.current_state = SOCKS5ServerState.RELAYING
+		return SOCKS5ReplyType.SUCCEEDED
+
+	async def open_destination(self, host, port):
+		"""
+		Names are resolved by the DNSCache of the module, its addresses are tried in order.
+		CONNECT_TIMEOUT applies to each connect, not to the name lookup.
+		"""
+		loop = asyncio.get_event_loop()
+		if self.module.dns_cache is not None:
+			addresses = await self.module.dns_cache.resolve(host)
+		else:
+			addresses = []
+			for info in await loop.getaddrinfo(host, port, type = socket.SOCK_STREAM):
+				if info[4][0] not in addresses:
+					addresses.append(info[4][0])
+		error = None
+		for address in addresses:
+			try:
+				_, destination = await asyncio.wait_for(loop.create_connection(lambda: SocketEndpoint(name = 'destination'), host = address, port = port), timeout = CONNECT_TIMEOUT)
+				return destination
+			except (asyncio.TimeoutError, OSError) as e:
+				error = e
+		raise error
+
+	async def relay_data(self):
+		self.relay = Relay('[Socks5 Proxy]', logger, self.session.timeout)
+		self.relay.connect(self.destination, StreamEndpoint(self.creader, self.cwriter, name = 'tunnel'))
+		await self.relay.closed.wait()
+
 	async def run(self):
+		"""
+		The socks5 handshake comes through the tunnel, this is what servers without session open messages do
+		"""
 		asyncio.ensure_future(self.creader.run())
 		try:
-			while True:
-				msg = await asyncio.wait_for(self.parse_message(), timeout = 30)
-				#print(str(msg))
-				if self.session.current_state == SOCKS5ServerState.NEGOTIATION:
-					mutual, mutual_idx = get_mutual_preference(self.session.supported_auth_types, msg.METHODS)
-					if mutual is None:
-						logger.debug('No common authentication types! Client supports %s' % (','.join([str(x) for x in msg.METHODS])))
-						print(msg.METHODS)
-						t = await asyncio.wait_for(self.send(SOCKS5NegoReply.construct_auth(SOCKS5Method.NOTACCEPTABLE).to_bytes()), timeout = 1)
-						return
-					logger.debug('Mutual authentication type: %s' % mutual)
-					self.session.mutual_auth_type = mutual
-					self.session.authHandler = SOCKS5AuthHandler(self.session.mutual_auth_type, self.session.creds) 
-
-					if self.session.mutual_auth_type == SOCKS5Method.NOAUTH:
-						self.session.current_state = SOCKS5ServerState.REQUEST # if no authentication is requred then we skip the auth part
-					else:
-						self.session.current_state = SOCKS5ServerState.NOT_AUTHENTICATED
-
-					t = await asyncio.wait_for(self.send(SOCKS5NegoReply.construct(self.session.mutual_auth_type).to_bytes()), timeout = 1)
-
-				elif self.session.current_state == SOCKS5ServerState.NOT_AUTHENTICATED:
-					if self.session.mutual_auth_type == SOCKS5Method.PLAIN:
-						status, creds = self.session.authHandler.do_AUTH(msg)
-						if status:
-							self.session.current_state = SOCKS5ServerState.REQUEST
-							t = await asyncio.wait_for(self.send(SOCKS5NegoReply.construct_auth(SOCKS5Method.NOAUTH).to_bytes()), timeout = 1)
-						else:
-							t = await asyncio.wait_for(self.send(SOCKS5NegoReply.construct_auth(SOCKS5Method.NOTACCEPTABLE).to_bytes()), timeout = 1)
-							return
-					else:
-						#put GSSAPI implementation here
-						raise Exception('Not implemented!')
-
-				elif self.session.current_state == SOCKS5ServerState.REQUEST:
-					logger.debug('Remote client wants to connect to %s:%d' % (str(msg.DST_ADDR), msg.DST_PORT))
-					if msg.CMD == SOCKS5Command.CONNECT:
-						#in this case the server acts as a normal socks5 server
-						proxy_reader, proxy_writer = await asyncio.wait_for(asyncio.open_connection(host=str(msg.DST_ADDR),port = msg.DST_PORT), timeout=1)
-						logger.debug('Connected!')
-						self.session.current_state = SOCKS5ServerState.RELAYING
-						t = await asyncio.wait_for(self.send(SOCKS5Reply.construct(SOCKS5ReplyType.SUCCEEDED, self.session.allinterface, 0).to_bytes()), timeout = 1)
-						#asyncio.ensure_future(self.proxy_forwarder(proxy_reader, self.cwriter))
-						#asyncio.ensure_future(self.proxy_forwarder(self.creader, proxy_writer))
-
-						tcp_proxy = AioTCPProxy(proxy_reader, proxy_writer, self.creader, self.cwriter, '[Socks5 Proxy]', logger)
-						asyncio.ensure_future(tcp_proxy.run())
-
-
-						await asyncio.wait_for(self.session.proxy_closed.wait(), timeout = None)
-						return
-					
-					else:
-						t = await asyncio.wait_for(SOCKS5Reply.construct(SOCKS5ReplyType.COMMAND_NOT_SUPPORTED, self.session.allinterface, 0).to_bytes(), timeout = 1)
-						return				
+			req = await socks5_handshake(self.creader, self.send, self.session)
+			if req is None:
+				return
+			reply = await self.connect(req)
+			await asyncio.wait_for(self.send(SOCKS5Reply.construct(reply, self.session.allinterface, 0).to_bytes()), timeout = 1)
+			if reply != SOCKS5ReplyType.SUCCEEDED:
+				return
+			await self.relay_data()
 		except Exception as e:
 			logger.exception('Socks5Server error!')
 
-class Socks5Module(CommsModule):
-	def __init__(self, job_id, in_queue, out_queue):
-		CommsModule.__init__(self, module_name, job_id, in_queue, out_queue, ModuleDesignation.AGENT)
-		self.sessions = {} #session_id -> socks5server
-		self.server_out_queue = asyncio.Queue()
-	
-	async def handle_socks5_out(self):
+	def open(self, data):
+		"""
+		The server did the handshake and sent the request in an OPEN control message.
+		What follows the request is early data of the client, it is queued right away so the session data
+		that came after the OPEN message stays behind it. The destination gets it first thing once connected.
+		"""
 		try:
-			while True:
-				packet = await self.server_out_queue.get()
-
-				print('Sending putput packet! ')
-				await self.send_data(packet.to_json())
+			buff = io.BytesIO(data)
+			req = SOCKS5Request.from_buffer(buff)
+			early_data = buff.read()
+			if len(early_data) > 0:
+				self.in_queue.put_nowait(early_data)
 		except Exception as e:
-			logger.exception('handle_socks5_out')
+			logger.exception('Socks5Server open error!')
+			req = None
+		asyncio.ensure_future(self.open_connection(req))
+
+	async def open_connection(self, req):
+		"""
+		The connect result goes back in an OPEN_RESULT, a failed session is closed right after it.
+		"""
+		asyncio.ensure_future(self.creader.run())
+		reply = SOCKS5ReplyType.FAILURE
+		if req is not None:
+			reply = await self.connect(req)
+		#sent like the data of the session, so it stays in order with it on the same websocket
+		await self.send_packet(SessionControl.open_result(self.session_id, reply.value))
+		if reply != SOCKS5ReplyType.SUCCEEDED:
+			await self.send_packet(Socks5Packet(self.session_id, None, priority = self.priority))
 			return
+		try:
+			await self.relay_data()
+		except Exception as e:
+			logger.exception('Socks5Server error!')
+
+class Socks5Module(CommsModule):
+	def __init__(self, job_id, in_queue, out_queue, initial_window = None, priority_rules = None, dns_cache = None):
+		CommsModule.__init__(self, module_name, job_id, in_queue, out_queue, ModuleDesignation.AGENT)
+		self.initial_window = initial_window
+		self.priority_rules = priority_rules
+		self.dns_cache = dns_cache #DNSCache of the agent, None resolves every name again
+		#with flow control the window keeps every session below this, so reading the websocket never waits for one
+		self.buffer_bytes = max(SESSION_BUFFER_MAX, initial_window or 0)
+		self.sessions = {} #int session_id -> socks5server
+		self.closed = set() #session ids we closed but the server did not yet
+
+	def session_stats(self):
+		t = []
+		for session_id, server in self.sessions.items():
+			if server.relay is not None:
+				t.append({'session_id' : session_id, 'relay' : server.relay.to_dict()})
+		return t
 
+	def create_session(self, session_id):
+		logger.debug('Creating new session!')
+		#the session gets its own buffer, the destination socket is written by the Relay of the session
+		in_queue = ByteQueue(self.buffer_bytes, sizeof = lambda data: 0 if data is None else len(data), name = 'session %s' % session_id) #pre-series servers send uuid strings
+		server = Socks5Server(session_id, in_queue, self, self.initial_window, self.priority_rules)
+		self.sessions[session_id] = server
+		return server
+
+	async def send_session_packet(self, server, packet):
+		"""
+		Sends a packet of a session straight to the websocket (out_queue is the FrameSink of the connection)
+		"""
+		if self.sessions.get(packet.session_id) is not server:
+			#session is closed, the server might reuse the id so nothing else can be sent for it
+			return
+		if packet.data is None:
+			self.sessions.pop(packet.session_id)
+			if server.window is not None:
+				server.window.close()
+			server.input_closed()
+			self.closed.add(packet.session_id)
+		await self.send_data(packet)
 
 	async def run(self):
-		asyncio.ensure_future(self.handle_socks5_out())
 		while True:
 			data = await self.get_data()
 			logger.debug('Got data! %s' % data)
 			packet = Socks5Packet.from_data(data)
+			if isinstance(packet, SessionControl):
+				if packet.ctrl_type == ControlType.WINDOW_UPDATE and packet.session_id in self.sessions:
+					server = self.sessions[packet.session_id]
+					if server.window is not None:
+						server.window.update(packet.increment)
+				elif packet.ctrl_type == ControlType.OPEN:
+					if packet.session_id in self.sessions or packet.session_id in self.closed:
+						logger.debug('Session %s is already in use!' % packet.session_id)
+						continue
+					server = self.create_session(packet.session_id)
+					server.open(packet.data)
+				continue
+
+			if packet.data is None:
+				#server closed the session, answering with our own close lets it reuse the id
+				if packet.session_id in self.sessions:
+					server = self.sessions.pop(packet.session_id)
+					if server.window is not None:
+						server.window.close()
+					await server.in_queue.put(None)
+					await self.send_data(Socks5Packet(packet.session_id, None))
+				elif packet.session_id in self.closed:
+					self.closed.remove(packet.session_id)
+				else:
+					#never opened here (eg. the server gave up on its OPEN), the id is only reused once we answer
+					await self.send_data(Socks5Packet(packet.session_id, None))
+				continue
+
+			if packet.session_id in self.closed:
+				#data that was on the way when we closed the session
+				continue
+
 			if packet.session_id not in self.sessions:
-				logger.debug('Creating new session!')
-				in_queue = asyncio.Queue()
-				server = Socks5Server(packet.session_id, in_queue, self.server_out_queue)
-				self.sessions[packet.session_id] = server
+				#the socks5 handshake comes through the tunnel
+				server = self.create_session(packet.session_id)
 				asyncio.ensure_future(server.run())
 			
 			await self.sessions[packet.session_id].in_queue.put(packet.data)
 
 
+class SessionWriter:
+	"""
+	Writes the data of one session to its local socket from its own task, so a client that reads slowly
+	only holds up its own session. write only waits when the session has max_bytes or more buffered, with
+	flow control the window keeps it below that. on_delivered is called with the bytes that reached the socket.
+	"""
+	def __init__(self, session_id, writer, max_bytes = SESSION_BUFFER_MAX, on_delivered = None):
+		self.session_id = session_id
+		self.writer = writer
+		self.max_bytes = max_bytes
+		self.on_delivered = on_delivered
+		self.buffer = ChunkBuffer()
+		self.has_data = asyncio.Event()
+		self.has_room = asyncio.Event()
+		self.has_room.set()
+		self.is_closing = False
+		self.failed = False
+
+		self.high_watermark = 0
+		self.total_bytes = 0
+		self.room_waits = 0
+
+	async def write(self, data):
+		if self.failed:
+			#socket is gone, handle_client_in closes the session
+			return
+		if len(self.buffer) >= self.max_bytes:
+			self.room_waits += 1
+			while len(self.buffer) >= self.max_bytes and not self.failed:
+				self.has_room.clear()
+				await self.has_room.wait()
+		self.buffer.append(data)
+		if len(self.buffer) > self.high_watermark:
+			self.high_watermark = len(self.buffer)
+		self.has_data.set()
+
+	def close(self):
+		"""
+		The socket is closed once everything buffered is written
+		"""
+		self.is_closing = True
+		self.has_data.set()
+
+	async def run(self):
+		try:
+			while True:
+				if len(self.buffer) == 0:
+					if self.is_closing:
+						break
+					self.has_data.clear()
+					await self.has_data.wait()
+					continue
+				data = self.buffer.read()
+				self.writer.write(data)
+				await self.writer.drain()
+				self.total_bytes += len(data)
+				if len(self.buffer) < self.max_bytes:
+					self.has_room.set()
+				if self.on_delivered is not None:
+					self.on_delivered(len(data))
+		except Exception as e:
+			logger.debug('session %d died :( %s' % (self.session_id, e))
+			self.failed = True
+			self.buffer.read()
+			self.has_room.set()
+		logger.debug('session %d writer done %s' % (self.session_id, self.to_dict()))
+		try:
+			self.writer.close()
+		except:
+			pass
+
+	def to_dict(self):
+		t = {}
+		t['session_id'] = self.session_id
+		t['buffered'] = len(self.buffer)
+		t['high_watermark'] = self.high_watermark
+		t['total_bytes'] = self.total_bytes
+		t['room_waits'] = self.room_waits
+		return t
+
 class Socks5ModuleServer(CommsModule):
-	def __init__(self, job_id, in_queue, out_queue, listen_ip = '127.0.0.1'):
+	def __init__(self, job_id, in_queue, out_queue, listen_ip = '127.0.0.1', initial_window = None, priority_rules = None, local_handshake = False, early_data = False):
 		CommsModule.__init__(self, module_name, job_id, in_queue, out_queue)
-		self.sessions = {} #session_id -> writer
+		self.initial_window = initial_window
+		self.priority_rules = priority_rules
+		self.local_handshake = local_handshake #the agent takes OPEN messages, the socks5 handshake is done here
+		self.early_data = early_data #clients get SUCCEEDED before the agent connected, see open_session_early
+		self.opening = {} #int session_id -> future of the agent's connect result
+		self.sessions = {} #int session_id -> SessionWriter
+		self.windows = {} #int session_id -> FlowWindow
+		self.read_sizers = {} #int session_id -> ReadSizer of the local socket
+		self.buffer_bytes = max(SESSION_BUFFER_MAX, initial_window or 0) #see Socks5Module
+		self.session_ids = IdAllocator()
+		self.half_closed = set() #session ids where only one side sent the closing packet
 		self.listen_ip = listen_ip
 
+	def session_closed(self, session_id):
+		"""
+		Called when the closing packet is sent and when it is recieved.
+		The id can only be reused when both happened, otherwise late packets of the old session could end up in the new one.
+		"""
+		if session_id in self.half_closed:
+			self.half_closed.remove(session_id)
+			self.session_ids.release(session_id)
+		else:
+			self.half_closed.add(session_id)
+		window = self.windows.pop(session_id, None)
+		if window is not None:
+			window.close()
+
 	async def handle_client_out(self):
 		while True:
 			try:
 				data = await self.get_data()
 				print('Data out')
 				packet = Socks5Packet.from_data(data)
+				if isinstance(packet, SessionControl):
+					if packet.ctrl_type == ControlType.WINDOW_UPDATE and packet.session_id in self.windows:
+						self.windows[packet.session_id].update(packet.increment)
+					elif packet.ctrl_type == ControlType.OPEN_RESULT:
+						reply = SOCKS5ReplyType(packet.result_code)
+						if packet.session_id in self.opening:
+							self.opening.pop(packet.session_id).set_result(reply)
+					continue
+
+				if packet.data is None:
+					self.session_closed(packet.session_id)
+					if packet.session_id in self.opening:
+						#agent closed the session without a result
+						self.opening.pop(packet.session_id).set_result(SOCKS5ReplyType.FAILURE)
+
 				if packet.session_id not in self.sessions:
 					logger.debug('Unknown session id')
 					continue
 			
 				if packet.data is None:
-					#closing connection!
-					try:
-						await self.sessions[packet.session_id].drain()
-						self.sessions[packet.session_id].close()
-					except Exception as e:
-						logger.exception('Socket closing!')
-					
-					del self.sessions[packet.session_id]
+					#closing connection, the writer of the session finishes what it has first
+					self.sessions.pop(packet.session_id).close()
 				else:
-					try:
-						self.sessions[packet.session_id].write(packet.data)
-						await self.sessions[packet.session_id].drain()
-					except Exception as e:
-						logger.debug('session died :(')
-						temp = self.sessions[packet.session_id]
-						del self.sessions[packet.session_id]
-						try:
-							temp.close()
-						except:
-							pass
+					await self.sessions[packet.session_id].write(packet.data)
 
 			except Exception as e:
 				logger.exception('handle_client_out')
 				continue
 
-	async def handle_client_in(self,session_id,  reader):
+	def session_stats(self):
+		t = []
+		for session_id, session_writer in self.sessions.items():
+			stats = session_writer.to_dict()
+			if session_id in self.read_sizers:
+				stats['reads'] = self.read_sizers[session_id].to_dict()
+			t.append(stats)
+		return t
+
+	def data_delivered(self, session_id, n):
+		if session_id in self.windows:
+			increment = self.windows[session_id].delivered(n)
+			if increment > 0:
+				self.send_control(SessionControl.window_update(session_id, increment))
+
+	async def end_session(self, session_id, priority = None):
+		"""
+		Sends the closing packet of the session, the local socket is closed once its writer is done
+		"""
+		await self.send_data(Socks5Packet(session_id, None, priority = priority))
+		self.read_sizers.pop(session_id, None)
+		self.session_closed(session_id)
+		if session_id in self.sessions:
+			try:
+				self.sessions[session_id].close()
+			except:
+				pass
+			del self.sessions[session_id]
+
+	async def wait_open_result(self, session_id):
+		"""
+		:return: the agent's answer to the OPEN of the session, None if there was none in OPEN_TIMEOUT seconds
+		"""
+		try:
+			return await asyncio.wait_for(asyncio.shield(self.opening[session_id]), timeout = OPEN_TIMEOUT)
+		except asyncio.TimeoutError:
+			logger.debug('Session %d got no answer to its open request!' % session_id)
+			self.opening.pop(session_id, None)
+			return None
+
+	async def open_session(self, session_id, req, writer):
+		"""
+		Asks the agent to connect to the destination of the request and answers the client once it is done.
+		Only the request crosses the tunnel, so setting up a connection takes a single round trip.
+		:return: True if the session can start relaying
+		"""
+		self.opening[session_id] = asyncio.get_event_loop().create_future()
+		#sent like the data of the session: a reused id has to wait for the closing packet of its old session
+		await self.send_data(SessionControl(session_id, ControlType.OPEN, req.to_bytes()))
+		reply = await self.wait_open_result(session_id)
+		if reply is None:
+			reply = SOCKS5ReplyType.TTL_EXPIRED
+		logger.debug('Session %d to %s:%d: %s' % (session_id, str(req.DST_ADDR), req.DST_PORT, reply.name))
+		#written before the writer of the session starts, it does not count against the flow control window
+		try:
+			writer.write(SOCKS5Reply.construct(reply, ipaddress.ip_address('0.0.0.0'), 0).to_bytes())
+			await writer.drain()
+		except Exception as e:
+			logger.debug('Session %d client is gone! %s' % (session_id, e))
+			return False
+		return reply == SOCKS5ReplyType.SUCCEEDED
+
+	async def open_session_early(self, session_id, req, reader, writer):
+		"""
+		Optimistic version of open_session, it saves the round trip of the connect.
+		The client gets SUCCEEDED right away and what it sends in the next EARLY_DATA_WAIT seconds (eg. a TLS ClientHello)
+		goes in the OPEN message, the agent writes it as soon as it is connected.
+		If the connect fails the client can not get an error reply anymore: the session is closed as if the
+		destination hung up right away and the early data is lost. It was never sent, so nothing is sent twice.
+		"""
+		window = self.windows.get(session_id)
+		read_size = EARLY_DATA_MAX
+		if window is not None:
+			read_size = min(read_size, window.send_credit)
+		try:
+			writer.write(SOCKS5Reply.construct(SOCKS5ReplyType.SUCCEEDED, ipaddress.ip_address('0.0.0.0'), 0).to_bytes())
+			await writer.drain()
+			early_data = await asyncio.wait_for(reader.read(read_size), timeout = EARLY_DATA_WAIT)
+		except asyncio.TimeoutError:
+			early_data = b''
+		except Exception as e:
+			#handle_client_in sees the broken socket too and closes the session
+			logger.debug('Session %d client is gone! %s' % (session_id, e))
+			early_data = b''
+		if window is not None:
+			window.consume(len(early_data))
+		self.opening[session_id] = asyncio.get_event_loop().create_future()
+		#sent like the data of the session: a reused id has to wait for the closing packet of its old session
+		await self.send_data(SessionControl(session_id, ControlType.OPEN, req.to_bytes() + early_data))
+		logger.debug('Session %d to %s:%d opened with %d bytes of early data' % (session_id, str(req.DST_ADDR), req.DST_PORT, len(early_data)))
+		asyncio.ensure_future(self.watch_open_early(session_id))
+
+	async def watch_open_early(self, session_id):
+		"""
+		The client was already told it is connected. A failed connect is closed by the agent,
+		without any answer the client socket is closed here and handle_client_in ends the session.
+		"""
+		reply = await self.wait_open_result(session_id)
+		if reply == SOCKS5ReplyType.SUCCEEDED:
+			return
+		if reply is not None:
+			logger.debug('Session %d could not connect: %s' % (session_id, reply.name))
+			return
+		if session_id in self.windows:
+			#wakes up handle_client_in if it waits for credit
+			self.windows[session_id].close()
+		if session_id in self.sessions:
+			self.sessions.pop(session_id).close()
+
+	async def handle_client_in(self,session_id,  reader, port = None):
+		compression = CompressionVerdict() #marks the session if the relayed data does not compress (eg. TLS)
+		priority = SessionPriority(self.priority_rules, port) #port is only known if the handshake was done here
+		window = self.windows.get(session_id)
+		sizer = ReadSizer()
+		self.read_sizers[session_id] = sizer
 		while True:
 			try:
-				data = await reader.read(4096)
+				read_size = sizer.size
+				if window is not None:
+					#out of credit: stop reading, the socket buffers fill up and the client slows down
+					if not await window.wait_for_credit():
+						raise Exception('Session closed')
+					read_size = min(read_size, window.send_credit)
+				data = await reader.read(read_size)
+				sizer.observe(len(data), read_size)
+				if window is not None:
+					window.consume(len(data))
+			except Exception as e:
+				logger.debug('handle_client_in read error %s' % e)
+				data = b''
+			
+			try:
+				if data != b'':
+					await self.send_data(Socks5Packet(session_id, data, compression, priority))
 				if data == b'' or reader.at_eof():
-					await self.send_data(Socks5Packet(session_id, None).to_json())
-					try:
-						self.sessions[session_id].close()
-					except:
-						pass
-					if session_id in self.sessions:
-						del self.sessions[session_id]
+					logger.debug('Session %d closed, reads: %s' % (session_id, sizer.to_dict()))
+					await self.end_session(session_id, priority)
 					return
-				else:
-					await self.send_data(Socks5Packet(session_id, data).to_json())
 			except Exception as e:
 				logger.exception('handle_client_in')
+				self.read_sizers.pop(session_id, None)
 				return
 
 
 	async def handle_client(self, reader, writer):
+		handed_over = False #once the SessionWriter runs it closes the socket
 		try:
 			logger.debug('Client connected from %s:%d' % ( writer.get_extra_info('peername')))
+			req = None
+			if self.local_handshake:
+				async def send(data):
+					writer.write(data)
+					await writer.drain()
+				req = await socks5_handshake(reader, send, SOCKS5Session())
+				if req is None:
+					return
 			#creating new session
-			session_id = str(uuid.uuid4())
-			self.sessions[session_id] = writer
-			asyncio.ensure_future(self.handle_client_in(session_id, reader))
+			#out_queue picks the websocket of the session and the ids that can be reused on it
+			session_id = self.out_queue.open_session(self.job_id, self.session_ids)
+			session_writer = SessionWriter(session_id, writer, self.buffer_bytes, lambda n: self.data_delivered(session_id, n))
+			self.sessions[session_id] = session_writer
+			if self.initial_window is not None:
+				self.windows[session_id] = FlowWindow(self.initial_window)
+			if req is not None and self.early_data and req.CMD == SOCKS5Command.CONNECT:
+				await self.open_session_early(session_id, req, reader, writer)
+			elif req is not None and not await self.open_session(session_id, req, writer):
+				await self.end_session(session_id)
+				handed_over = True
+				await session_writer.run()
+				return
+			handed_over = True
+			asyncio.ensure_future(session_writer.run())
+			asyncio.ensure_future(self.handle_client_in(session_id, reader, req.DST_PORT if req is not None else None))
+			return
+		except asyncio.TimeoutError:
+			logger.debug('Client did not finish the socks5 handshake in time')
 			return
 		except Exception as e:
 			logger.exception('handle_client')
 			return
+		finally:
+			if not handed_over:
+				writer.close()
 
 	async def run(self):
 		asyncio.ensure_future(self.handle_client_out())
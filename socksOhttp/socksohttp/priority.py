@@ -0,0 +1,74 @@
+import enum
+
+class Priority(enum.IntEnum):
+	"""
+	Traffic classes of the outgoing frames, the websocket writer always sends the lower values first
+	"""
+	CONTROL = 0 #job setup, window updates
+	INTERACTIVE = 1 #ssh, rdp, new connections
+	BULK = 2 #downloads, uploads
+
+class PriorityRules:
+	"""
+	How the sessions are classified.
+	A session to one of the interactive_ports or bulk_ports keeps that class. Every other session starts
+	as interactive, so connection setup is fast, and becomes bulk once it has sent bulk_after bytes with an
+	average packet size of at least small_packet. It goes back to interactive when its packets get small again.
+	"""
+	def __init__(self, interactive_ports = [22, 23, 53, 3389, 5900], bulk_ports = [], small_packet = 512, bulk_after = 256*1024):
+		self.interactive_ports = set(interactive_ports)
+		self.bulk_ports = set(bulk_ports)
+		self.small_packet = small_packet
+		self.bulk_after = bulk_after
+
+	def to_dict(self):
+		t = {}
+		t['interactive_ports'] = sorted(self.interactive_ports)
+		t['bulk_ports'] = sorted(self.bulk_ports)
+		t['small_packet'] = self.small_packet
+		t['bulk_after'] = self.bulk_after
+		return t
+
+	@staticmethod
+	def parse_ports(s):
+		"""
+		Comma separated port list from the command line
+		"""
+		if s is None or s == '':
+			return []
+		return [int(x) for x in s.split(',')]
+
+class SessionPriority:
+	"""
+	Class of one session, kept next to its CompressionVerdict and updated with the size of every packet it sends.
+	"""
+	def __init__(self, rules = None, port = None):
+		self.rules = rules if rules is not None else PriorityRules()
+		self.fixed = None
+		self.priority = Priority.INTERACTIVE
+		self.total = 0
+		self.avg_size = 0
+		if port is not None:
+			self.set_port(port)
+
+	def set_port(self, port):
+		if port in self.rules.interactive_ports:
+			self.fixed = Priority.INTERACTIVE
+		elif port in self.rules.bulk_ports:
+			self.fixed = Priority.BULK
+		else:
+			self.fixed = None
+		if self.fixed is not None:
+			self.priority = self.fixed
+
+	def observe(self, size):
+		self.total += size
+		#moving average over roughly the last 8 packets
+		self.avg_size += (size - self.avg_size) / 8
+		if self.fixed is not None:
+			return self.priority
+		if self.avg_size < self.rules.small_packet:
+			self.priority = Priority.INTERACTIVE
+		elif self.total >= self.rules.bulk_after:
+			self.priority = Priority.BULK
+		return self.priority
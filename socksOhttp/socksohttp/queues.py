@@ -0,0 +1,180 @@
+import time
+import asyncio
+from collections import deque
+
+class ByteQueue:
+	"""
+	asyncio.Queue lookalike that is bounded by the size of its items in bytes instead of their count.
+	put waits while the queue holds max_bytes or more, so a producer reading a socket stops reading it.
+	put_nowait never waits, it is meant for small control messages that must not get stuck behind data.
+	An item bigger than max_bytes still goes into an empty queue. max_bytes None means unbounded.
+	"""
+	def __init__(self, max_bytes = None, sizeof = len, name = 'queue'):
+		self.max_bytes = max_bytes
+		self.sizeof = sizeof
+		self.name = name
+		self.items = deque()
+		self.size = 0
+		self.not_empty = asyncio.Event()
+		self.not_full = asyncio.Event()
+		self.not_full.set()
+
+		self.high_watermark = 0
+		self.total_bytes = 0
+		self.full_waits = 0
+		self.full_time = 0.0
+
+	def qsize(self):
+		return len(self.items)
+
+	def empty(self):
+		return len(self.items) == 0
+
+	def full(self):
+		return self.max_bytes is not None and self.size >= self.max_bytes
+
+	def put_nowait(self, item):
+		item_size = self.sizeof(item)
+		self.items.append((item, item_size))
+		self.size += item_size
+		self.total_bytes += item_size
+		if self.size > self.high_watermark:
+			self.high_watermark = self.size
+		if self.full():
+			self.not_full.clear()
+		self.not_empty.set()
+
+	async def put(self, item):
+		if self.full():
+			self.full_waits += 1
+			start = time.monotonic()
+			while self.full():
+				self.not_full.clear()
+				await self.not_full.wait()
+			self.full_time += time.monotonic() - start
+		self.put_nowait(item)
+
+	def get_nowait(self):
+		if len(self.items) == 0:
+			raise asyncio.QueueEmpty()
+		item, item_size = self.items.popleft()
+		self.size -= item_size
+		if not self.full():
+			self.not_full.set()
+		if len(self.items) == 0:
+			self.not_empty.clear()
+		return item
+
+	async def get(self):
+		while len(self.items) == 0:
+			self.not_empty.clear()
+			await self.not_empty.wait()
+		return self.get_nowait()
+
+	def to_dict(self):
+		t = {}
+		t['name'] = self.name
+		t['items'] = self.qsize()
+		t['bytes'] = self.size
+		t['max_bytes'] = self.max_bytes
+		t['high_watermark'] = self.high_watermark
+		t['total_bytes'] = self.total_bytes
+		t['full_waits'] = self.full_waits
+		t['full_time'] = self.full_time
+		return t
+
+class DRRQueue(ByteQueue):
+	"""
+	ByteQueue that keeps a FIFO per flow (eg. per session, flowof returns the key of an item) and serves them deficit round robin.
+	Every time a flow gets its turn it may send quantum more bytes, so a bulk transfer can not starve a
+	session that only sends a little now and then: that one gets out within one round.
+	Only flows that already have queued data wait in put when the queue is full, a flow that is empty can
+	always add one item. Memory stays bounded by max_bytes plus one item per flow.
+	"""
+	def __init__(self, max_bytes = None, sizeof = len, flowof = id, quantum = 16*1024, name = 'queue'):
+		ByteQueue.__init__(self, max_bytes, sizeof, name)
+		self.flowof = flowof
+		self.quantum = quantum
+		self.flows = {} #key -> deque of (item, size)
+		self.deficit = {} #key -> bytes the flow may still send in this round
+		self.active = deque() #keys of the flows that have data, the first one is being served
+		self.count = 0
+		self.rounds = 0
+
+	def qsize(self):
+		return self.count
+
+	def empty(self):
+		return self.count == 0
+
+	def put_nowait(self, item):
+		key = self.flowof(item)
+		item_size = self.sizeof(item)
+		if key not in self.flows:
+			self.flows[key] = deque()
+			self.deficit[key] = self.quantum if len(self.active) == 0 else 0
+			self.active.append(key)
+		self.flows[key].append((item, item_size))
+		self.count += 1
+		self.size += item_size
+		self.total_bytes += item_size
+		if self.size > self.high_watermark:
+			self.high_watermark = self.size
+		if self.full():
+			self.not_full.clear()
+		self.not_empty.set()
+
+	async def put(self, item):
+		key = self.flowof(item)
+		if self.full() and key in self.flows:
+			self.full_waits += 1
+			start = time.monotonic()
+			while self.full() and key in self.flows:
+				self.not_full.clear()
+				await self.not_full.wait()
+			self.full_time += time.monotonic() - start
+		self.put_nowait(item)
+
+	def get_nowait(self):
+		if self.count == 0:
+			raise asyncio.QueueEmpty()
+		while True:
+			key = self.active[0]
+			flow = self.flows[key]
+			item, item_size = flow[0]
+			if item_size <= self.deficit[key]:
+				break
+			#out of credit, the next flow gets its turn and its quantum
+			self.active.rotate(-1)
+			self.deficit[self.active[0]] += self.quantum
+			self.rounds += 1
+
+		flow.popleft()
+		self.deficit[key] -= item_size
+		if len(flow) == 0:
+			#an idle flow does not keep its credit
+			del self.flows[key]
+			del self.deficit[key]
+			self.active.popleft()
+			if len(self.active) > 0:
+				self.deficit[self.active[0]] += self.quantum
+		self.count -= 1
+		self.size -= item_size
+		#an empty flow may be waiting too, wake everyone up and let them check
+		self.not_full.set()
+		if self.count == 0:
+			self.not_empty.clear()
+		return item
+
+	async def get(self):
+		while self.count == 0:
+			self.not_empty.clear()
+			await self.not_empty.wait()
+		return self.get_nowait()
+
+	def to_dict(self):
+		t = ByteQueue.to_dict(self)
+		t['flows'] = len(self.flows)
+		t['quantum'] = self.quantum
+		t['rounds'] = self.rounds
+		return t
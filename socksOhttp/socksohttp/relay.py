@@ -0,0 +1,267 @@
+import asyncio
+import logging
+
+from .buffers import ReadSizer, READ_SIZE_MAX
+
+class Relay:
+	"""
+	Connects two endpoints and passes the data between them, it replaces AioTCPProxy.
+	The sockets are asyncio protocols, so there is no task and no wait_for per read: the event loop
+	calls the endpoint with the data, the endpoint hands it to its peer. When a transport has too much
+	to write (pause_writing) its peer stops reading until it went out (resume_writing).
+	Idle connections are closed by one timer per relay, it is only moved when it fires.
+	The relay closes both sides once one of them is closed, what is already buffered still goes out.
+	"""
+	def __init__(self, name = '[Relay]', logger = None, timeout = 60):
+		self.name = name
+		self.logger = logger
+		self.timeout = timeout #seconds without data in either direction, None means no timeout
+		self.closed = asyncio.Event()
+		self.endpoints = []
+		self.loop = asyncio.get_event_loop()
+		self.last_activity = self.loop.time()
+		self.timer = None
+
+		if not self.logger:
+			self.logger = logging.getLogger()
+
+	def connect(self, endpoint1, endpoint2):
+		endpoint1.peer = endpoint2
+		endpoint2.peer = endpoint1
+		self.endpoints = [endpoint1, endpoint2]
+		for endpoint in self.endpoints:
+			endpoint.relay = self
+		if self.timeout is not None:
+			self.timer = self.loop.call_later(self.timeout, self.check_idle)
+		for endpoint in self.endpoints:
+			endpoint.start()
+
+	def touch(self):
+		self.last_activity = self.loop.time()
+
+	def check_idle(self):
+		idle = self.loop.time() - self.last_activity
+		if idle < self.timeout:
+			self.timer = self.loop.call_later(self.timeout - idle, self.check_idle)
+			return
+		self.logger.debug('%s No data for %d seconds, closing!' % (self.name, self.timeout))
+		self.close()
+
+	def close(self):
+		if self.closed.is_set():
+			return
+		self.closed.set()
+		if self.timer is not None:
+			self.timer.cancel()
+		for endpoint in self.endpoints:
+			endpoint.close()
+		self.logger.debug('%s Closed! %s' % (self.name, self.to_dict()))
+
+	def to_dict(self):
+		t = {}
+		t['name'] = self.name
+		t['endpoints'] = [endpoint.to_dict() for endpoint in self.endpoints]
+		return t
+
+class SocketEndpoint(asyncio.BufferedProtocol):
+	"""
+	Socket side of a relay. Reads into one preallocated buffer, the read size is picked by a ReadSizer.
+	The buffer is reused, so the peer gets a copy of exactly what was read.
+	Data that arrives before the relay is connected is kept and reading is paused until then.
+	"""
+	def __init__(self, max_read = READ_SIZE_MAX, name = 'socket'):
+		self.name = name
+		self.sizer = ReadSizer(max_size = max_read)
+		self.buffer = memoryview(bytearray(max_read))
+		self.transport = None
+		self.peer = None
+		self.relay = None
+		self.pending = [] #read before the relay was connected
+		self.eof = False
+		self.total_in = 0
+		self.total_out = 0
+		self.write_pauses = 0
+		self.streams = None #set by from_stream
+
+	@staticmethod
+	def from_stream(reader, writer, max_read = READ_SIZE_MAX, name = 'socket'):
+		"""
+		Takes over the connection of an asyncio stream pair, eg. after a handshake was done with the streams.
+		What the StreamReader already buffered is passed on first.
+		"""
+		endpoint = SocketEndpoint(max_read, name)
+		transport = writer.transport
+		#StreamReader has no public way to hand over what it buffered without waiting
+		if len(reader._buffer) > 0:
+			endpoint.pending.append(bytes(reader._buffer))
+			reader._buffer.clear()
+		endpoint.eof = reader.at_eof()
+		#newer pythons close the transport when the StreamWriter is garbage collected
+		endpoint.streams = (reader, writer)
+		transport.set_protocol(endpoint)
+		endpoint.connection_made(transport)
+		return endpoint
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def get_buffer(self, sizehint):
+		return self.buffer[:self.sizer.size]
+
+	def buffer_updated(self, nbytes):
+		self.sizer.observe(nbytes)
+		self.total_in += nbytes
+		data = bytes(self.buffer[:nbytes])
+		if self.relay is None:
+			self.pending.append(data)
+			self.transport.pause_reading()
+			return
+		self.relay.touch()
+		self.peer.write(data)
+
+	def eof_received(self):
+		self.eof = True
+		if self.relay is not None:
+			self.relay.close()
+
+	def connection_lost(self, exc):
+		self.eof = True
+		if self.relay is not None:
+			self.relay.close()
+
+	def pause_writing(self):
+		#our socket does not take more, the peer stops reading
+		self.write_pauses += 1
+		if self.peer is not None:
+			self.peer.pause_reading()
+
+	def resume_writing(self):
+		if self.peer is not None:
+			self.peer.resume_reading()
+
+	def start(self):
+		for data in self.pending:
+			self.peer.write(data)
+		self.pending = []
+		if self.eof or self.transport.is_closing():
+			self.relay.close()
+			return
+		self.resume_reading()
+
+	def pause_reading(self):
+		if not self.transport.is_closing():
+			self.transport.pause_reading()
+
+	def resume_reading(self):
+		if not self.transport.is_closing() and not self.transport.is_reading():
+			self.transport.resume_reading()
+
+	def write(self, data):
+		if self.transport.is_closing():
+			return
+		self.total_out += len(data)
+		self.transport.write(data)
+
+	def close(self):
+		#the transport sends what it still has before closing the socket
+		self.transport.close()
+
+	def to_dict(self):
+		t = {}
+		t['name'] = self.name
+		t['in'] = self.total_in
+		t['out'] = self.total_out
+		t['write_pauses'] = self.write_pauses
+		t['reads'] = self.sizer.to_dict()
+		return t
+
+class StreamEndpoint:
+	"""
+	Relay endpoint for an asyncio.StreamReader/StreamWriter lookalike pair that is not a socket,
+	eg. the FakeStreamReader/FakeStreamWriter of a tunneled session.
+	Writes are buffered by the writer and sent by a task, the peer stops reading while more than
+	high_water bytes wait in it. This side stops reading while the peer's socket does not take more.
+	"""
+	def __init__(self, reader, writer, high_water = READ_SIZE_MAX, name = 'stream'):
+		self.name = name
+		self.reader = reader
+		self.writer = writer
+		self.high_water = high_water
+		self.peer = None
+		self.relay = None
+		self.can_read = asyncio.Event()
+		self.can_read.set()
+		self.has_data = asyncio.Event()
+		self.peer_paused = False
+		self.is_closing = False
+		self.read_task = None
+		self.total_in = 0
+		self.total_out = 0
+
+	def start(self):
+		self.read_task = asyncio.ensure_future(self.read_stream())
+		asyncio.ensure_future(self.write_stream())
+
+	async def read_stream(self):
+		try:
+			while True:
+				if not self.can_read.is_set():
+					await self.can_read.wait()
+				data = await self.reader.read(self.high_water)
+				if data == b'':
+					break
+				self.total_in += len(data)
+				self.relay.touch()
+				self.peer.write(data)
+		except asyncio.CancelledError:
+			return
+		except Exception as e:
+			self.relay.logger.debug('%s %s read error %s' % (self.relay.name, self.name, e))
+		self.relay.close()
+
+	async def write_stream(self):
+		try:
+			while True:
+				if len(self.writer.buffer) == 0:
+					if self.is_closing:
+						break
+					self.has_data.clear()
+					await self.has_data.wait()
+					continue
+				await self.writer.drain()
+				if self.peer_paused and len(self.writer.buffer) < self.high_water:
+					self.peer_paused = False
+					self.peer.resume_reading()
+			#everything is sent, this closes the other side
+			self.writer.write(b'')
+			await self.writer.drain()
+		except Exception as e:
+			self.relay.logger.debug('%s %s write error %s' % (self.relay.name, self.name, e))
+			self.relay.close()
+
+	def pause_reading(self):
+		self.can_read.clear()
+
+	def resume_reading(self):
+		self.can_read.set()
+
+	def write(self, data):
+		self.total_out += len(data)
+		self.writer.write(data)
+		if not self.peer_paused and len(self.writer.buffer) >= self.high_water:
+			self.peer_paused = True
+			self.peer.pause_reading()
+		self.has_data.set()
+
+	def close(self):
+		self.is_closing = True
+		self.has_data.set()
+		if self.read_task is not None and not self.read_task.done() and self.read_task is not asyncio.current_task():
+			self.read_task.cancel()
+
+	def to_dict(self):
+		t = {}
+		t['name'] = self.name
+		t['in'] = self.total_in
+		t['out'] = self.total_out
+		return t
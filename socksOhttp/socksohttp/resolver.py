@@ -0,0 +1,110 @@
+import socket
+import asyncio
+import ipaddress
+from collections import OrderedDict
+
+DNS_TTL = 60 #seconds a resolved name is kept, getaddrinfo does not tell the real TTL
+DNS_NEGATIVE_TTL = 10 #seconds a failed lookup is kept
+DNS_MAX_ENTRIES = 1024
+
+class DNSEntry:
+	def __init__(self, addresses, error, expires):
+		self.addresses = addresses #list of IP address strings, in the order getaddrinfo returned them
+		self.error = error #the exception of a failed lookup, it is raised again on a hit
+		self.expires = expires
+
+class DNSCache:
+	"""
+	Async resolver of the agent with a cache in front of it, so the sessions to the same hosts do not
+	all wait for a getaddrinfo in the default executor.
+	Entries expire after ttl seconds, failed lookups are cached for negative_ttl seconds.
+	The least recently used entry is dropped when there are more than max_entries.
+	Lookups of a name that is being resolved wait for that lookup instead of starting another one.
+	"""
+	def __init__(self, ttl = DNS_TTL, negative_ttl = DNS_NEGATIVE_TTL, max_entries = DNS_MAX_ENTRIES):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.max_entries = max_entries
+		self.entries = OrderedDict() #hostname -> DNSEntry, the least recently used first
+		self.in_flight = {} #hostname -> task of the running lookup
+
+		self.lookups = 0
+		self.hits = 0
+		self.negative_hits = 0
+		self.coalesced = 0
+		self.misses = 0
+		self.evictions = 0
+
+	async def resolve(self, hostname):
+		"""
+		:return: list of IP address strings, raises the error of the lookup if it failed
+		"""
+		try:
+			ipaddress.ip_address(hostname)
+			return [hostname]
+		except ValueError:
+			pass
+
+		self.lookups += 1
+		hostname = hostname.lower()
+		loop = asyncio.get_event_loop()
+		entry = self.entries.get(hostname)
+		if entry is not None:
+			if entry.expires > loop.time():
+				self.entries.move_to_end(hostname)
+				if entry.error is not None:
+					self.negative_hits += 1
+					raise socket.gaierror(*entry.error.args)
+				self.hits += 1
+				return entry.addresses
+			del self.entries[hostname]
+
+		if hostname in self.in_flight:
+			self.coalesced += 1
+		else:
+			self.misses += 1
+			task = asyncio.ensure_future(self.lookup(hostname))
+			#marks a failed lookup as retrieved, there might be nobody waiting for it anymore
+			task.add_done_callback(lambda t: t.cancelled() or t.exception())
+			self.in_flight[hostname] = task
+		#every caller is shielded, one that is cancelled (eg. by a timeout) does not cancel the lookup of the others
+		return await asyncio.shield(self.in_flight[hostname])
+
+	async def lookup(self, hostname):
+		"""
+		Runs in its own task, the result or the error is cached for the callers that come later
+		"""
+		loop = asyncio.get_event_loop()
+		try:
+			infos = await loop.getaddrinfo(hostname, None, type = socket.SOCK_STREAM)
+			addresses = []
+			for info in infos:
+				if info[4][0] not in addresses:
+					addresses.append(info[4][0])
+			self.add(hostname, DNSEntry(addresses, None, loop.time() + self.ttl))
+			return addresses
+		except socket.gaierror as e:
+			self.add(hostname, DNSEntry(None, e, loop.time() + self.negative_ttl))
+			raise
+		finally:
+			#other errors are not an answer of the resolver, nothing is cached for them
+			del self.in_flight[hostname]
+
+	def add(self, hostname, entry):
+		self.entries[hostname] = entry
+		self.entries.move_to_end(hostname)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last = False)
+			self.evictions += 1
+
+	def to_dict(self):
+		t = {}
+		t['entries'] = len(self.entries)
+		t['lookups'] = self.lookups
+		t['hits'] = self.hits
+		t['negative_hits'] = self.negative_hits
+		t['coalesced'] = self.coalesced
+		t['misses'] = self.misses
+		t['evictions'] = self.evictions
+		t['hit_rate'] = (self.hits + self.negative_hits + self.coalesced) / self.lookups if self.lookups > 0 else 0.0
+		return t
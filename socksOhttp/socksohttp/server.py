@@ -17,20 +17,31 @@ class CommsClient:
 	"""
 	Class handles the client job communications
 	"""
-	def __init__(self, client_uuid, in_queue, out_queue):
+	def __init__(self, client_uuid, in_queue, out_queue, wire_format = WireFormat.BINARY, channel = None, priority_rules = None, early_data = False):
 		self.client_uuid = client_uuid
+		self.priority_rules = priority_rules
+		self.early_data = early_data
+		self.wire_format = wire_format
+		self.channel = channel
 		self.connected_at = datetime.utcnow()
 		self.last_seen_at = None
 		
 		self.in_queue = in_queue
-		self.out_queue = out_queue
+		self.out_queue = out_queue #StripedSink of the websockets, the modules send their data straight into it
 
 		self.interface_queue = asyncio.Queue()
 
 		self.jobs = {} #jobid -> job_in_queue
-		self.job_cmd_queue = asyncio.Queue()
+		self.socks5_jobs = {} #jobid -> Socks5ModuleServer, for the session stats of the keepalive
+		self.job_cmd_queue = asyncio.Queue() #job control messages
 		self.pending_jobs = {}
 
+	def queue_stats(self):
+		return [stripe.out_queue.to_dict() for stripe in self.out_queue.stripes]
+
+	def session_stats(self):
+		return {job_id : module.session_stats() for job_id, module in self.socks5_jobs.items()}
+
 	async def create_job(self, module_name):
 		logger.debug('Creating job for module %s' % repr(module_name))
 		self.pending_jobs[module_name] = 1
@@ -46,14 +57,15 @@ class CommsClient:
 		del self.pending_jobs[rply.job_name]
 		if rply.job_name == 'echo':
 			in_queue = asyncio.Queue()
-			ems = EchoModuleServer(rply.job_id, in_queue, self.job_cmd_queue)
+			ems = EchoModuleServer(rply.job_id, in_queue, self.out_queue)
 			self.jobs[rply.job_id] = in_queue
 			asyncio.ensure_future(ems.run())
 
 		elif rply.job_name == 'socks5':
 			in_queue = asyncio.Queue()
-			ems = Socks5ModuleServer(rply.job_id, in_queue, self.job_cmd_queue)
+			ems = Socks5ModuleServer(rply.job_id, in_queue, self.out_queue, initial_window = self.channel.initial_window, priority_rules = self.priority_rules, local_handshake = self.channel.session_open, early_data = self.early_data)
 			self.jobs[rply.job_id] = in_queue
+			self.socks5_jobs[rply.job_id] = ems
 			asyncio.ensure_future(ems.run())
 
 		else:
@@ -81,8 +93,7 @@ class CommsClient:
 	async def listen_cmds(self):
 		while True:
 			cmd = await self.job_cmd_queue.get()
-			cmd.client_uuid = self.client_uuid
-			await self.out_queue.put(cmd)
+			self.out_queue.put_nowait(cmd)
 
 	async def run(self):
 		asyncio.ensure_future(self.listen_rplys())
@@ -94,10 +105,19 @@ class CommsClient:
 
 
 class CommsServer:
-	def __init__(self, ws_ip, ws_port, with_proxyjs = False):
+	def __init__(self, ws_ip, ws_port, with_proxyjs = False, wire_format = WireFormat.BINARY, with_encryption = False, compression_level = None, auto_level = True, initial_window = 256*1024, queue_bytes = QUEUE_MAX_BYTES, quantum = DRR_QUANTUM, priority_rules = None, early_data = False):
 		self.ws_server = None
 		self.ws_ip = ws_ip
 		self.ws_port = ws_port
+		self.wire_format = wire_format #JSON stops offering the binary format to the agents
+		self.with_encryption = with_encryption
+		self.compression_level = compression_level
+		self.auto_level = auto_level
+		self.initial_window = initial_window #flow control window of the sessions, None turns it off
+		self.queue_bytes = queue_bytes #bound of the outgoing queues of each client, None makes them unbounded
+		self.quantum = quantum #DRR quantum of the outgoing scheduler
+		self.priority_rules = priority_rules #PriorityRules of the sessions, None means the defaults
+		self.early_data = early_data #SOCKS clients are answered before the agent connected, their first bytes go with the connect request
 
 		self.with_proxyjs = with_proxyjs
 
@@ -117,7 +137,7 @@ class CommsServer:
 			try:
 				pong_waiter = await ws.ping()
 				await asyncio.wait_for(pong_waiter, timeout=self.client_timeout)
-				logger.debug('Client still alive!')
+				logger.debug('Client still alive! %s Stripes: %s Queues: %s Sessions: %s' % (client.channel.seq.to_dict(), client.out_queue.to_dict(), client.queue_stats(), client.session_stats()))
 				await asyncio.sleep(self.client_ping_interval)
 			except asyncio.TimeoutError:
 				logger.info('Client timed out, dropping client!')
@@ -136,9 +156,16 @@ class CommsServer:
 			client_uuid = str(uuid.uuid4())
 			rc = RegisterCmd()
 			rc.client_uuid = client_uuid
+			rc.with_encryption = self.with_encryption
+			rc.compression_level = self.compression_level
+			rc.auto_level = self.auto_level
+			rc.initial_window = self.initial_window
+			if self.wire_format == WireFormat.JSON:
+				rc.capabilities['wire_formats'] = ['json']
 			msg = ClientCmd()
 			msg.uuid = str(uuid.uuid4())
 			msg.cmd = rc
+			msg.wire_format = WireFormat.JSON #every agent can read this, the agent picks the format for the rest
 			data = msg.to_msg()
 
 			await ws.send(data)
@@ -151,44 +178,93 @@ class CommsServer:
 			if cr.rply.client_uuid != client_uuid:
 				raise Exception('Client returned different uuid! %s' % str(client_uuid))
 			
-			logger.debug('Client registered! %s' % client_uuid)
+			rc.check_options(cr.rply)
+			if self.with_encryption and not cr.rply.with_encryption:
+				logger.warning('Client %s does not support encryption, falling back to plaintext!' % client_uuid)
+			if rc.compression_level is not None and cr.rply.compression_level is None:
+				logger.warning('Client %s does not support stream compression!' % client_uuid)
+			
+			if cr.rply.join is not None and cr.rply.join not in self.clients:
+				raise Exception('Client wants to join an unknown client! %s' % cr.rply.join)
+			
+			logger.debug('Client registered! %s Protocol version: %d Options: %s' % (client_uuid, cr.rply.protocol_version, cr.rply.to_dict()))
+			wire_format = WireFormat.BINARY if cr.rply.wire_format == 'binary' else WireFormat.JSON
+			compression_level = self.compression_level if cr.rply.compression_level is not None else None
+			channel = CommsChannel(client_uuid, ModuleDesignation.SERVER, cr.rply.with_encryption, cr.rply.cipher_suite, compression_level, self.auto_level, cr.rply.batching, cr.rply.initial_window, cr.rply.session_open)
+			client_out_queue = FrameSink(client_uuid, self.queue_bytes, self.quantum)
+
+			if cr.rply.join is not None:
+				#additional websocket of an agent that is already registered
+				cc = self.clients[cr.rply.join]
+				stripe = Stripe(client_uuid, cc.in_queue, client_out_queue, wire_format, channel)
+				cc.out_queue.add(stripe)
+				logger.debug('Client %s opened a new stripe, now has %d' % (cc.client_uuid, len(cc.out_queue.stripes)))
+				return cc, stripe
+
 			client_in_queue = asyncio.Queue()
-			client_out_queue = asyncio.Queue()
-			cc = CommsClient(client_uuid, client_in_queue, client_out_queue)
+			stripe = Stripe(client_uuid, client_in_queue, client_out_queue, wire_format, channel)
+			stripes = StripedSink(client_uuid)
+			stripes.add(stripe)
+			cc = CommsClient(client_uuid, client_in_queue, stripes, wire_format, channel, self.priority_rules, self.early_data)
 			self.clients[client_uuid] = cc
 			self.sessions[client_uuid] = ws
 			asyncio.ensure_future(self.keepalive(ws, cc))
-			return cc
+			return cc, stripe
 
 
 
 		except Exception as e:
 			logger.exception('Client from %s:%d failed to register!' % ws.remote_address)
+			return None, None
 
 	async def handle_client_out(self, ws, client):
 		while True:
-			cmd = await client.out_queue.get()
-			msg = ClientCmd()
-			msg.uuid = str(uuid.uuid4())
-			msg.cmd = cmd
-			data = msg.to_msg()
+			cmds = await get_batch(client.out_queue)
+			if client.wire_format == WireFormat.BINARY and client.channel.batching:
+				#everything that is pending goes out in one message
+				data = ClientCmd.batch_to_msg(cmds, client.channel)
+				await ws.send(data)
+				continue
 
-			await ws.send(data)
+			for cmd in cmds:
+				msg = ClientCmd()
+				msg.cmd = cmd
+				msg.wire_format = client.wire_format
+				data = msg.to_msg(client.channel)
+
+				await ws.send(data)
 
 
 	async def handle_client_in(self, ws, client):
 		while True:
-			msg = await ws.recv()
-			cr = ClientRply.from_msg(msg)
-			cmd_uuid = cr.uuid
-			await client.in_queue.put(cr.rply)
+			try:
+				msg = await ws.recv()
+			except websockets.exceptions.ConnectionClosed:
+				if client.draining:
+					#the agent closed a stripe it did not need anymore
+					return
+				raise
+			for cr in ClientRply.from_batch(msg, client.channel.with_encryption, channel = client.channel):
+				if isinstance(cr.rply, StripeRply):
+					#the agent wants to close this websocket
+					asyncio.ensure_future(client.group.drain(client))
+					continue
+				await client.in_queue.put(cr.rply)
 
 	
 	async def handle_client(self, ws, path):
 		logger.debug('Client connected from %s:%d' % ws.remote_address)
-		cc = await self.register_client(ws)
-		asyncio.ensure_future(self.handle_client_in(ws, cc))
-		asyncio.ensure_future(self.handle_client_out(ws, cc))
+		cc, stripe = await self.register_client(ws)
+		if cc is None:
+			return
+		stripe.tasks.append(asyncio.ensure_future(self.handle_client_in(ws, stripe)))
+		stripe.tasks.append(asyncio.ensure_future(self.handle_client_out(ws, stripe)))
+		if stripe.client_uuid != cc.client_uuid:
+			#additional stripe, it lives until the agent closes it
+			await ws.wait_closed()
+			cc.out_queue.remove(stripe)
+			logger.debug('Client %s closed a stripe, now has %d' % (cc.client_uuid, len(cc.out_queue.stripes)))
+			return
 		asyncio.ensure_future(cc.run())
 
 		
@@ -27,6 +27,7 @@ html_data = """
 			var agent_url = document.getElementById('agent_url').value;
 
 			var ws_agent = new WebSocket(agent_url);
+			ws_agent.binaryType = 'arraybuffer';
 
 			ws_agent.onopen = function(event) {
 				var label = document.getElementById('agentstatus');
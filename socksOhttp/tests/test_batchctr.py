@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from socksohttp.AES import AESModeOfOperationCTR, AESModeOfOperationBatchCTR, Counter
+from socksohttp.AES import batchctr
+
+#NIST SP800-38A F.5.1 CTR-AES128.Encrypt
+KEY = bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c')
+COUNTER = bytes.fromhex('f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff')
+PLAINTEXT = bytes.fromhex('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e5130c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710')
+CIPHERTEXT = bytes.fromhex('874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff5ae4df3edbd5d35e5b4f09020db03eab1e031dda2fbe03d1792170a0f3009cee')
+
+@pytest.fixture(params = [False, True], ids = ['int', 'numpy'])
+def use_numpy(request):
+	if request.param and batchctr.numpy is None:
+		pytest.skip('numpy is not installed')
+	return request.param
+
+def reference(key, iv):
+	return AESModeOfOperationCTR(key, Counter(int.from_bytes(iv, byteorder = 'big')))
+
+def encrypt_chunked(cipher, data, sizes):
+	out = b''
+	pos = 0
+	i = 0
+	while pos < len(data):
+		size = sizes[i % len(sizes)]
+		out += cipher.encrypt(data[pos:pos+size])
+		pos += size
+		i += 1
+	return out
+
+def test_known_answer(use_numpy):
+	cipher = AESModeOfOperationBatchCTR(KEY, COUNTER, use_numpy = use_numpy)
+	assert cipher.encrypt(PLAINTEXT) == CIPHERTEXT
+	cipher.reset(COUNTER)
+	assert cipher.decrypt(CIPHERTEXT) == PLAINTEXT
+
+@pytest.mark.parametrize('sizes', [[1], [15], [16, 17], [3, 100, 7, 33], [1000]])
+def test_unaligned_chunks(use_numpy, sizes):
+	key = os.urandom(32)
+	iv = os.urandom(16)
+	data = os.urandom(2000)
+	expected = reference(key, iv).encrypt(data)
+	#unused keystream is kept between the calls
+	assert encrypt_chunked(AESModeOfOperationBatchCTR(key, iv, use_numpy = use_numpy), data, sizes) == expected
+
+def test_counter_wraparound(use_numpy):
+	key = os.urandom(16)
+	iv = b'\xff' * 15 + b'\xfd'
+	data = os.urandom(16 * 6 + 5)
+	#the counter rolls over from 2**128 - 1 to 0
+	assert encrypt_chunked(AESModeOfOperationBatchCTR(key, iv, use_numpy = use_numpy), data, [7, 40]) == reference(key, iv).encrypt(data)
+
+def test_reset():
+	cipher = AESModeOfOperationBatchCTR(KEY)
+	first = cipher.encrypt(b'x' * 20)
+	cipher.reset()
+	assert cipher.encrypt(b'x' * 20) == first
+	with pytest.raises(ValueError):
+		cipher.reset(b'short')
@@ -0,0 +1,63 @@
+from socksohttp.buffers import ChunkBuffer, ReadSizer
+
+def test_chunk_buffer_read():
+	buffer = ChunkBuffer()
+	chunk = b'abcdef'
+	buffer.append(chunk)
+	buffer.append(b'')
+	buffer.append(bytearray(b'ghi'))
+	assert len(buffer) == 9
+	assert buffer.read(2) == b'ab'
+	#across chunks
+	assert buffer.read(6) == b'cdefgh'
+	assert buffer.read() == b'i'
+	assert len(buffer) == 0 and buffer.read() == b''
+	#a whole chunk is handed back as it is
+	buffer.append(chunk)
+	assert buffer.read() is chunk
+
+def test_chunk_buffer_view():
+	buffer = ChunkBuffer()
+	buffer.append(b'abc')
+	buffer.append(b'def')
+	view = buffer.read_view(5)
+	assert isinstance(view, memoryview) and bytes(view) == b'abc'
+	assert bytes(buffer.read_view(1)) == b'd'
+	assert len(buffer) == 2
+	buffer.consume(2)
+	assert len(buffer) == 0 and bytes(buffer.read_view()) == b''
+
+def test_chunk_buffer_find():
+	buffer = ChunkBuffer()
+	assert buffer.find(b'\r\n\r\n') == -1
+	for part in [b'HTTP/1.1 200 OK\r', b'\nHost: x\r\n', b'\r\nbody']:
+		buffer.append(part)
+	buffer.read(5)
+	pos = buffer.find(b'\r\n\r\n')
+	assert pos == 19
+	assert buffer.read(pos + 4) == b'1.1 200 OK\r\nHost: x\r\n\r\n'
+	assert buffer.read() == b'body'
+
+def test_read_sizer():
+	sizer = ReadSizer(1024, 8192)
+	#the socket keeps filling the reads: bulk transfer
+	for size in [1024, 2048, 4096, 8192]:
+		assert sizer.size == size
+		sizer.observe(size)
+	assert sizer.size == 8192 and sizer.largest == 8192
+	#short reads bring it back down, but not below min_size
+	for _ in range(5):
+		sizer.observe(10)
+	assert sizer.size == 1024
+	stats = sizer.to_dict()
+	assert stats['grows'] == 3 and stats['shrinks'] == 3 and stats['reads'] == 9
+
+def test_read_sizer_credit():
+	sizer = ReadSizer(1024, 8192)
+	sizer.observe(4096)
+	assert sizer.size == 2048
+	#a read limited by flow control credit that was filled is not a short read
+	sizer.observe(300, 300)
+	assert sizer.size == 2048
+	sizer.observe(300, 2048)
+	assert sizer.size == 1024
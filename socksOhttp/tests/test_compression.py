@@ -0,0 +1,31 @@
+import os
+
+from socksohttp.compression import CompressionVerdict, sample_entropy
+
+def test_sample_entropy():
+	assert sample_entropy(b'') == 0.0
+	assert sample_entropy(b'a' * 5000) == 0.0
+	assert sample_entropy(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n' * 50) < 5
+	assert sample_entropy(os.urandom(64*1024)) > 7.5
+
+def test_verdict_random_data():
+	verdict = CompressionVerdict(max_misses = 4, recheck = 10)
+	data = os.urandom(4096)
+	for _ in range(4):
+		assert verdict.should_compress(data) is False
+	assert verdict.incompressible
+	#skipped until the recheck frame
+	assert [verdict.should_compress(b'text' * 100) for _ in range(10)] == [False] * 9 + [True]
+	#the traffic compresses again
+	verdict.update(400, 20)
+	assert not verdict.incompressible and verdict.misses == 0
+	assert verdict.should_compress(b'text' * 100)
+
+def test_verdict_no_saving():
+	verdict = CompressionVerdict(max_misses = 2)
+	#small frames are not sampled, they are judged by the result of the compression
+	assert verdict.should_compress(b'\x01\x02')
+	verdict.update(100, 99)
+	assert not verdict.incompressible
+	verdict.update(100, 99)
+	assert verdict.incompressible
@@ -0,0 +1,110 @@
+import os
+import uuid
+
+import pytest
+
+from socksohttp import crypto
+from socksohttp.crypto import *
+
+KEY = os.urandom(32)
+NONCE = uuid.uuid4().bytes
+
+def backends():
+	"""
+	native_aes values that can be used here, None is the pure python AES
+	"""
+	t = [None]
+	try:
+		import cryptography
+		t.append('cryptography')
+	except ImportError:
+		pass
+	try:
+		import Crypto.Cipher.AES
+		t.append('pycryptodome')
+	except ImportError:
+		pass
+	return t
+
+def use_backend(monkeypatch, backend):
+	monkeypatch.setattr(crypto, 'native_aes', backend)
+	if backend == 'cryptography':
+		from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+		from cryptography.hazmat.backends import default_backend
+		try:
+			from cryptography.hazmat.decrepit.ciphers.modes import CFB8
+		except ImportError:
+			CFB8 = modes.CFB8
+		for name, value in [('Cipher', Cipher), ('algorithms', algorithms), ('modes', modes), ('default_backend', default_backend), ('CFB8', CFB8)]:
+			monkeypatch.setattr(crypto, name, value, raising = False)
+	if backend == 'pycryptodome':
+		from Crypto.Cipher import AES as CryptoAES
+		monkeypatch.setattr(crypto, 'CryptoAES', CryptoAES, raising = False)
+
+def seal_with(monkeypatch, backend, suite_class, iv, data, aad = b''):
+	use_backend(monkeypatch, backend)
+	return suite_class(KEY, NONCE).seal(iv, data, aad)
+
+def open_with(monkeypatch, backend, suite_class, iv, data, aad = b''):
+	use_backend(monkeypatch, backend)
+	return suite_class(KEY, NONCE).open(iv, data, aad)
+
+@pytest.mark.parametrize('suite_class', [AESCTRSuite, AESCFBSuite])
+@pytest.mark.parametrize('length', [0, 1, 15, 16, 1000])
+def test_backends_interoperate(monkeypatch, suite_class, length):
+	suite = suite_class(KEY, NONCE)
+	iv = suite.get_iv(1, NONCE, 12345)
+	data = os.urandom(length)
+	sealed = [seal_with(monkeypatch, backend, suite_class, iv, data) for backend in backends()]
+	assert all(x == sealed[0] for x in sealed)
+	for backend in backends():
+		assert open_with(monkeypatch, backend, suite_class, iv, sealed[0]) == data
+
+def test_ctr_frames_do_not_share_keystream(monkeypatch):
+	suite = AESCTRSuite(KEY, NONCE)
+	data = b'\x00' * 64
+	#a frame uses more than one block, the blocks of the next frame must not overlap
+	first = seal_with(monkeypatch, None, AESCTRSuite, suite.get_iv(1, NONCE, 1), data)
+	second = seal_with(monkeypatch, None, AESCTRSuite, suite.get_iv(1, NONCE, 2), data)
+	assert first[16:] != second[:48]
+	#the connection key depends on the client uuid
+	assert AESCTRSuite(KEY, NONCE).key != AESCTRSuite(KEY, uuid.uuid4().bytes).key
+
+def test_shake_hmac_xor_paths(monkeypatch):
+	suite = SHAKEHMACSuite(KEY, NONCE)
+	iv = suite.get_iv(0, NONCE, 7)
+	data = os.urandom(1000)
+	sealed = suite.seal(iv, data, b'header')
+	assert len(sealed) == len(data) + suite.tag_size
+	monkeypatch.setattr(crypto, 'numpy', None)
+	assert suite.seal(iv, data, b'header') == sealed
+	assert suite.open(iv, sealed, b'header') == data
+
+def test_shake_hmac_tampered():
+	suite = SHAKEHMACSuite(KEY, NONCE)
+	iv = suite.get_iv(0, NONCE, 7)
+	sealed = suite.seal(iv, b'payload', b'header')
+	assert suite.open(iv, sealed, b'header') == b'payload'
+	for i in [0, len(sealed) - 1]:
+		tampered = bytearray(sealed)
+		tampered[i] ^= 1
+		with pytest.raises(Exception, match = 'authentication'):
+			suite.open(iv, bytes(tampered), b'header')
+	#the header and the iv are authenticated too
+	with pytest.raises(Exception, match = 'authentication'):
+		suite.open(iv, sealed, b'Header')
+	with pytest.raises(Exception, match = 'authentication'):
+		suite.open(suite.get_iv(0, NONCE, 8), sealed, b'header')
+	with pytest.raises(Exception, match = 'authentication'):
+		SHAKEHMACSuite(KEY, uuid.uuid4().bytes).open(iv, sealed, b'header')
+	with pytest.raises(Exception, match = 'too short'):
+		suite.open(iv, sealed[:suite.tag_size - 1])
+
+def test_select_cipher_suite():
+	#the server's order wins among the fast ones
+	assert select_cipher_suite(['shake256-hmac', 'aes-ctr']) == 'shake256-hmac'
+	expected = 'aes-cfb' if AESCFBSuite.accelerated else 'shake256-hmac'
+	assert select_cipher_suite(['aes-cfb', 'shake256-hmac']) == expected
+	assert select_cipher_suite(['unknown', 'aes-cfb']) == 'aes-cfb'
+	with pytest.raises(Exception):
+		select_cipher_suite(['unknown'])
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from socksohttp.modules.socks5 import FakeStreamReader
+
+def make_reader(chunks, eof = True, **kwargs):
+	queue = asyncio.Queue()
+	for chunk in chunks:
+		queue.put_nowait(chunk)
+	if eof:
+		queue.put_nowait(None)
+	reader = FakeStreamReader(queue, **kwargs)
+	asyncio.ensure_future(reader.streamify_input())
+	return reader, queue
+
+def test_read():
+	async def main():
+		consumed = []
+		reader, _ = make_reader([b'abc', b'defgh'], on_consumed = consumed.append)
+		assert await reader.read(0) == b''
+		assert await reader.read(2) == b'ab'
+		#across chunks
+		assert await reader.read(4) == b'cdef'
+		assert await reader.read() == b'gh'
+		assert reader.at_eof() and await reader.read(10) == b''
+		assert consumed == [2, 4, 2]
+	asyncio.run(main())
+
+def test_read_waits_for_data():
+	async def main():
+		reader, queue = make_reader([], eof = False)
+		reading = asyncio.ensure_future(reader.read(100))
+		await asyncio.sleep(0)
+		assert not reading.done()
+		#does not wait for more than what is buffered
+		queue.put_nowait(b'late')
+		assert await asyncio.wait_for(reading, 1) == b'late'
+	asyncio.run(main())
+
+def test_readexactly_across_chunks():
+	async def main():
+		reader, queue = make_reader([b'\x05', b'\x01\x00\x01', b'\x0a\x00'], eof = False)
+		assert await reader.readexactly(1) == b'\x05'
+		assert await reader.readexactly(4) == b'\x01\x00\x01\x0a'
+		reading = asyncio.ensure_future(reader.readexactly(3))
+		await asyncio.sleep(0)
+		assert not reading.done()
+		queue.put_nowait(b'\x00')
+		queue.put_nowait(b'\x01\xbb')
+		assert await asyncio.wait_for(reading, 1) == b'\x00\x00\x01'
+		queue.put_nowait(None)
+		assert await reader.read() == b'\xbb'
+	asyncio.run(main())
+
+def test_readuntil():
+	async def main():
+		reader, _ = make_reader([b'HTTP/1.1 200 OK\r', b'\n', b'Host: x\r\n\r', b'\nbody'])
+		assert await reader.readuntil(b'\r\n') == b'HTTP/1.1 200 OK\r\n'
+		#the separator is split between chunks
+		assert await reader.readuntil(b'\r\n\r\n') == b'Host: x\r\n\r\n'
+		assert await reader.readline() == b'body'
+	asyncio.run(main())
+
+def test_eof_partial():
+	async def main():
+		reader, _ = make_reader([b'ab', b'c'])
+		with pytest.raises(asyncio.IncompleteReadError) as e:
+			await reader.readexactly(5)
+		assert e.value.partial == b'abc' and e.value.expected == 5
+		reader, _ = make_reader([b'no separator'])
+		with pytest.raises(asyncio.IncompleteReadError) as e:
+			await reader.readuntil(b'\r\n')
+		assert e.value.partial == b'no separator'
+		assert reader.at_eof()
+	asyncio.run(main())
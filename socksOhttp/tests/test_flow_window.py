@@ -0,0 +1,75 @@
+import asyncio
+
+from socksohttp.comms import FlowWindow, FrameSink, StripedSink, Stripe, WireFormat, SessionControl
+from socksohttp.modules.socks5 import Socks5ModuleServer
+
+def test_credit():
+	window = FlowWindow(1000)
+	window.consume(400)
+	assert window.send_credit == 600 and window.has_credit.is_set()
+	window.consume(600)
+	assert window.send_credit == 0 and not window.has_credit.is_set()
+	window.update(100)
+	assert window.send_credit == 100 and window.has_credit.is_set()
+
+def test_delivered():
+	window = FlowWindow(1000)
+	assert window.delivered(300) == 0
+	#given back once half the window was passed on
+	assert window.delivered(200) == 500
+	assert window.delivered(499) == 0
+	assert window.delivered(1) == 500
+
+def test_blocks_until_update():
+	async def main():
+		window = FlowWindow(100)
+		window.consume(150)
+		waiting = asyncio.ensure_future(window.wait_for_credit())
+		await asyncio.sleep(0)
+		assert not waiting.done()
+		#still in debt
+		window.update(50)
+		await asyncio.sleep(0)
+		assert not waiting.done()
+		window.update(1)
+		assert await asyncio.wait_for(waiting, 1) is True
+	asyncio.run(main())
+
+def test_closed_while_blocked():
+	async def main():
+		window = FlowWindow(100)
+		window.consume(100)
+		waiting = asyncio.ensure_future(window.wait_for_credit())
+		await asyncio.sleep(0)
+		window.close()
+		assert await asyncio.wait_for(waiting, 1) is False
+		assert await window.wait_for_credit() is False
+	asyncio.run(main())
+
+def test_window_update_wakes_session():
+	async def main():
+		sink = FrameSink('client')
+		stripes = StripedSink('client')
+		stripes.add(Stripe('client', asyncio.Queue(), sink, WireFormat.BINARY, None))
+		module = Socks5ModuleServer(1, asyncio.Queue(), stripes, initial_window = 4)
+		asyncio.ensure_future(module.handle_client_out())
+		session_id = stripes.open_session(1, module.session_ids)
+		window = module.windows[session_id] = FlowWindow(4)
+		reader = asyncio.StreamReader()
+		reader.feed_data(b'abcdefgh')
+		asyncio.ensure_future(module.handle_client_in(session_id, reader))
+		await asyncio.sleep(0.01)
+		#the reader stops once the window is used up
+		assert window.send_credit == 0 and len(reader._buffer) == 4
+		module.in_queue.put_nowait(SessionControl.window_update(session_id, 4))
+		await asyncio.sleep(0.01)
+		assert len(reader._buffer) == 0
+		data = b''
+		while not sink.empty():
+			data += sink.get_nowait().job_data.data
+		assert data == b'abcdefgh'
+		#closing the session wakes up the blocked reader, it sends the closing packet
+		module.session_closed(session_id)
+		await asyncio.sleep(0.01)
+		assert sink.get_nowait().job_data.data is None
+	asyncio.run(main())
@@ -0,0 +1,87 @@
+import os
+import uuid
+
+import pytest
+
+from socksohttp.comms import *
+
+@pytest.mark.parametrize('n', [0, 1, 0x7F, 0x80, 300, 0x3FFF, 0x4000, 2**32, 2**63 - 1])
+def test_varint_roundtrip(n):
+	data = pack_varint(n)
+	assert unpack_varint(b'xx' + data + b'yy', 2) == (n, 2 + len(data))
+
+def test_varint_errors():
+	with pytest.raises(Exception):
+		unpack_varint(b'\x80\x80')
+	with pytest.raises(Exception):
+		unpack_varint(b'\xff' * 10 + b'\x01')
+
+def frame_roundtrip(job_data):
+	frame = Frame()
+	frame.msg_type = 6
+	frame.seq = 1000
+	frame.ack = 999
+	frame.job_id = 3
+	pack_job_data(frame, job_data)
+	data = frame.to_bytes()
+	parsed = Frame.from_bytes(data)
+	assert (parsed.msg_type, parsed.seq, parsed.ack, parsed.job_id) == (6, 1000, 999, 3)
+	assert parsed.header_data == frame.pack_header()
+	return unpack_job_data(parsed)
+
+def test_frame_job_data():
+	assert frame_roundtrip(b'\x00binary') == b'\x00binary'
+	assert frame_roundtrip('text') == 'text'
+	assert frame_roundtrip(None) is None
+
+def test_frame_session_packets():
+	packet = frame_roundtrip(SessionPacket(200, b'data'))
+	assert packet.session_id == 200 and packet.data == b'data'
+	packet = frame_roundtrip(SessionPacket(5, None))
+	assert packet.session_id == 5 and packet.data is None
+	control = frame_roundtrip(SessionControl(7, ControlType.OPEN, b'request'))
+	assert isinstance(control, SessionControl)
+	assert control.session_id == 7 and control.ctrl_type == ControlType.OPEN and control.data == b'request'
+
+def test_frame_errors():
+	with pytest.raises(Exception):
+		Frame.from_bytes(b'\x00')
+	frame = Frame()
+	frame.msg_type = 6
+	data = frame.to_bytes()
+	with pytest.raises(Exception):
+		Frame.from_bytes(bytes((WIRE_VERSION + 1,)) + data[1:])
+	#job_id varint cut off
+	with pytest.raises(Exception):
+		Frame.from_bytes(data[:-1])
+
+def job_cmd(job_data):
+	cmd = JobCmd()
+	cmd.job_id = 2
+	cmd.job_data = job_data
+	return cmd
+
+@pytest.mark.parametrize('cipher_suite', CIPHER_SUITES)
+@pytest.mark.parametrize('compression_level', [None, 6])
+def test_batch_roundtrip(cipher_suite, compression_level):
+	client_uuid = str(uuid.uuid4())
+	server = CommsChannel(client_uuid, ModuleDesignation.SERVER, True, cipher_suite, compression_level, batching = True)
+	agent = CommsChannel(client_uuid, ModuleDesignation.AGENT, True, cipher_suite, compression_level, batching = True)
+	#several messages in a row, the cipher counters and the deflate streams have to stay in sync
+	for i in range(3):
+		job_data = [SessionPacket(i, b'hello %d ' % i * 100), SessionPacket(i + 1, os.urandom(1000)), SessionControl(i, ControlType.WINDOW_UPDATE, pack_varint(4096)), SessionPacket(i, None)]
+		for batch in [job_data, job_data[:1]]:
+			msg = ClientCmd.batch_to_msg([job_cmd(x) for x in batch], server)
+			cmds = ClientCmd.from_batch(msg, channel = agent)
+			assert [cc.cmd.job_data.to_dict() for cc in cmds] == [x.to_dict() for x in batch]
+	assert agent.seq.recv_seq == server.seq.send_seq
+
+def test_batch_errors():
+	batch = Frame.from_bytes(pack_batch([job_cmd(b'data').to_frame()], MSG_BATCH))
+	assert len(unpack_batch(batch)) == 1
+	truncated = Frame.from_bytes(batch.to_bytes()[:-1])
+	with pytest.raises(Exception):
+		unpack_batch(truncated)
+	nested = Frame.from_bytes(pack_batch([batch], MSG_BATCH))
+	with pytest.raises(Exception):
+		unpack_batch(nested)
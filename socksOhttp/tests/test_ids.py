@@ -0,0 +1,50 @@
+from socksohttp.comms import SeqTracker, IdAllocator
+
+def test_seq_tracker():
+	server = SeqTracker()
+	agent = SeqTracker()
+	for _ in range(3):
+		agent.received(*server.next())
+	assert agent.recv_seq == 3 and agent.lost == 0
+	server.received(*agent.next())
+	#the ack of seq 3 gives a round trip sample and clears the pending messages
+	assert server.srtt is not None and len(server.pending) == 0
+	assert agent.to_dict()['send_seq'] == 1
+
+def test_seq_tracker_gaps():
+	tracker = SeqTracker()
+	tracker.received(1, 0)
+	tracker.received(4, 0)
+	assert tracker.lost == 2 and tracker.recv_seq == 4
+	tracker.received(3, 0)
+	assert tracker.reordered == 1 and tracker.recv_seq == 4
+
+def test_seq_tracker_wraps():
+	tracker = SeqTracker()
+	tracker.send_seq = 0xFFFFFFFE
+	assert tracker.next()[0] == 0xFFFFFFFF
+	assert tracker.next()[0] == 0
+	tracker.recv_seq = 0xFFFFFFFF
+	tracker.received(0, 0)
+	assert tracker.lost == 0 and tracker.reordered == 0 and tracker.recv_seq == 0
+
+def test_id_allocator():
+	ids = IdAllocator()
+	assert [ids.get() for _ in range(4)] == [0, 1, 2, 3]
+	ids.release(2)
+	ids.release(0)
+	#released ids are reused lowest first, so they stay short as varints
+	assert ids.get() == 0
+	assert ids.get() == 2
+	assert ids.get() == 4
+
+def test_id_allocator_accept():
+	ids = IdAllocator()
+	for _ in range(3):
+		ids.get()
+	ids.release(0)
+	ids.release(1)
+	#eg. only ids that were last used on the same websocket
+	assert ids.get(lambda x: x == 1) == 1
+	assert ids.get(lambda x: False) == 3
+	assert ids.free == [0]
@@ -0,0 +1,75 @@
+import json
+import uuid
+
+import pytest
+
+from socksohttp.comms import *
+
+def register_cmd(**kwargs):
+	cmd = RegisterCmd()
+	cmd.client_uuid = str(uuid.uuid4())
+	for name, value in kwargs.items():
+		setattr(cmd, name, value)
+	#what the agent gets on the wire
+	return RegisterCmd.from_json(json.loads(cmd.to_json()))
+
+def test_negotiate_defaults():
+	cmd = register_cmd(with_encryption = True, compression_level = 6)
+	rply = RegisterRply.negotiate(cmd)
+	assert rply.wire_format == 'binary' and rply.wire_version == WIRE_VERSION
+	assert rply.cipher_suite in CIPHER_SUITES and rply.compression_level == 6 and rply.batching
+	cmd.check_options(rply)
+
+def test_v1_agent():
+	#an old agent only sends back the uuid
+	cmd = register_cmd(with_encryption = True, compression_level = 6, initial_window = 65536)
+	rply = RegisterRply.from_json({'rply_id' : 3, 'client_uuid' : cmd.client_uuid})
+	assert rply.protocol_version == 1
+	assert rply.wire_format == 'json' and rply.wire_version is None
+	assert not rply.with_encryption and rply.compression_level is None
+	assert not rply.batching and rply.initial_window is None and not rply.striping and not rply.session_open
+	cmd.check_options(rply)
+
+def test_v1_server():
+	cmd = RegisterCmd.from_json({'cmd_id' : 3, 'client_uuid' : str(uuid.uuid4())})
+	assert cmd.protocol_version == 1
+	rply = RegisterRply.negotiate(cmd)
+	assert rply.wire_format == 'json' and rply.compression_level is None and not rply.with_encryption
+	assert not rply.batching and not rply.striping and not rply.session_open
+
+def test_no_mutual_options():
+	cmd = register_cmd(with_encryption = True, compression_level = 6)
+	cmd.capabilities['compression'] = ['zstd']
+	cmd.capabilities['batching'] = []
+	rply = RegisterRply.negotiate(cmd)
+	assert rply.wire_format == 'binary'
+	assert rply.compression_level is None and not rply.batching
+	cmd.check_options(rply)
+	cmd.capabilities['cipher_suites'] = ['chacha20-poly1305']
+	with pytest.raises(Exception, match = 'No common cipher suite'):
+		RegisterRply.negotiate(cmd)
+	#without a mutual wire version everything stays JSON, the cipher list does not matter
+	cmd.capabilities['wire_versions'] = [WIRE_VERSION + 1]
+	rply = RegisterRply.negotiate(cmd)
+	assert rply.wire_format == 'json' and rply.compression_level is None
+	cmd.check_options(rply)
+
+@pytest.mark.parametrize('option, value, error', [
+	('cipher_suite', 'chacha20-poly1305', 'cipher suite'),
+	('wire_version', WIRE_VERSION + 1, 'wire format'),
+	('compression_level', 6, 'compression'),
+	('batching', True, 'batching'),
+	('initial_window', 1024, 'flow control'),
+	('striping', True, 'striping'),
+	('session_open', True, 'session open'),
+])
+def test_check_options_rejects(option, value, error):
+	cmd = register_cmd(with_encryption = True)
+	cmd.capabilities['batching'] = []
+	cmd.capabilities['striping'] = []
+	cmd.capabilities['session_open'] = []
+	rply = RegisterRply.negotiate(cmd)
+	cmd.check_options(rply)
+	setattr(rply, option, value)
+	with pytest.raises(Exception, match = error):
+		cmd.check_options(rply)
@@ -0,0 +1,51 @@
+import asyncio
+
+from socksohttp.queues import DRRQueue
+
+def drr(max_bytes = None, quantum = 1000):
+	#items are (flow, data)
+	return DRRQueue(max_bytes, sizeof = lambda item: len(item[1]), flowof = lambda item: item[0], quantum = quantum)
+
+def drain(queue):
+	out = []
+	while not queue.empty():
+		out.append(queue.get_nowait())
+	return out
+
+def test_drr_round_robin():
+	async def main():
+		queue = drr()
+		for i in range(4):
+			queue.put_nowait(('bulk', b'b' * 1000))
+		queue.put_nowait(('ssh', b's' * 50))
+		queue.put_nowait(('ssh', b's' * 50))
+		flows = [flow for flow, _ in drain(queue)]
+		#the small flow gets out within one round of the bulk one
+		assert flows == ['bulk', 'ssh', 'ssh', 'bulk', 'bulk', 'bulk']
+		assert queue.size == 0 and queue.to_dict()['flows'] == 0
+	asyncio.run(main())
+
+def test_drr_fifo_per_flow():
+	async def main():
+		queue = drr(quantum = 100)
+		for i in range(10):
+			queue.put_nowait((i % 3, b'%d' % i * (i + 1) * 10))
+		out = drain(queue)
+		for flow in range(3):
+			assert [data for f, data in out if f == flow] == [b'%d' % i * (i + 1) * 10 for i in range(10) if i % 3 == flow]
+	asyncio.run(main())
+
+def test_drr_full():
+	async def main():
+		queue = drr(max_bytes = 1500)
+		await queue.put(('bulk', b'b' * 1000))
+		await queue.put(('bulk', b'b' * 1000))
+		blocked = asyncio.ensure_future(queue.put(('bulk', b'b' * 1000)))
+		await asyncio.sleep(0)
+		assert not blocked.done()
+		#a flow without queued data is not held up by the full queue
+		await asyncio.wait_for(queue.put(('ssh', b's')), 1)
+		queue.get_nowait()
+		await asyncio.wait_for(blocked, 1)
+		assert queue.qsize() == 3 and queue.to_dict()['full_waits'] == 1
+	asyncio.run(main())
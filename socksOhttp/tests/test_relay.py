@@ -0,0 +1,76 @@
+import os
+import asyncio
+
+from socksohttp.relay import Relay, SocketEndpoint
+
+async def relayed_pair():
+	"""
+	client <-> relay <-> destination over loopback sockets, like a socks5 session on the agent.
+	Returns the client streams, the destination streams and the relay.
+	"""
+	loop = asyncio.get_event_loop()
+	destinations = asyncio.Queue()
+	async def on_destination(reader, writer):
+		await destinations.put((reader, writer))
+	destination_server = await asyncio.start_server(on_destination, '127.0.0.1', 0)
+	relays = asyncio.Queue()
+	async def on_client(reader, writer):
+		_, destination = await loop.create_connection(lambda: SocketEndpoint(name = 'destination'), '127.0.0.1', destination_server.sockets[0].getsockname()[1])
+		relay = Relay(timeout = None)
+		relay.connect(SocketEndpoint.from_stream(reader, writer, name = 'client'), destination)
+		await relays.put(relay)
+	relay_server = await asyncio.start_server(on_client, '127.0.0.1', 0)
+	client = await asyncio.open_connection('127.0.0.1', relay_server.sockets[0].getsockname()[1])
+	destination = await asyncio.wait_for(destinations.get(), 1)
+	relay = await asyncio.wait_for(relays.get(), 1)
+	destination_server.close()
+	relay_server.close()
+	return client, destination, relay
+
+def test_bidirectional():
+	async def main():
+		(creader, cwriter), (dreader, dwriter), relay = await relayed_pair()
+		upload = os.urandom(1024*1024)
+		download = os.urandom(512*1024)
+		cwriter.write(upload)
+		dwriter.write(download)
+		received = await asyncio.wait_for(asyncio.gather(dreader.readexactly(len(upload)), creader.readexactly(len(download))), 5)
+		assert received == [upload, download]
+		client, destination = relay.to_dict()['endpoints']
+		assert client['in'] == destination['out'] == len(upload)
+		assert destination['in'] == client['out'] == len(download)
+		cwriter.close()
+		await asyncio.wait_for(relay.closed.wait(), 1)
+		dwriter.close()
+	asyncio.run(main())
+
+def test_half_close():
+	async def main():
+		(creader, cwriter), (dreader, dwriter), relay = await relayed_pair()
+		#the client is done sending: what it sent still arrives, then the destination sees EOF
+		cwriter.write(b'request')
+		cwriter.write_eof()
+		assert await asyncio.wait_for(dreader.read(), 1) == b'request'
+		await asyncio.wait_for(relay.closed.wait(), 1)
+		#the relay closes the client side too
+		assert await asyncio.wait_for(creader.read(), 1) == b''
+		cwriter.close()
+		dwriter.close()
+	asyncio.run(main())
+
+def test_reset():
+	async def main():
+		(creader, cwriter), (dreader, dwriter), relay = await relayed_pair()
+		cwriter.write(b'ping')
+		assert await asyncio.wait_for(dreader.readexactly(4), 1) == b'ping'
+		#the destination resets the connection
+		dwriter.transport.abort()
+		await asyncio.wait_for(relay.closed.wait(), 1)
+		try:
+			assert await asyncio.wait_for(creader.read(), 1) == b''
+		except ConnectionResetError:
+			pass
+		for endpoint in relay.endpoints:
+			assert endpoint.transport.is_closing()
+		cwriter.close()
+	asyncio.run(main())
@@ -0,0 +1,101 @@
+import socket
+import asyncio
+
+from socksohttp.resolver import DNSCache
+
+def fake_resolver(loop, calls, delay = 0.01):
+	"""
+	Replaces getaddrinfo of the loop, names ending with .invalid do not resolve
+	"""
+	async def getaddrinfo(host, port, **kwargs):
+		calls.append(host)
+		await asyncio.sleep(delay)
+		if host.endswith('.invalid'):
+			raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+		address = '10.0.0.%d' % len(calls)
+		return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 0)), (socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 0))]
+	loop.getaddrinfo = getaddrinfo
+
+def run(coro_func):
+	async def main():
+		calls = []
+		fake_resolver(asyncio.get_event_loop(), calls)
+		return await coro_func(calls)
+	return asyncio.run(main())
+
+def test_hit_and_ip_literal():
+	async def main(calls):
+		cache = DNSCache()
+		assert await cache.resolve('Example.com') == ['10.0.0.1']
+		assert await cache.resolve('example.com') == ['10.0.0.1']
+		assert await cache.resolve('127.0.0.1') == ['127.0.0.1']
+		assert calls == ['example.com']
+		stats = cache.to_dict()
+		assert stats['hits'] == 1 and stats['misses'] == 1 and stats['lookups'] == 2
+	run(main)
+
+def test_coalescing():
+	async def main(calls):
+		cache = DNSCache()
+		results = await asyncio.gather(*[cache.resolve('example.com') for _ in range(5)])
+		assert results == [['10.0.0.1']] * 5
+		assert calls == ['example.com']
+		assert cache.to_dict()['coalesced'] == 4
+	run(main)
+
+def test_negative_caching():
+	async def main(calls):
+		cache = DNSCache(negative_ttl = 60)
+		for _ in range(3):
+			try:
+				await cache.resolve('nothing.invalid')
+				assert False
+			except socket.gaierror:
+				pass
+		assert calls == ['nothing.invalid']
+		assert cache.to_dict()['negative_hits'] == 2
+	run(main)
+
+def test_ttl_and_lru():
+	async def main(calls):
+		cache = DNSCache(ttl = 0.05, max_entries = 2)
+		await cache.resolve('a.example')
+		await cache.resolve('b.example')
+		await cache.resolve('a.example')
+		await cache.resolve('c.example') #b is the least recently used
+		assert list(cache.entries) == ['a.example', 'c.example']
+		assert cache.to_dict()['evictions'] == 1
+		await asyncio.sleep(0.1)
+		await cache.resolve('a.example')
+		assert calls.count('a.example') == 2
+	run(main)
+
+def test_first_caller_cancelled():
+	async def main(calls):
+		fake_resolver(asyncio.get_event_loop(), calls, delay = 0.1)
+		cache = DNSCache()
+		first = asyncio.ensure_future(asyncio.wait_for(cache.resolve('example.com'), timeout = 0.02))
+		await asyncio.sleep(0)
+		second = asyncio.ensure_future(cache.resolve('example.com'))
+		try:
+			await first
+			assert False
+		except asyncio.TimeoutError:
+			pass
+		assert await second == ['10.0.0.1']
+		#the lookup finished for the one that gave up too
+		assert await cache.resolve('example.com') == ['10.0.0.1']
+		assert calls == ['example.com']
+	run(main)
+
+def test_waiter_cancelled():
+	async def main(calls):
+		cache = DNSCache()
+		first = asyncio.ensure_future(cache.resolve('example.com'))
+		await asyncio.sleep(0)
+		second = asyncio.ensure_future(cache.resolve('example.com'))
+		await asyncio.sleep(0)
+		second.cancel()
+		assert await first == ['10.0.0.1']
+		assert second.cancelled()
+	run(main)
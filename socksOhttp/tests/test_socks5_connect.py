@@ -0,0 +1,66 @@
+import socket
+import asyncio
+import ipaddress
+
+import pytest
+
+import socksohttp.modules.socks5 as socks5
+from socksohttp.modules.socks5 import *
+from socksohttp.resolver import DNSCache
+
+def make_server(dns_cache = None):
+	module = Socks5Module(1, asyncio.Queue(), asyncio.Queue(), dns_cache = dns_cache)
+	return module.create_session(0)
+
+def request(host, port = 443):
+	try:
+		return SOCKS5Request.construct(SOCKS5Command.CONNECT, ipaddress.ip_address(host), port)
+	except ValueError:
+		return SOCKS5Request.construct(SOCKS5Command.CONNECT, host, port)
+
+def test_slow_lookup_not_timed_out(monkeypatch):
+	monkeypatch.setattr(socks5, 'CONNECT_TIMEOUT', 0.05)
+	async def main():
+		listener = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', 0)
+		port = listener.sockets[0].getsockname()[1]
+		loop = asyncio.get_event_loop()
+		async def getaddrinfo(host, port, **kwargs):
+			await asyncio.sleep(0.2)
+			return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+		loop.getaddrinfo = getaddrinfo
+		#the lookup takes longer than CONNECT_TIMEOUT, only the connect itself is timed
+		for dns_cache in [None, DNSCache()]:
+			server = make_server(dns_cache)
+			assert await server.connect(request('example.com', port)) == SOCKS5ReplyType.SUCCEEDED
+			server.destination.close()
+		listener.close()
+	asyncio.run(main())
+
+def test_connect_errors(monkeypatch):
+	monkeypatch.setattr(socks5, 'CONNECT_TIMEOUT', 0.05)
+	async def main():
+		loop = asyncio.get_event_loop()
+		async def create_connection(factory, host, port):
+			if host == '10.0.0.1':
+				await asyncio.sleep(1)
+			raise ConnectionRefusedError()
+		loop.create_connection = create_connection
+		assert await make_server().connect(request('10.0.0.1')) == SOCKS5ReplyType.TTL_EXPIRED
+		assert await make_server().connect(request('10.0.0.2')) == SOCKS5ReplyType.CONN_REFUSED
+	asyncio.run(main())
+
+def test_connect_cancelled():
+	async def main():
+		loop = asyncio.get_event_loop()
+		started = asyncio.Event()
+		async def getaddrinfo(host, port, **kwargs):
+			started.set()
+			await asyncio.sleep(10)
+		loop.getaddrinfo = getaddrinfo
+		task = asyncio.ensure_future(make_server().connect(request('example.com')))
+		await started.wait()
+		task.cancel()
+		#the session is being torn down, the cancellation is not turned into a reply
+		with pytest.raises(asyncio.CancelledError):
+			await task
+	asyncio.run(main())
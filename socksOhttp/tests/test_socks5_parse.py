@@ -0,0 +1,81 @@
+import asyncio
+import ipaddress
+
+import pytest
+
+from socksohttp.modules.socks5 import *
+
+def parse_incremental(msg_type, data):
+	"""
+	Feeds the parser the way read_message does: only as many bytes as it asked for
+	"""
+	buffered = b''
+	while True:
+		msg, length = msg_type.parse(buffered)
+		if msg is not None:
+			return msg, length
+		assert length > len(buffered)
+		buffered = data[:length]
+
+def test_nego():
+	nego, length = SOCKS5Nego.parse(b'\x05\x02\x00\x02rest')
+	assert length == 4
+	assert nego.VER == 5 and nego.METHODS == [SOCKS5Method.NOAUTH, SOCKS5Method.PLAIN]
+	assert SOCKS5Nego.parse(b'\x05') == (None, 2)
+	assert SOCKS5Nego.parse(b'\x05\x03\x00') == (None, 5)
+
+def test_nego_unknown_methods():
+	#private methods are left out, so the server can answer NOTACCEPTABLE
+	nego, length = SOCKS5Nego.parse(b'\x05\x03\x80\x00\xfe')
+	assert length == 5 and nego.METHODS == [SOCKS5Method.NOAUTH]
+	nego, _ = SOCKS5Nego.parse(b'\x05\x01\x80')
+	assert nego.METHODS == []
+	assert get_mutual_preference([SOCKS5Method.NOAUTH], nego.METHODS)[0] is None
+
+def test_nego_reply():
+	rep, length = SOCKS5NegoReply.parse(SOCKS5NegoReply.construct(SOCKS5Method.NOTACCEPTABLE).to_bytes())
+	assert length == 2 and rep.VER == 5 and rep.METHOD == SOCKS5Method.NOTACCEPTABLE
+
+def test_plain_auth():
+	data = SOCKS5PlainAuth.construct('user', 'secret').to_bytes()
+	auth, length = parse_incremental(SOCKS5PlainAuth, data + b'\x05')
+	assert length == len(data)
+	assert auth.UNAME == 'user' and auth.PASSWD == 'secret'
+
+@pytest.mark.parametrize('address', [ipaddress.ip_address('10.1.2.3'), ipaddress.ip_address('2001:db8::1'), 'example.com'])
+def test_request(address):
+	data = SOCKS5Request.construct(SOCKS5Command.CONNECT, address, 443).to_bytes()
+	req, length = parse_incremental(SOCKS5Request, data)
+	assert length == len(data)
+	assert req.CMD == SOCKS5Command.CONNECT and req.DST_ADDR == address and req.DST_PORT == 443
+	#a memoryview works too, the server parses straight from its buffer
+	req, length = SOCKS5Request.parse(memoryview(data + b'early data'))
+	assert length == len(data) and req.DST_ADDR == address
+	assert SOCKS5Request.from_bytes(data).to_bytes() == data
+
+def test_reply():
+	data = SOCKS5Reply.construct(SOCKS5ReplyType.CONN_REFUSED, ipaddress.ip_address('0.0.0.0'), 0).to_bytes()
+	rep, length = parse_incremental(SOCKS5Reply, data)
+	assert length == 10 and rep.REP == SOCKS5ReplyType.CONN_REFUSED and rep.BIND_PORT == 0
+
+def test_incomplete_from_bytes():
+	with pytest.raises(Exception):
+		SOCKS5Request.from_bytes(b'\x05\x01\x00\x03\x0bexample')
+
+def test_read_message_leaves_the_rest():
+	async def main():
+		reader = asyncio.StreamReader()
+		request = SOCKS5Request.construct(SOCKS5Command.CONNECT, 'example.com', 80).to_bytes()
+		data = b'\x05\x01\x00' + request + b'GET /'
+		#split in the middle of the messages
+		reader.feed_data(data[:2])
+		reader.feed_data(data[2:9])
+		reader.feed_data(data[9:])
+		session = SOCKS5Session()
+		nego = await SOCKS5CommandParser.from_streamreader(reader, session, 1)
+		assert nego.METHODS == [SOCKS5Method.NOAUTH]
+		session.current_state = SOCKS5ServerState.REQUEST
+		req = await SOCKS5CommandParser.from_streamreader(reader, session, 1)
+		assert req.DST_ADDR == 'example.com' and req.DST_PORT == 80
+		assert await reader.read(5) == b'GET /'
+	asyncio.run(main())
@@ -0,0 +1,133 @@
+import asyncio
+import ipaddress
+
+import socksohttp.modules.socks5 as socks5
+from socksohttp.modules.socks5 import *
+
+class FakeWriter:
+	"""
+	Client socket of a session on the server
+	"""
+	def __init__(self, reader = None):
+		self.reader = reader
+		self.data = b''
+		self.closed = False
+
+	def write(self, data):
+		self.data += data
+
+	async def drain(self):
+		pass
+
+	def close(self):
+		self.closed = True
+		if self.reader is not None:
+			self.reader.feed_eof()
+
+	def get_extra_info(self, name):
+		return ('127.0.0.1', 40000)
+
+def make_module(**kwargs):
+	sink = FrameSink('client')
+	stripes = StripedSink('client')
+	stripes.add(Stripe('client', asyncio.Queue(), sink, WireFormat.BINARY, None))
+	module = Socks5ModuleServer(1, asyncio.Queue(), stripes, local_handshake = True, **kwargs)
+	asyncio.ensure_future(module.handle_client_out())
+	return module, sink
+
+def sent_packets(sink):
+	packets = []
+	while not sink.empty():
+		packets.append(sink.get_nowait().job_data)
+	return packets
+
+def is_open(packet, session_id):
+	return isinstance(packet, SessionControl) and packet.ctrl_type == ControlType.OPEN and packet.session_id == session_id
+
+def is_close(packet, session_id):
+	return not isinstance(packet, SessionControl) and packet.data is None and packet.session_id == session_id
+
+REQUEST = SOCKS5Request.construct(SOCKS5Command.CONNECT, ipaddress.ip_address('10.0.0.1'), 443)
+
+async def close_queued(module):
+	"""
+	Closes a session while its closing packet is still queued, the agent's close already arrived
+	:return: the id, it is free again
+	"""
+	session_id = module.out_queue.open_session(module.job_id, module.session_ids)
+	await module.end_session(session_id)
+	module.in_queue.put_nowait(SessionPacket(session_id, None))
+	await asyncio.sleep(0)
+	assert module.session_ids.free == [session_id]
+	return session_id
+
+def client_reader(data):
+	reader = asyncio.StreamReader()
+	#greeting with the no authentication method, then the request
+	reader.feed_data(b'\x05\x01\x00' + REQUEST.to_bytes() + data)
+	return reader
+
+def test_open_after_close_of_reused_id():
+	async def main():
+		module, sink = make_module()
+		session_id = await close_queued(module)
+		assert module.out_queue.open_session(module.job_id, module.session_ids) == session_id
+		writer = FakeWriter()
+		opening = asyncio.ensure_future(module.open_session(session_id, REQUEST, writer))
+		await asyncio.sleep(0)
+		packets = sent_packets(sink)
+		assert len(packets) == 2
+		assert is_close(packets[0], session_id) and is_open(packets[1], session_id)
+		module.in_queue.put_nowait(SessionControl.open_result(session_id, SOCKS5ReplyType.SUCCEEDED.value))
+		assert await asyncio.wait_for(opening, 1) is True
+		assert SOCKS5Reply.from_bytes(writer.data).REP == SOCKS5ReplyType.SUCCEEDED
+	asyncio.run(main())
+
+def test_open_timeout(monkeypatch):
+	monkeypatch.setattr(socks5, 'OPEN_TIMEOUT', 0.05)
+	async def main():
+		module, sink = make_module()
+		session_id = module.out_queue.open_session(module.job_id, module.session_ids)
+		writer = FakeWriter()
+		assert await module.open_session(session_id, REQUEST, writer) is False
+		assert SOCKS5Reply.from_bytes(writer.data).REP == SOCKS5ReplyType.TTL_EXPIRED
+		assert session_id not in module.opening
+		#the session is closed and its id comes back once the agent answered the close
+		await module.end_session(session_id)
+		module.in_queue.put_nowait(SessionPacket(session_id, None))
+		await asyncio.sleep(0)
+		assert module.session_ids.free == [session_id]
+	asyncio.run(main())
+
+def test_early_open_after_close_of_reused_id():
+	async def main():
+		module, sink = make_module(early_data = True)
+		session_id = await close_queued(module)
+		reader = client_reader(b'hello')
+		writer = FakeWriter(reader)
+		await module.handle_client(reader, writer)
+		packets = sent_packets(sink)
+		assert is_close(packets[0], session_id) and is_open(packets[1], session_id)
+		assert packets[1].data.endswith(b'hello')
+		#the client is told it is connected right away
+		assert SOCKS5Reply.from_bytes(writer.data[2:]).REP == SOCKS5ReplyType.SUCCEEDED
+		module.in_queue.put_nowait(SessionControl.open_result(session_id, SOCKS5ReplyType.SUCCEEDED.value))
+		await asyncio.sleep(0.01)
+		assert session_id not in module.opening and not writer.closed
+		writer.close()
+	asyncio.run(main())
+
+def test_early_open_timeout(monkeypatch):
+	monkeypatch.setattr(socks5, 'OPEN_TIMEOUT', 0.05)
+	async def main():
+		module, sink = make_module(early_data = True, initial_window = 1024)
+		reader = client_reader(b'')
+		writer = FakeWriter(reader)
+		await module.handle_client(reader, writer)
+		session_id = sent_packets(sink)[0].session_id
+		await asyncio.sleep(0.2)
+		#no answer from the agent: the client socket is closed and the session with it
+		assert writer.closed
+		assert session_id not in module.opening and session_id not in module.sessions
+		assert is_close(sent_packets(sink)[0], session_id)
+	asyncio.run(main())
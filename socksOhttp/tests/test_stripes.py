@@ -0,0 +1,119 @@
+import asyncio
+
+from socksohttp.comms import *
+from socksohttp.client import CommsAgentServer
+
+def packet(session_id, data):
+	cmd = JobCmd()
+	cmd.job_id = 1
+	cmd.job_data = SessionPacket(session_id, data)
+	return cmd
+
+def make_sink(n, sticky = True):
+	sink = StripedSink('client', sticky)
+	for _ in range(n):
+		sink.add(Stripe('client', asyncio.Queue(), FrameSink('client'), WireFormat.BINARY, None))
+	return sink
+
+def drain(stripe):
+	items = []
+	while not stripe.out_queue.empty():
+		items.append(stripe.out_queue.get_nowait())
+	return items
+
+def test_policy_grow():
+	policy = StripePolicy(max_stripes = 3, grow_rate = 1000, grow_backlog = 500)
+	assert policy.decide(1, 999, 499) == 0
+	assert policy.decide(1, 1000, 0) == 1
+	assert policy.decide(2, 1000, 1000) == 1
+	#rate and backlog are per stripe
+	assert policy.decide(2, 1999, 999) == 0
+	assert policy.decide(3, 10**9, 10**9) == 0
+
+def test_policy_shrink():
+	policy = StripePolicy(max_stripes = 3, min_stripes = 1, grow_rate = 1000, shrink_after = 3)
+	#the remaining stripe could carry 249 bytes/sec at a quarter of grow_rate
+	assert [policy.decide(2, 249, 0) for _ in range(3)] == [0, 0, -1]
+	assert policy.idle == 0
+	#any busy interval starts the count again
+	assert policy.decide(2, 249, 0) == 0
+	assert policy.decide(2, 250, 0) == 0
+	assert policy.decide(2, 0, 1) == 0
+	assert [policy.decide(2, 0, 0) for _ in range(3)] == [0, 0, -1]
+	#never below min_stripes
+	assert [policy.decide(1, 0, 0) for _ in range(5)] == [0] * 5
+
+def test_session_pinned():
+	async def main():
+		sink = make_sink(2)
+		first = sink.open_session(1, IdAllocator())
+		#the next session goes to the stripe with less sessions
+		second = sink.open_session(1, IdAllocator(start_no = 1))
+		for i in range(5):
+			await sink.put(packet(first, b'a%d' % i))
+			await sink.put(packet(second, b'b%d' % i))
+		sink.put_nowait(packet(first, None))
+		a, b = sink.stripes
+		assert [p.job_data.data for p in drain(a)] == [None] + [b'a%d' % i for i in range(5)]
+		assert [p.job_data.data for p in drain(b)] == [b'b%d' % i for i in range(5)]
+		#draining stripes get no new sessions
+		b.draining = True
+		third = sink.open_session(1, IdAllocator(start_no = 2))
+		assert sink.pins[(1, third)] is a
+	asyncio.run(main())
+
+def test_server_drain_keeps_queued_frames():
+	async def main():
+		sink = make_sink(2)
+		stripe = sink.stripes[1]
+		sink.stripes[0].sessions = 1
+		session_id = sink.open_session(1, IdAllocator())
+		assert sink.pins[(1, session_id)] is stripe
+		for i in range(3):
+			await sink.put(packet(session_id, b'%d' % i))
+		draining = asyncio.ensure_future(sink.drain(stripe))
+		await asyncio.sleep(0.15)
+		assert not stripe.drained.is_set()
+		#the session still sends on its stripe and closes there
+		await sink.put(packet(session_id, None))
+		sent = drain(stripe)
+		await asyncio.wait_for(draining, 1)
+		sent += drain(stripe)
+		assert [p.job_data.data for p in sent[:4]] == [b'0', b'1', b'2', None]
+		#DRAINED goes out after everything else
+		assert len(sent) == 5 and sent[4].op == StripeOp.DRAINED
+	asyncio.run(main())
+
+class FakeWebsocket:
+	def __init__(self):
+		self.closed = False
+
+	async def close(self):
+		self.closed = True
+
+def test_agent_remove_stripe_sends_queued_frames():
+	async def main():
+		client = CommsAgentServer('ws://127.0.0.1:8443')
+		agent = type('agent', (), {})()
+		agent.out_queue = make_sink(2, sticky = False)
+		stripe = agent.out_queue.stripes[1]
+		stripe.sessions = 0
+		agent.out_queue.stripes[0].sessions = 1
+		for i in range(3):
+			await agent.out_queue.put(packet(7, b'%d' % i))
+		assert agent.out_queue.pins[(1, 7)] is stripe
+		ws = FakeWebsocket()
+		removing = asyncio.ensure_future(client.remove_stripe(agent, ws, stripe))
+		await asyncio.sleep(0)
+		#the server answers the DRAIN request once it has nothing more for the stripe
+		stripe.drained.set()
+		await asyncio.sleep(0.15)
+		assert not ws.closed and stripe in agent.out_queue.stripes
+		await agent.out_queue.put(packet(7, None))
+		sent = drain(stripe)
+		await asyncio.wait_for(removing, 1)
+		assert ws.closed and stripe not in agent.out_queue.stripes
+		#the DRAIN request, then every frame of the session
+		assert sent[0].op == StripeOp.DRAIN
+		assert [p.job_data.data for p in sent[1:]] == [b'0', b'1', b'2', None]
+	asyncio.run(main())